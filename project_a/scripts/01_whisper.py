@@ -1,14 +1,13 @@
 # Note: The file size limit for the Whisper model is 25 MB. 
-# If you need to transcribe a file larger than 25 MB, you can use the Azure AI Speech batch transcription API.
+# Larger files are split into parts at pauses, the parts are transcribed in parallel and the transcripts stitched back together.
+# Alternatively, you can use the Azure AI Speech batch transcription API.
 
 import os
-import time
-from openai import AzureOpenAI
 from dotenv import load_dotenv
 
-load_dotenv()
+from transcribers import create_transcriber, run_transcription_pipeline
 
-start_time = time.time()
+load_dotenv()
 
 demo_flag = True
 print(f'demo_flag: {demo_flag}')
@@ -16,34 +15,22 @@ print(f'demo_flag: {demo_flag}')
 deployment_id = "whisper" # "gpt-4o-transcribe" 
 audio_test_files = ["../audio_files/4379528_trimmed.mp3", "../audio_files/4379528.mp3"] if not demo_flag else ["../audio_files_sample/wikipediaOcelot.wav"]
 output_path = "../transcripts" if not demo_flag else "../transcripts_sample"
+cache_path = "../cache" # Transcription results are reused when the same audio is transcribed again with the same settings
  
-client = AzureOpenAI(
-    api_key=os.getenv("AZURE_OPENAI_API_KEY"),  
-    api_version= '2024-10-21', #'2025-04-01-preview, #'2024-02-01'
-    azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-)
-
 audio_test_file_selected = audio_test_files[1] if not demo_flag else audio_test_files[0] # Select the file from the list
 
-result = client.audio.transcriptions.create(
-    file=open(audio_test_file_selected, "rb"),            
-    model=deployment_id,
-    temperature=0,
-    # prompt='''You are generating a text transcript for documentation. 
-    # You will be given audio file, listen to it carefully ignoring background sounds.
-    # Do not guess words that you cannot hear clearly.''',    
-    # # response_format="json" # text, srt
-)
-
-end_time = time.time()
-# print(result.text)
-
-# Calculate time taken in seconds  
-time_taken = end_time - start_time  
-print(f"Time taken: {time_taken:.2f} seconds")  
-
-# Save the variable to the file
-output_file_path = os.path.join(output_path, 'whisper_transcript_' + os.path.basename(audio_test_file_selected) +'.txt')
-with open(output_file_path, "w") as file:  
-    file.write(result.text)
-    print(f"Transcription saved to {output_file_path}")
\ No newline at end of file
+# Requests are spread across the deployments listed in the AZURE_OPENAI_ENDPOINTS_CONFIG file (see endpoints_template.json),
+# or sent to AZURE_OPENAI_ENDPOINT if it is not set. Retries and failover are handled by the pool.
+# Set requests_per_minute to the rate limit of the deployment (Azure AI Foundry > Deployments), Whisper deployments default to 3 requests per minute
+transcriber = create_transcriber('whisper', 
+                                 cache_dir=cache_path, 
+                                 deployment_id=deployment_id, 
+                                 api_version='2024-10-21', #'2025-04-01-preview, #'2024-02-01'
+                                 requests_per_minute=3, 
+                                 max_file_size_mb=25, # Whisper file size limit, larger files are split into parts
+                                 split_for_latency=False, # Set to True to split smaller files too, parts are transcribed in parallel for lower latency
+                                 part_length=600, # Target length of each part in seconds, boundaries are placed in pauses near this length
+                                 max_concurrency=4) # Parts sent at the same time per endpoint
+
+# The audio duration, tokens and estimated cost are appended to the usage ledger, see 07_usage_report.py
+run_transcription_pipeline(transcriber, [audio_test_file_selected], output_path, usage_ledger_path=os.path.join(cache_path, 'usage_ledger.jsonl'))
@@ -0,0 +1,91 @@
+# Batch transcription of many audio files in one process, with any of the four backends.
+# Clients, endpoint pools and caches are set up once and the files are transcribed by a pool of workers.
+#
+# Examples:
+#   python 05_batch.py --input ../audio_files --backend whisper
+#   python 05_batch.py --input "../audio_files/**/*.mp3" --backend 4o_audio --workers 8
+#   python 05_batch.py --input ../audio_files/manifest.csv --backend base_speech   (CSV with a file_path column, or JSONL with a "file_path" key)
+#   python 05_batch.py --input ../audio_files --backend auto --latency-sla 900   (backend chosen per file, see RoutingTranscriber)
+
+import os
+import argparse
+from datetime import datetime
+from dotenv import load_dotenv
+
+from speech_jobs import TranscriptionWebhookReceiver
+from utils import list_audio_files, register_transcription_webhook, delete_webhook
+from metrics import configure_metrics
+from transcripts import TRANSCRIPT_FORMATS
+from transcribers import BACKENDS, SPEECH_API_URL, SPEECH_BACKEND_MODELS, RoutingTranscriber, create_transcriber, run_transcription_pipeline
+
+load_dotenv()
+
+parser = argparse.ArgumentParser(description='Transcribe a folder, glob pattern or manifest of audio files.')
+parser.add_argument('--input', required=True, help='Folder, glob pattern or .csv / .jsonl manifest of audio files')
+parser.add_argument('--backend', required=True, choices=BACKENDS + ('auto',), help='auto chooses the backend per file')
+parser.add_argument('--output', default='../transcripts', help='Folder the transcripts and the status summary are saved to')
+parser.add_argument('--workers', type=int, default=4, help='Number of files transcribed at the same time')
+parser.add_argument('--cache', default='../cache', help='Transcription cache folder')
+parser.add_argument('--content-container-url', default=None, help='Speech backends: SAS URL (read and list) of the upload container, transcribed as one job when it holds only this batch')
+parser.add_argument('--webhook-url', default=None, help='Speech backends: public URL forwarded to --webhook-port, to be notified of completed jobs instead of polling')
+parser.add_argument('--webhook-port', type=int, default=8765, help='Local port of the web hook receiver')
+parser.add_argument('--transcript-format', default='jsonl', choices=TRANSCRIPT_FORMATS + ('none',), 
+                    help='Format of the structured transcript saved per file (segments, words, speakers)')
+parser.add_argument('--dataset', default=None, help='.jsonl, .parquet or .arrow file the structured transcripts of all files are combined into')
+parser.add_argument('--usage-ledger', default=None, help='JSONL file the usage and estimated cost of each file is appended to (default is usage_ledger.jsonl in the cache folder)')
+parser.add_argument('--metrics-log', default=None, help='JSONL file each timed stage (decode, export, upload, poll, model call...) is appended to')
+parser.add_argument('--metrics-port', type=int, default=None, help='Port the stage metrics are served on at /metrics (Prometheus text format)')
+parser.add_argument('--metrics-file', default=None, help='File the stage metrics are written to at the end (Prometheus text format)')
+parser.add_argument('--backends', nargs='+', default=BACKENDS, choices=BACKENDS, help='auto: backends to choose from')
+parser.add_argument('--latency-sla', type=float, default=None, help='auto: seconds a file may take, backends expected to be slower are avoided')
+parser.add_argument('--cost-budget', type=float, default=None, help='auto: USD per audio hour, backends priced higher are avoided')
+parser.add_argument('--latency-cost', type=float, default=5.0, help='auto: USD one hour of waiting is worth, trades latency against cost')
+parser.add_argument('--locale', default=None, help='auto: locale of the audio, e.g. en-AU')
+parser.add_argument('--diarization', action='store_true', help='auto: only backends that can separate speakers')
+parser.add_argument('--word-timestamps', action='store_true', help='auto: only backends with word level timestamps')
+args = parser.parse_args()
+
+file_paths = list_audio_files(args.input)
+transcript_format = None if args.transcript_format == 'none' else args.transcript_format
+
+# Stage timings cost nothing unless one of the metrics outputs is requested
+metrics = None
+if args.metrics_log or args.metrics_port or args.metrics_file:
+    metrics = configure_metrics(json_log_path=args.metrics_log, prometheus_port=args.metrics_port)
+status_file_path = os.path.join(args.output, f'batch_status_{args.backend}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.jsonl')
+
+# Speech batch transcription takes up to 1000 files per job, so all files are submitted together
+batch_options = None
+webhook_receiver, webhook_id = None, None
+if args.backend in SPEECH_BACKEND_MODELS or args.backend == 'auto':
+    # A content container holds a fixed set of files, so it is not used when the router splits the batch between backends
+    batch_options = {'content_container_url': args.content_container_url if args.backend != 'auto' else None}
+    if args.webhook_url:
+        webhook_receiver = TranscriptionWebhookReceiver(port=args.webhook_port, secret=os.getenv('SPEECH_WEBHOOK_SECRET')).start()
+        webhook_response = register_transcription_webhook(SPEECH_API_URL, '2024-11-15', os.getenv("AZURE_AI_FOUNDRY_KEY"), args.webhook_url, 
+                                                          secret=os.getenv('SPEECH_WEBHOOK_SECRET'))
+        if webhook_response:
+            webhook_id = webhook_response['self'].split('/')[-1]
+            batch_options['webhook_receiver'] = webhook_receiver
+        else:
+            print('Web hook registration failed, polling for completion instead')
+
+if args.backend == 'auto':
+    transcriber = RoutingTranscriber(backends=tuple(args.backends), cache_dir=args.cache, locale=args.locale, latency_sla_seconds=args.latency_sla,
+                                     cost_budget_per_hour=args.cost_budget, latency_cost_per_hour=args.latency_cost,
+                                     require_diarization=args.diarization, require_word_timestamps=args.word_timestamps,
+                                     transcriber_options={'batch_options': batch_options, 'transcript_format': transcript_format})
+else:
+    transcriber = create_transcriber(args.backend, cache_dir=args.cache, batch_options=batch_options, transcript_format=transcript_format)
+
+try:
+    run_transcription_pipeline(transcriber, file_paths, args.output, max_workers=args.workers, status_file_path=status_file_path, 
+                               dataset_path=args.dataset, usage_ledger_path=args.usage_ledger or os.path.join(args.cache, 'usage_ledger.jsonl'))
+finally:
+    if metrics and args.metrics_file:
+        metrics.write_prometheus(args.metrics_file)
+        print(f'Metrics saved to {args.metrics_file}')
+    if webhook_id:
+        delete_webhook(SPEECH_API_URL, '2024-11-15', webhook_id, os.getenv("AZURE_AI_FOUNDRY_KEY"))
+    if webhook_receiver:
+        webhook_receiver.stop()
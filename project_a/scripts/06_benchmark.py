@@ -0,0 +1,190 @@
+# Offline benchmark of the transcription pipelines against local stand-ins for Azure OpenAI, Azure AI Speech and Blob Storage (mock_services.py).
+# Synthetic audio files of several lengths are transcribed with each backend, every backend in its own process so its peak memory can be measured.
+# Reports files and audio hours per hour, p50 / p95 latency per file, peak RSS, the estimated cost at list prices (see accounting.py),
+# the time spent per stage (see metrics.py) and the requests each pipeline made, without using any quota.
+#
+# Examples:
+#   python 06_benchmark.py
+#   python 06_benchmark.py --backends whisper 4o_audio --lengths 30 120 600 --files-per-length 4 --throttle-rate 0.05 --failure-rate 0.02
+#   python 06_benchmark.py --output ../benchmarks/baseline.json   (results as JSON, e.g. to compare runs)
+
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import tempfile
+import contextlib
+import multiprocessing
+from datetime import datetime
+
+from pydub import AudioSegment
+from pydub.generators import Sine
+
+from accounting import make_usage_record, percentile
+from metrics import configure_metrics
+from mock_services import SERVICES, MockAzureServices, get_mock_environment
+from transcribers import BACKENDS, SPEECH_BACKEND_MODELS, create_transcriber
+
+try:
+    import resource
+except ImportError:
+    resource = None # Not available on Windows, peak RSS is then not reported
+
+def generate_synthetic_audio(output_path, lengths, files_per_length=1, file_format='mp3'):
+    """
+    Generates audio files of tone bursts separated by short pauses, so splitting on silence finds split points as in speech.
+    :param lengths: Lengths of the files in seconds.
+    :return: List of (file path, length in seconds).
+    """
+    os.makedirs(output_path, exist_ok=True)
+    tone = Sine(440).to_audio_segment(duration=2000, volume=-20).set_frame_rate(16000).set_channels(1)
+    pause = AudioSegment.silent(duration=500, frame_rate=16000)
+    audio_files = []
+    for length in lengths:
+        file_path = os.path.join(output_path, f'synthetic_{length}s.{file_format}')
+        if not os.path.exists(file_path):
+            audio = (tone + pause) * math.ceil(length / 2.5)
+            audio[:length * 1000].export(file_path, format=file_format)
+        for _c in range(files_per_length):
+            copy_path = os.path.join(output_path, f'synthetic_{length}s_{_c}.{file_format}')
+            if not os.path.exists(copy_path):
+                with open(file_path, 'rb') as source, open(copy_path, 'wb') as copy:
+                    copy.write(source.read())
+            audio_files.append((copy_path, length))
+
+    return audio_files
+
+def get_peak_rss_mb():
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KB elsewhere
+    return round(peak_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def run_backend(backend, file_paths, output_path, cache_dir, environment, workers, transcriber_options, quiet):
+    """
+    Transcribes the files with one backend, run in a child process.
+    :return: Dict with the wall time, the status of each file, the stage metrics and the peak RSS of the process.
+    """
+    os.environ.update(environment)
+    metrics = configure_metrics()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull if quiet else sys.stdout):
+        transcriber = create_transcriber(backend, cache_dir=cache_dir, **transcriber_options)
+        start_time = time.time()
+        file_statuses = transcriber.transcribe_files(file_paths, output_path, max_workers=workers)
+        wall_seconds = time.time() - start_time
+
+    return {'wall_seconds': wall_seconds, 'file_statuses': file_statuses, 'stages': metrics.summary()['stages'], 'peak_rss_mb': get_peak_rss_mb()}
+
+def summarize_run(backend, run_result, audio_seconds_by_file, request_stats):
+    """
+    :return: Dict of the benchmark metrics of one backend.
+    """
+    file_statuses = run_result['file_statuses']
+    succeeded = [file_status for file_status in file_statuses if file_status['status'] == 'succeeded']
+    # A file of a Speech batch job waits for its whole job, its seconds are only its audio's share of the job time
+    latencies = [(file_status.get('usage') or {}).get('job_seconds', file_status['seconds']) for file_status in succeeded]
+    latencies = [latency for latency in latencies if latency is not None]
+    audio_seconds = sum(audio_seconds_by_file[file_status['file_path']] for file_status in succeeded)
+    wall_seconds = run_result['wall_seconds']
+    cost = sum(make_usage_record(file_status, backend)['cost_usd'] or 0 for file_status in file_statuses)
+
+    return {'backend': backend,
+            'files': len(file_statuses),
+            'succeeded': len(succeeded),
+            'wall_seconds': round(wall_seconds, 2),
+            'files_per_hour': round(len(succeeded) / wall_seconds * 3600, 1) if wall_seconds else None,
+            'audio_hours_per_hour': round(audio_seconds / wall_seconds, 2) if wall_seconds else None,
+            'p50_seconds': percentile(latencies, 50),
+            'p95_seconds': percentile(latencies, 95),
+            'peak_rss_mb': run_result['peak_rss_mb'],
+            'cost_usd': round(cost, 4),
+            'cost_per_audio_hour': round(cost / audio_seconds * 3600, 3) if audio_seconds else None,
+            'requests': sum(counter['requests'] for counter in request_stats.values()),
+            'throttled': sum(counter['throttled'] for counter in request_stats.values()),
+            'failed_requests': sum(counter['failed'] for counter in request_stats.values()),
+            'request_stats': request_stats,
+            'stages': run_result['stages'],
+            'errors': sorted({file_status['error'] for file_status in file_statuses if file_status['error']})}
+
+def print_summary(results):
+    columns = [('backend', 15), ('files', 6), ('succeeded', 10), ('wall_seconds', 13), ('files_per_hour', 15), ('audio_hours_per_hour', 21),
+               ('p50_seconds', 12), ('p95_seconds', 12), ('peak_rss_mb', 12), ('cost_usd', 9), ('cost_per_audio_hour', 20), ('requests', 9), 
+               ('throttled', 10), ('failed_requests', 16)]
+    print(''.join(name.ljust(width) for name, width in columns))
+    for result in results:
+        print(''.join(str(result[name] if result[name] is not None else '-').ljust(width) for name, width in columns))
+
+    for result in results:
+        print(f'\n{result["backend"]} requests: ' + ', '.join(f'{operation}: {counter["requests"]} ({counter["throttled"]} throttled, {counter["failed"]} failed)'
+                                                             for operation, counter in result['request_stats'].items()))
+        print(f'{result["backend"]} stages: ' + ', '.join(f'{name}: {stage["count"]} in {stage["seconds"]:.2f}s'
+                                                           for name, stage in sorted(result['stages'].items(), key=lambda item: -item[1]['seconds'])))
+        for error in result['errors']:
+            print(f'{result["backend"]} error: {error}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the transcription pipelines against local mock Azure services.')
+    parser.add_argument('--backends', nargs='+', default=BACKENDS, choices=BACKENDS)
+    parser.add_argument('--lengths', nargs='+', type=int, default=[15, 60, 300], help='Lengths of the synthetic audio files in seconds')
+    parser.add_argument('--files-per-length', type=int, default=2, help='Number of files of each length')
+    parser.add_argument('--format', default='mp3', choices=['mp3', 'wav'], help='Format of the synthetic audio files')
+    parser.add_argument('--workers', type=int, default=4, help='Number of files transcribed at the same time')
+    parser.add_argument('--latency', type=float, default=0.2, help='Seconds added to every mock request')
+    parser.add_argument('--latency-per-mb', type=float, default=0.5, help='Seconds added per MB sent to a mock service')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Share of mock requests answered with 429')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Share of mock requests answered with 500')
+    parser.add_argument('--mock-rpm', type=int, default=None, help='Requests per minute per mock service before it answers with 429')
+    parser.add_argument('--rpm', type=int, default=6000, help='Requests per minute the Azure OpenAI clients allow themselves')
+    parser.add_argument('--tpm', type=int, default=10_000_000, help='Tokens per minute the Azure OpenAI clients allow themselves')
+    parser.add_argument('--queue-seconds', type=float, default=5, help='Seconds a mock Speech job stays NotStarted')
+    parser.add_argument('--run-seconds', type=float, default=5, help='Seconds a mock Speech job stays Running')
+    parser.add_argument('--audio-dir', default=None, help='Folder for the synthetic audio, kept between runs (default is a temporary folder)')
+    parser.add_argument('--output', default=None, help='JSON file the results are saved to')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the pipelines')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='transcription_benchmark_')
+    audio_files = generate_synthetic_audio(args.audio_dir or os.path.join(work_dir, 'audio'), args.lengths, args.files_per_length, args.format)
+    audio_seconds_by_file = dict(audio_files)
+    file_paths = [file_path for file_path, _ in audio_files]
+    print(f'{len(file_paths)} synthetic audio files, {sum(args.lengths) * args.files_per_length / 60:.1f} minutes of audio')
+
+    service_config = {'latency': args.latency, 'latency_per_mb': args.latency_per_mb, 'throttle_rate': args.throttle_rate,
+                      'failure_rate': args.failure_rate, 'requests_per_minute': args.mock_rpm}
+    mock_services = MockAzureServices(config={**{service: service_config for service in SERVICES},
+                                              'speech_job': {'queue_seconds': args.queue_seconds, 'run_seconds': args.run_seconds}}).start()
+
+    # A new process per backend, so peak RSS is per pipeline and the mock servers do not share its interpreter
+    process_context = multiprocessing.get_context('spawn')
+    results = []
+    try:
+        for backend in args.backends:
+            if backend in SPEECH_BACKEND_MODELS:
+                transcriber_options = {'api_url': mock_services.url, 'batch_options': {'poll_interval': 1}}
+            else:
+                transcriber_options = {'requests_per_minute': args.rpm, 'tokens_per_minute': args.tpm}
+
+            output_path = os.path.join(work_dir, 'transcripts', backend)
+            os.makedirs(output_path, exist_ok=True)
+            # Blobs uploaded by the previous backend would be skipped as unchanged
+            mock_services.reset(clear_storage=True)
+            print(f'Benchmarking {backend}...')
+            with process_context.Pool(1) as pool:
+                # A new cache folder per backend, so every file is sent to the mock services
+                run_result = pool.apply(run_backend, (backend, file_paths, output_path, os.path.join(work_dir, 'cache', backend),
+                                                      get_mock_environment(mock_services.url), args.workers, transcriber_options, not args.verbose))
+            results.append(summarize_run(backend, run_result, audio_seconds_by_file, mock_services.stats()))
+    finally:
+        mock_services.stop()
+
+    print()
+    print_summary(results)
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        with open(args.output, 'w') as file:
+            json.dump({'created': datetime.now().isoformat(timespec='seconds'), 'settings': vars(args), 'results': results}, file, indent=4)
+        print(f'\nResults saved to {args.output}')
@@ -0,0 +1,44 @@
+# Report of the usage ledger written by the transcription scripts (see accounting.py): audio hours, real-time factor, tokens,
+# estimated cost, cost per audio hour and audio hours per dollar per backend and deployment, and the throughput of recent runs.
+# Group by the settings of a backend to compare them, e.g. chunk_length and max_concurrency for 4o_audio or workers for a batch.
+#
+# Examples:
+#   python 07_usage_report.py
+#   python 07_usage_report.py --by backend chunk_length max_concurrency --since 2025-01-01
+#   python 07_usage_report.py --backend 4o_audio --runs 20 --output ../usage_report.json
+
+import os
+import json
+import argparse
+
+from accounting import DEFAULT_LEDGER_PATH, read_usage_ledger, summarize_usage, print_table
+
+parser = argparse.ArgumentParser(description='Summarize the transcription usage ledger.')
+parser.add_argument('--ledger', default=DEFAULT_LEDGER_PATH, help='Usage ledger JSONL file')
+parser.add_argument('--by', nargs='+', default=['backend', 'deployment'], help='Record fields the files are grouped by, e.g. backend chunk_length workers')
+parser.add_argument('--since', default=None, help='Only records from this ISO date or time on, e.g. 2025-01-31')
+parser.add_argument('--backend', default=None, help='Only records of this backend')
+parser.add_argument('--runs', type=int, default=10, help='Number of recent runs listed')
+parser.add_argument('--output', default=None, help='JSON file the summary is saved to')
+args = parser.parse_args()
+
+if not os.path.exists(args.ledger):
+    raise SystemExit(f'No usage ledger at {args.ledger}, run a transcription first')
+
+records = [record for record in read_usage_ledger(args.ledger, since=args.since) if not args.backend or record['backend'] == args.backend]
+summary = summarize_usage(records, group_by=tuple(args.by))
+runs = [record for record in records if record['type'] == 'run'][-args.runs:] if args.runs else []
+
+print(f'Files by {", ".join(args.by)} (real-time factor, cost per audio hour and audio hours per dollar exclude cached files):')
+summary_columns = ['files', 'failed', 'cached', 'audio_hours', 'rtf', 'rtf_p50', 'rtf_p95', 'requests', 'prompt_tokens', 'audio_tokens', 
+                   'completion_tokens', 'cost_usd', 'cost_per_audio_hour', 'audio_hours_per_dollar']
+print_table(summary, list(args.by) + [column for column in summary_columns if column not in args.by])
+
+print(f'\nLast {len(runs)} run(s):')
+print_table(runs, ['run_id', 'backend', 'files', 'succeeded', 'cached', 'audio_seconds', 'wall_seconds', 'audio_hours_per_hour', 'workers', 'cost_usd'])
+
+if args.output:
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as file:
+        json.dump({'group_by': args.by, 'summary': summary, 'runs': runs}, file, indent=4)
+    print(f'\nSummary saved to {args.output}')
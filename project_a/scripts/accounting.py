@@ -0,0 +1,193 @@
+# Throughput and cost accounting per backend and deployment.
+# Each transcribed file is appended to a local JSONL ledger with its audio duration, wall time, real-time factor (wall seconds per
+# audio second, below 1 is faster than real time), the requests and tokens it used and its estimated cost. Each run is recorded too,
+# with its wall time, so audio hours per wall-clock hour can be compared across backends, deployments, chunk sizes and concurrency.
+# The backends fill the usage of a file (see transcribe_files_concurrently in utils.py), 07_usage_report.py summarizes the ledger.
+# Files of a Speech batch job have no wall time of their own: their seconds are their audio's share of the job's time and their record
+# keeps the job's submission_id and job_seconds, so the real-time factor of a file is the job's and a summary counts each job once.
+
+import os
+import json
+import math
+import threading
+import uuid
+from datetime import datetime
+
+DEFAULT_LEDGER_PATH = '../cache/usage_ledger.jsonl'
+
+# Approximate list prices in USD, update for your region and agreement (BACKEND_PROFILES in transcribers.py has the estimates used for routing)
+# Whisper and Speech batch transcription are billed per audio hour, gpt-4o-audio per million tokens of each kind
+PRICES = {
+    'whisper': {'per_audio_hour': 0.36},
+    '4o_audio': {'audio_input_per_million': 40.0, 'text_input_per_million': 2.5, 'text_output_per_million': 10.0},
+    'whisper_speech': {'per_audio_hour': 0.18},
+    'base_speech': {'per_audio_hour': 0.18},
+}
+
+# Usage counts added up per group in the report
+SUMMED_USAGE = ('requests', 'prompt_tokens', 'completion_tokens', 'audio_tokens', 'billed_audio_seconds')
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile, None for no values.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+def estimate_cost(backend, usage, prices=PRICES):
+    """
+    :param usage: Usage of one file (billed_audio_seconds, or prompt_tokens, audio_tokens and completion_tokens).
+    :return: Estimated cost in USD, None for a backend without a price.
+    """
+    price = prices.get(backend)
+    if price is None:
+        return None
+    if 'per_audio_hour' in price:
+        return (usage.get('billed_audio_seconds') or 0) / 3600 * price['per_audio_hour']
+
+    audio_tokens = usage.get('audio_tokens') or 0
+    text_tokens = (usage.get('prompt_tokens') or 0) - audio_tokens
+    return (audio_tokens * price['audio_input_per_million'] + text_tokens * price['text_input_per_million']
+            + (usage.get('completion_tokens') or 0) * price['text_output_per_million']) / 1_000_000
+
+def make_usage_record(file_status, backend, prices=PRICES):
+    """
+    Builds the ledger record of one file from its status dict (file_path, status, seconds, usage).
+    :return: Dict with the backend, deployment, audio and wall seconds, real-time factor, usage counts and estimated cost.
+    """
+    usage = file_status.get('usage') or {}
+    audio_seconds = usage.get('audio_seconds')
+    wall_seconds = file_status.get('seconds')
+    if usage.get('job_seconds') is not None:
+        # Batch file, its share of the job's time would only repeat the job's real-time factor with rounding errors
+        wall_seconds, audio_seconds = usage['job_seconds'], usage.get('job_audio_seconds')
+    cost = estimate_cost(backend, usage, prices)
+
+    return {'type': 'file',
+            'file_path': file_status['file_path'],
+            'status': file_status['status'],
+            'backend': backend,
+            **usage,
+            'deployment': usage.get('deployment'),
+            'cached': bool(usage.get('cached')),
+            'wall_seconds': file_status.get('seconds'),
+            'batch_job': usage.get('submission_id') if usage.get('job_seconds') is not None else None,
+            'rtf': round(wall_seconds / audio_seconds, 4) if audio_seconds and wall_seconds is not None else None,
+            'cost_usd': round(cost, 6) if cost is not None else None}
+
+class UsageLedger:
+    """
+    Appends file and run records to a JSONL file, one line per record, shared by runs so the report can compare them.
+    """
+
+    def __init__(self, ledger_path=DEFAULT_LEDGER_PATH, prices=PRICES):
+        self.ledger_path = ledger_path
+        self.prices = prices
+        self.run_id = datetime.now().strftime('%Y%m%d_%H%M%S_') + uuid.uuid4().hex[:6]
+        self._lock = threading.Lock()
+
+    def _append(self, records):
+        created = datetime.now().isoformat(timespec='seconds')
+        with self._lock:
+            os.makedirs(os.path.dirname(self.ledger_path) or '.', exist_ok=True)
+            with open(self.ledger_path, 'a') as file:
+                for record in records:
+                    file.write(json.dumps({'time': created, 'run_id': self.run_id, **record}) + '\n')
+
+    def record_run(self, backend, file_statuses, wall_seconds, **settings):
+        """
+        Records the files of a run and the run itself.
+        :param backend: Backend of the transcriber, files routed by RoutingTranscriber are recorded with their own backend.
+        :param wall_seconds: Wall time of the whole run.
+        :param settings: Run settings recorded with every record, e.g. workers.
+        :return: The run record.
+        """
+        file_records = [{**make_usage_record(file_status, file_status.get('backend', backend), self.prices), **settings} for file_status in file_statuses]
+        succeeded = [record for record in file_records if record['status'] == 'succeeded']
+        audio_seconds = sum(record.get('audio_seconds') or 0 for record in succeeded)
+        cost = sum(record['cost_usd'] or 0 for record in file_records)
+
+        run_record = {'type': 'run', 'backend': backend, 'files': len(file_records), 'succeeded': len(succeeded),
+                      'cached': sum(record['cached'] for record in succeeded), 'audio_seconds': round(audio_seconds, 2),
+                      'wall_seconds': round(wall_seconds, 2), 'audio_hours_per_hour': round(audio_seconds / wall_seconds, 3) if wall_seconds else None,
+                      'cost_usd': round(cost, 6), **settings}
+        self._append(file_records + [run_record])
+        return run_record
+
+def read_usage_ledger(ledger_path=DEFAULT_LEDGER_PATH, since=None):
+    """
+    :param since: ISO date or time, earlier records are skipped (optional).
+    :return: List of the ledger records.
+    """
+    with open(ledger_path, 'r') as file:
+        records = [json.loads(line) for line in file if line.strip()]
+    return [record for record in records if not since or record['time'] >= since]
+
+def sum_wall_seconds(records):
+    """
+    Wall time of file records, counting the time of each batch job once instead of once per file.
+    """
+    job_seconds = {(record.get('run_id'), record['batch_job']): record['job_seconds'] for record in records if record.get('batch_job') is not None}
+    return sum(record['wall_seconds'] or 0 for record in records if record.get('batch_job') is None) + sum(job_seconds.values())
+
+def summarize_usage(records, group_by=('backend', 'deployment')):
+    """
+    Aggregates file records per group. Real-time factor, cost per audio hour and audio hours per dollar only count files that
+    were sent to the service, files answered from the cache took no service time and cost nothing. The files of a batch job
+    count the job's time once.
+    :param group_by: Record fields the files are grouped by, e.g. ('backend', 'chunk_length').
+    :return: List of summary dicts sorted by group.
+    """
+    groups = {}
+    for record in records:
+        if record.get('type') == 'file':
+            groups.setdefault(tuple(record.get(field) for field in group_by), []).append(record)
+
+    summaries = []
+    for group, group_records in sorted(groups.items(), key=lambda item: [str(value) for value in item[0]]):
+        succeeded = [record for record in group_records if record['status'] == 'succeeded']
+        processed = [record for record in succeeded if not record['cached'] and record.get('audio_seconds')]
+        processed_audio_seconds = sum(record['audio_seconds'] for record in processed)
+        cost = sum(record.get('cost_usd') or 0 for record in group_records)
+        rtfs = [record['rtf'] for record in processed if record.get('rtf') is not None]
+
+        summaries.append({'files': len(group_records),
+                          'failed': len(group_records) - len(succeeded),
+                          'cached': sum(record['cached'] for record in succeeded),
+                          'audio_hours': round(sum(record.get('audio_seconds') or 0 for record in succeeded) / 3600, 3),
+                          'rtf': round(sum_wall_seconds(processed) / processed_audio_seconds, 4) if processed_audio_seconds else None,
+                          'rtf_p50': percentile(rtfs, 50),
+                          'rtf_p95': percentile(rtfs, 95),
+                          **{field: sum(record.get(field) or 0 for record in group_records) for field in SUMMED_USAGE},
+                          'cost_usd': round(cost, 4),
+                          'cost_per_audio_hour': round(cost / (processed_audio_seconds / 3600), 4) if processed_audio_seconds and cost else None,
+                          'audio_hours_per_dollar': round(processed_audio_seconds / 3600 / cost, 2) if cost else None,
+                          **dict(zip(group_by, group))})
+
+    return summaries
+
+def print_table(rows, columns):
+    """
+    Prints dicts as a table with the given columns, each as wide as its longest value.
+    """
+    cells = [[str(row.get(column) if row.get(column) is not None else '-') for column in columns] for row in rows]
+    widths = [max([len(column)] + [len(row[_c]) for row in cells]) + 2 for _c, column in enumerate(columns)]
+    print(''.join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in cells:
+        print(''.join(cell.ljust(width) for cell, width in zip(row, widths)))
+
+def print_usage_summary(file_statuses, backend, prices=PRICES):
+    """
+    Prints the audio duration, real-time factor, tokens and estimated cost of the files of a run.
+    """
+    summary = summarize_usage([make_usage_record(file_status, file_status.get('backend', backend), prices) for file_status in file_statuses],
+                              group_by=('backend',))
+    for backend_summary in summary:
+        tokens = f', tokens: {backend_summary["prompt_tokens"]} prompt ({backend_summary["audio_tokens"]} audio), ' \
+                 f'{backend_summary["completion_tokens"]} completion' if backend_summary['prompt_tokens'] else ''
+        cost_per_audio_hour = f' (${backend_summary["cost_per_audio_hour"]:.2f} per audio hour)' if backend_summary['cost_per_audio_hour'] else ''
+        print(f'Usage {backend_summary["backend"]}: audio: {backend_summary["audio_hours"] * 60:.1f} minutes, '
+              f'real-time factor: {backend_summary["rtf"] if backend_summary["rtf"] is not None else "-"}{tokens}, '
+              f'estimated cost: ${backend_summary["cost_usd"]:.4f}{cost_per_audio_hour}')
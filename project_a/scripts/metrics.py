@@ -0,0 +1,260 @@
+# Lightweight timing and counters for the transcription pipeline stages (decode, export, upload, submission, polling, model calls).
+# Stages are timed with spans:
+#
+#   with metrics.span('export_chunk', audio_seconds=len(chunk) / 1000) as span:
+#       ...
+#       span.set(bytes=len(chunk_data))
+#
+# and events such as retries and throttled requests are counted with metrics.increment('throttles', service='openai').
+# Metrics are disabled by default: span() then returns a shared no-op span and increment() returns at once, so the
+# instrumentation costs a function call. configure_metrics enables them, with each span written as a JSON line to a log file
+# and the totals exposed in the Prometheus text format (also read by the OpenTelemetry Collector's Prometheus receiver).
+
+import os
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Span attributes added up per stage, other attributes only go to the JSON log
+SUMMED_ATTRIBUTES = ('bytes', 'audio_seconds')
+
+# Upper bounds of the stage duration histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+class Span:
+    """
+    Times one stage from __enter__ to __exit__. Attributes can be added while it runs with set.
+    """
+    __slots__ = ('metrics', 'name', 'attributes', 'start_time')
+
+    def __init__(self, metrics, name, attributes):
+        self.metrics = metrics
+        self.name = name
+        self.attributes = attributes
+        self.start_time = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, time.perf_counter() - self.start_time, error=exc_type.__name__ if exc_type else None, **self.attributes)
+        return False
+
+class _NoopSpan:
+    """
+    Span returned while metrics are disabled.
+    """
+    __slots__ = ()
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NOOP_SPAN = _NoopSpan()
+
+def _labels(labels):
+    """
+    Formats (name, value) pairs as Prometheus labels, escaping backslashes, quotes and newlines in the values.
+    """
+    escaped = ['{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in labels]
+    return '{' + ','.join(escaped) + '}' if escaped else ''
+
+class Metrics:
+    """
+    Collects stage timings (count, errors, duration histogram, bytes and audio seconds per stage) and labelled counters.
+    """
+
+    def __init__(self, enabled=False, json_log_path=None, buckets=DEFAULT_BUCKETS, prefix='transcription'):
+        self.enabled = enabled
+        self.buckets = buckets
+        self.prefix = prefix
+        self.stages = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._json_log = None
+        self._server = None
+        if json_log_path:
+            self.open_json_log(json_log_path)
+
+    def open_json_log(self, json_log_path):
+        with self._lock:
+            if self._json_log:
+                self._json_log.close()
+            self._json_log = open(json_log_path, 'a', buffering=1)
+
+    def span(self, name, **attributes):
+        """
+        :return: Context manager timing the stage name, a no-op when metrics are disabled.
+        """
+        if not self.enabled:
+            return _NOOP_SPAN
+        return Span(self, name, attributes)
+
+    def observe(self, name, seconds, error=None, **attributes):
+        """
+        Records a stage duration measured elsewhere, e.g. the time a Speech job spent queued.
+        """
+        if not self.enabled:
+            return
+
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = {'count': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'buckets': [0] * len(self.buckets),
+                                             **{attribute: 0 for attribute in SUMMED_ATTRIBUTES}}
+            stage['count'] += 1
+            stage['errors'] += error is not None
+            stage['seconds'] += seconds
+            stage['max_seconds'] = max(stage['max_seconds'], seconds)
+            for _b, upper_bound in enumerate(self.buckets):
+                if seconds <= upper_bound:
+                    stage['buckets'][_b] += 1
+                    break
+            for attribute in SUMMED_ATTRIBUTES:
+                if attributes.get(attribute):
+                    stage[attribute] += attributes[attribute]
+
+            if self._json_log:
+                self._json_log.write(json.dumps({'time': round(time.time(), 3), 'span': name, 'seconds': round(seconds, 6), 'error': error,
+                                                 **attributes}, default=str) + '\n')
+
+    def increment(self, name, value=1, **labels):
+        """
+        Adds value to the counter name with the given labels, e.g. increment('retries', service='speech').
+        """
+        if not self.enabled:
+            return
+
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+            self.counters = {}
+
+    def summary(self):
+        """
+        :return: Dict with the totals per stage and the counters.
+        """
+        with self._lock:
+            return {'stages': {name: {key: value for key, value in stage.items() if key != 'buckets'} for name, stage in self.stages.items()},
+                    'counters': [{'name': name, **dict(labels), 'value': value} for (name, labels), value in self.counters.items()]}
+
+    def print_stats(self):
+        summary = self.summary()
+        for name, stage in sorted(summary['stages'].items(), key=lambda item: -item[1]['seconds']):
+            extras = ''.join(f', {attribute}: {stage[attribute]:.1f}' for attribute in SUMMED_ATTRIBUTES if stage[attribute])
+            print(f'Stage {name}: count: {stage["count"]}, errors: {stage["errors"]}, seconds: {stage["seconds"]:.2f}, '
+                  f'mean: {stage["seconds"] / stage["count"]:.3f}, max: {stage["max_seconds"]:.3f}{extras}')
+        for counter in summary['counters']:
+            labels = ', '.join(f'{key}={value}' for key, value in counter.items() if key not in ('name', 'value'))
+            print(f'Counter {counter["name"]}{" (" + labels + ")" if labels else ""}: {counter["value"]}')
+
+    # Prometheus text exposition format
+    def to_prometheus(self):
+        """
+        :return: The stage histograms and counters in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            stages = sorted((name, {**stage, 'buckets': list(stage['buckets'])}) for name, stage in self.stages.items())
+            counters = sorted(self.counters.items())
+
+        stage_metric = f'{self.prefix}_stage_seconds'
+        lines += [f'# HELP {stage_metric} Time spent per pipeline stage.', f'# TYPE {stage_metric} histogram']
+        for name, stage in stages:
+            cumulative_count = 0
+            for upper_bound, bucket_count in zip(self.buckets, stage['buckets']):
+                cumulative_count += bucket_count
+                lines.append(f'{stage_metric}_bucket{_labels([("stage", name), ("le", upper_bound)])} {cumulative_count}')
+            lines.append(f'{stage_metric}_bucket{_labels([("stage", name), ("le", "+Inf")])} {stage["count"]}')
+            lines.append(f'{stage_metric}_sum{_labels([("stage", name)])} {stage["seconds"]}')
+            lines.append(f'{stage_metric}_count{_labels([("stage", name)])} {stage["count"]}')
+
+        for total, help_text in (('errors', 'Stage runs that raised an error.'), ('bytes', 'Bytes processed per pipeline stage.'),
+                                 ('audio_seconds', 'Seconds of audio processed per pipeline stage.')):
+            metric = f'{self.prefix}_stage_{total}_total'
+            lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} counter']
+            lines += [f'{metric}{_labels([("stage", name)])} {stage[total]}' for name, stage in stages]
+
+        counter_names = sorted({name for (name, _), _ in counters})
+        for counter_name in counter_names:
+            metric = f'{self.prefix}_{counter_name}_total'
+            lines.append(f'# TYPE {metric} counter')
+            lines += [f'{metric}{_labels(labels)} {value}' for (name, labels), value in counters if name == counter_name]
+
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, file_path):
+        """
+        Writes the metrics to a file, e.g. for the node_exporter textfile collector.
+        """
+        with open(file_path + '.tmp', 'w') as file:
+            file.write(self.to_prometheus())
+        os.replace(file_path + '.tmp', file_path)
+
+    def start_http_server(self, port=9464, host='0.0.0.0'):
+        """
+        Serves the metrics at http://<host>:<port>/metrics for Prometheus or an OpenTelemetry Collector to scrape.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = metrics.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        print(f'Metrics served at http://{host}:{port}/metrics')
+        return self
+
+    def close(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        with self._lock:
+            if self._json_log:
+                self._json_log.close()
+                self._json_log = None
+
+# Shared by the pipeline, disabled until configure_metrics is called
+metrics = Metrics()
+
+def configure_metrics(enabled=True, json_log_path=None, prometheus_port=None):
+    """
+    Enables (or disables) the shared metrics.
+    :param json_log_path: File each span is appended to as a JSON line (optional).
+    :param prometheus_port: Port the metrics are served on at /metrics (optional).
+    :return: The shared Metrics.
+    """
+    metrics.enabled = enabled
+    if json_log_path:
+        metrics.open_json_log(json_log_path)
+    if prometheus_port:
+        metrics.start_http_server(prometheus_port)
+    return metrics
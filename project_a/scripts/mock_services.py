@@ -0,0 +1,396 @@
+# Local stand-ins for the Azure services the pipelines call, to measure throughput without using real quota (see 06_benchmark.py).
+# One HTTP server answers:
+#   - Azure OpenAI audio transcriptions and chat completions: /openai/deployments/<deployment>/...
+#   - Azure AI Speech v3.2 batch transcription: /speechtotext/v3.2/... (models, transcriptions, their files and result files)
+#   - Azure Blob Storage block blobs, path style as in Azurite: /<account>/<container>/<blob> (put blob, put block, put block list, properties, list blobs)
+# Latency, throttling (429, or 503 for Blob Storage, with Retry-After) and failures (500) are configured per service, and requests are counted per operation.
+#
+# Example, a mock at http://127.0.0.1:18600 with the settings of 06_benchmark.py:
+#   python mock_services.py --port 18600 --latency 0.2 --throttle-rate 0.05
+
+import json
+import time
+import base64
+import random
+import hashlib
+import argparse
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+SERVICES = ('openai', 'speech', 'blob')
+
+DEFAULT_SERVICE_CONFIG = {
+    'latency': 0.1,         # Seconds added to every request
+    'latency_per_mb': 0.0,  # Seconds added per MB of request body, e.g. for upload bandwidth or audio processing
+    'throttle_rate': 0.0,   # Share of requests answered with 429 (503 for Blob Storage)
+    'failure_rate': 0.0,    # Share of requests answered with 500
+    'requests_per_minute': None, # Requests above this rate are answered with 429
+    'retry_after': 1,       # Retry-After of throttled requests, in seconds
+}
+
+DEFAULT_SPEECH_JOB_CONFIG = {
+    'queue_seconds': 5,     # Time a transcription job stays NotStarted
+    'run_seconds': 5,       # Time a transcription job stays Running
+}
+
+def estimate_audio_seconds(size_bytes, bitrate_kbps=128):
+    """
+    Estimates the duration of compressed audio from its size, for the timestamps of mock results.
+    """
+    return size_bytes * 8 / (bitrate_kbps * 1000)
+
+class MockAzureServices:
+    """
+    Threaded HTTP server standing in for Azure OpenAI, Azure AI Speech and Blob Storage.
+    config is a dict per service (see DEFAULT_SERVICE_CONFIG), plus 'speech_job' (see DEFAULT_SPEECH_JOB_CONFIG) and 'seed'.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, config=None):
+        config = config or {}
+        self.config = {service: {**DEFAULT_SERVICE_CONFIG, **config.get(service, {})} for service in SERVICES}
+        self.config['speech_job'] = {**DEFAULT_SPEECH_JOB_CONFIG, **config.get('speech_job', {})}
+        self.random = random.Random(config.get('seed', 0))
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self.blobs = {}          # /account/container/blob -> (data, content_md5)
+        self.staged_blocks = {}  # (/account/container/blob, block_id) -> data
+        self.transcriptions = {} # id -> transcription
+        self._request_times = {service: [] for service in SERVICES}
+        self.reset()
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}'
+
+    def reset(self, clear_storage=False):
+        """
+        Clears the request counters, e.g. between benchmark runs, and with clear_storage the stored blobs and transcriptions.
+        """
+        with self._lock:
+            self.counters = {}
+            if clear_storage:
+                self.blobs.clear()
+                self.staged_blocks.clear()
+                self.transcriptions.clear()
+
+    def stats(self):
+        """
+        :return: Dict per "<service> <operation>" of requests, throttled, failed and bytes_in.
+        """
+        with self._lock:
+            return {operation: dict(counter) for operation, counter in sorted(self.counters.items())}
+
+    def start(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                mock._handle(self)
+
+            def do_HEAD(self):
+                mock._handle(self)
+
+            def do_POST(self):
+                mock._handle(self)
+
+            def do_PUT(self):
+                mock._handle(self)
+
+            def do_DELETE(self):
+                mock._handle(self)
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        print(f'Mock Azure services listening on {self.url}')
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    # Request handling
+    def _route(self, method, path):
+        if path.startswith('/openai/'):
+            operation = 'transcriptions' if path.endswith('/audio/transcriptions') else 'chat' if path.endswith('/chat/completions') else 'other'
+            return 'openai', operation
+        if path.startswith('/speechtotext/'):
+            if '/models' in path:
+                return 'speech', 'models'
+            if path.rstrip('/').endswith('/transcriptions'):
+                return 'speech', 'submit' if method == 'POST' else 'list'
+            if path.endswith('/files'):
+                return 'speech', 'files'
+            return 'speech', 'status' if method == 'GET' else 'delete' if method == 'DELETE' else 'other'
+        if path.startswith('/speech-results/'):
+            return 'speech', 'download'
+        return 'blob', method.lower()
+
+    def _is_throttled(self, service):
+        service_config = self.config[service]
+        if self.random.random() < service_config['throttle_rate']:
+            return True
+        if not service_config['requests_per_minute']:
+            return False
+
+        now = time.time()
+        request_times = [request_time for request_time in self._request_times[service] if now - request_time < 60]
+        throttled = len(request_times) >= service_config['requests_per_minute']
+        if not throttled:
+            request_times.append(now)
+        self._request_times[service] = request_times
+        return throttled
+
+    def _handle(self, request):
+        parsed_url = urllib.parse.urlsplit(request.path)
+        path = parsed_url.path
+        query = urllib.parse.parse_qs(parsed_url.query)
+        body = request.rfile.read(int(request.headers.get('Content-Length') or 0))
+        service, operation = self._route(request.command, path)
+        service_config = self.config[service]
+
+        with self._lock:
+            counter = self.counters.setdefault(f'{service} {operation}', {'requests': 0, 'throttled': 0, 'failed': 0, 'bytes_in': 0})
+            counter['requests'] += 1
+            counter['bytes_in'] += len(body)
+            throttled = self._is_throttled(service)
+            failed = not throttled and self.random.random() < service_config['failure_rate']
+            counter['throttled'] += throttled
+            counter['failed'] += failed
+
+        time.sleep(service_config['latency'] + service_config['latency_per_mb'] * len(body) / (1024 * 1024))
+
+        # Blob Storage throttles with 503 ServerBusy, the other services with 429
+        if throttled and service == 'blob':
+            return self._send(request, 503, headers={'x-ms-error-code': 'ServerBusy', 'Retry-After': str(service_config['retry_after'])})
+        if throttled:
+            return self._send_json(request, 429, {'error': {'code': '429', 'message': 'Rate limit exceeded (mock)'}},
+                                   headers={'Retry-After': str(service_config['retry_after'])})
+        if failed:
+            return self._send_json(request, 500, {'error': {'code': 'InternalServerError', 'message': 'Injected failure (mock)'}})
+
+        try:
+            if service == 'openai':
+                return self._handle_openai(request, operation, body)
+            if service == 'speech':
+                return self._handle_speech(request, operation, path, body)
+            return self._handle_blob(request, path, query, body)
+        except Exception as e:
+            return self._send_json(request, 400, {'error': {'code': 'BadRequest', 'message': str(e)}})
+
+    def _send(self, request, status, body=b'', content_type='application/json', headers=None):
+        request.send_response(status)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            request.send_header(name, value)
+        request.end_headers()
+        if request.command != 'HEAD':
+            request.wfile.write(body)
+
+    def _send_json(self, request, status, data, headers=None):
+        self._send(request, status, json.dumps(data).encode(), headers=headers)
+
+    # Azure OpenAI
+    def _handle_openai(self, request, operation, body):
+        if operation == 'transcriptions':
+            duration = estimate_audio_seconds(len(body))
+            segments = [{'id': _s, 'seek': 0, 'start': float(start), 'end': float(min(start + 5, duration)), 'text': f' Mock segment {_s + 1}.',
+                         'tokens': [], 'temperature': 0.0, 'avg_logprob': -0.2, 'compression_ratio': 1.2, 'no_speech_prob': 0.01}
+                        for _s, start in enumerate(range(0, max(1, int(duration)), 5))]
+            return self._send_json(request, 200, {'task': 'transcribe', 'language': 'english', 'duration': duration,
+                                                  'text': ''.join(segment['text'] for segment in segments).strip(), 'segments': segments})
+
+        if operation == 'chat':
+            # Roughly 10 audio tokens per second of audio, plus the text of the messages
+            audio_tokens = int(estimate_audio_seconds(len(body) * 3 / 4) * 10)
+            prompt_tokens = audio_tokens + 50
+            return self._send_json(request, 200, {'id': f'chatcmpl-mock-{self.random.randrange(10 ** 9)}', 'object': 'chat.completion',
+                                                  'created': int(time.time()), 'model': 'gpt-4o-audio-preview',
+                                                  'choices': [{'index': 0, 'finish_reason': 'stop',
+                                                               'message': {'role': 'assistant', 'content': 'Mock transcript of the audio chunk.'}}],
+                                                  'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': 8, 'total_tokens': prompt_tokens + 8,
+                                                            'prompt_tokens_details': {'audio_tokens': audio_tokens, 'cached_tokens': 0}}})
+
+        return self._send_json(request, 404, {'error': {'code': 'NotFound', 'message': 'Unknown operation (mock)'}})
+
+    # Azure AI Speech
+    def _handle_speech(self, request, operation, path, body):
+        if operation == 'models':
+            models = [('Whisper Large V2', 'en-US'), ('Whisper Large V2', 'en-AU'), ('Batch Transcription', 'en-AU'), ('Batch Transcription', 'en-US')]
+            return self._send_json(request, 200, {'values': [{'self': f'{self.url}/speechtotext/v3.2/models/base/mock-{_m}',
+                                                              'displayName': f'20240614 {display_name}', 'locale': locale,
+                                                              'createdDateTime': '2024-06-14T00:00:00Z',
+                                                              'properties': {'features': {'supportsTranscriptions': True}}}
+                                                             for _m, (display_name, locale) in enumerate(models)]})
+
+        if operation == 'submit':
+            payload = json.loads(body)
+            content_urls = payload.get('contentUrls') or []
+            if payload.get('contentContainerUrl'):
+                container_url = payload['contentContainerUrl'].split('?')[0]
+                container_path = self._blob_key(container_url)
+                content_urls = [container_url + blob_key[len(container_path):] for blob_key in list(self.blobs) if blob_key.startswith(container_path + '/')]
+            with self._lock:
+                transcription_id = f'mock-{len(self.transcriptions)}'
+                self.transcriptions[transcription_id] = {'created': time.time(), 'content_urls': content_urls}
+            return self._send_json(request, 201, {'self': f'{self.url}/speechtotext/v3.2/transcriptions/{transcription_id}', 'status': 'NotStarted'})
+
+        transcription_id = path.split('/')[4] if operation in ('status', 'files', 'delete') else path.split('/')[2]
+        transcription = self.transcriptions.get(transcription_id)
+        if transcription is None:
+            return self._send_json(request, 404, {'error': {'code': 'NotFound', 'message': f'Transcription {transcription_id} not found (mock)'}})
+
+        if operation == 'status':
+            elapsed = time.time() - transcription['created']
+            job_config = self.config['speech_job']
+            status = 'NotStarted' if elapsed < job_config['queue_seconds'] else \
+                     'Running' if elapsed < job_config['queue_seconds'] + job_config['run_seconds'] else 'Succeeded'
+            return self._send_json(request, 200, {'self': f'{self.url}/speechtotext/v3.2/transcriptions/{transcription_id}', 'status': status})
+
+        if operation == 'files':
+            values = [{'kind': 'Transcription', 'name': f'contenturl_{_f}.json',
+                       'links': {'contentUrl': f'{self.url}/speech-results/{transcription_id}/{_f}'}}
+                      for _f in range(len(transcription['content_urls']))]
+            values.append({'kind': 'TranscriptionReport', 'name': 'report.json', 'links': {'contentUrl': f'{self.url}/speech-results/{transcription_id}/report'}})
+            return self._send_json(request, 200, {'values': values})
+
+        if operation == 'download':
+            result_index = path.split('/')[3]
+            if result_index == 'report':
+                return self._send_json(request, 200, {'successfulTranscriptionsCount': len(transcription['content_urls']), 'failedTranscriptionsCount': 0,
+                                                      'details': [{'source': content_url.split('?')[0], 'status': 'Succeeded'}
+                                                                  for content_url in transcription['content_urls']]})
+            content_url = transcription['content_urls'][int(result_index)]
+            return self._send_json(request, 200, self._speech_result(content_url))
+
+        return self._send_json(request, 204 if operation == 'delete' else 404, {})
+
+    def _speech_result(self, content_url):
+        blob = self.blobs.get(self._blob_key(content_url))
+        duration = estimate_audio_seconds(len(blob[0])) if blob else 30
+        ticks_per_second = 10_000_000
+        recognized_phrases = []
+        for _p, start in enumerate(range(0, max(1, int(duration)), 5)):
+            words = [{'displayText': word, 'offsetInTicks': int((start + _w) * ticks_per_second), 'durationInTicks': ticks_per_second // 2, 'confidence': 0.9}
+                     for _w, word in enumerate(['Mock', 'phrase', str(_p + 1) + '.'])]
+            recognized_phrases.append({'recognitionStatus': 'Success', 'channel': 0, 'speaker': _p % 2 + 1, 'offsetInTicks': start * ticks_per_second,
+                                       'durationInTicks': int(min(5, duration - start) * ticks_per_second),
+                                       'nBest': [{'confidence': 0.9, 'display': f'Mock phrase {_p + 1}.', 'displayWords': words}]})
+
+        return {'source': content_url.split('?')[0], 'durationInTicks': int(duration * ticks_per_second),
+                'combinedRecognizedPhrases': [{'channel': 0, 'display': ' '.join(phrase['nBest'][0]['display'] for phrase in recognized_phrases)}],
+                'recognizedPhrases': recognized_phrases}
+
+    # Azure Blob Storage
+    def _blob_key(self, url_or_path):
+        """
+        Maps a blob URL (https://<account>.blob.core.windows.net/<container>/<blob>) or a path style path (/<account>/<container>/<blob>) to the store key.
+        """
+        parsed_url = urllib.parse.urlsplit(url_or_path)
+        path = urllib.parse.unquote(parsed_url.path)
+        if parsed_url.hostname and '.blob.' in parsed_url.hostname:
+            return '/' + parsed_url.hostname.split('.')[0] + path
+        return path
+
+    def _handle_blob(self, request, path, query, body):
+        blob_key = self._blob_key(path)
+        blob_headers = {'ETag': f'"0x{hashlib.md5(blob_key.encode()).hexdigest()[:16]}"',
+                        'Last-Modified': time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime()),
+                        'x-ms-request-id': f'mock-{self.random.randrange(10 ** 9)}', 'x-ms-version': '2025-01-05'}
+
+        if request.command == 'GET' and query.get('comp', [None])[0] == 'list':
+            # List blobs of the container, in one page
+            container_key = blob_key.rstrip('/') + '/'
+            prefix = query.get('prefix', [''])[0]
+            blobs = sorted((key[len(container_key):], len(data)) for key, (data, _) in list(self.blobs.items()) if key.startswith(container_key + prefix))
+            blobs_xml = ''.join(f'<Blob><Name>{escape(blob_name)}</Name><Properties><Content-Length>{size}</Content-Length>'
+                                f'<BlobType>BlockBlob</BlobType></Properties></Blob>' for blob_name, size in blobs)
+            body = f'<?xml version="1.0" encoding="utf-8"?><EnumerationResults><Blobs>{blobs_xml}</Blobs><NextMarker /></EnumerationResults>'
+            return self._send(request, 200, body.encode(), content_type='application/xml', headers=blob_headers)
+
+        if request.command in ('HEAD', 'GET') and 'comp' not in query:
+            blob = self.blobs.get(blob_key)
+            if blob is None:
+                return self._send(request, 404, headers={**blob_headers, 'x-ms-error-code': 'BlobNotFound'})
+            data, content_md5 = blob
+            headers = {**blob_headers, 'x-ms-blob-type': 'BlockBlob'}
+            if content_md5:
+                headers['Content-MD5'] = content_md5
+            if request.command == 'HEAD':
+                # Content-Length of a HEAD response is the blob size
+                request.send_response(200)
+                for name, value in {**headers, 'Content-Length': str(len(data)), 'Content-Type': 'application/octet-stream'}.items():
+                    request.send_header(name, value)
+                request.end_headers()
+                return
+            return self._send(request, 200, data, content_type='application/octet-stream', headers=headers)
+
+        if request.command == 'PUT':
+            comp = query.get('comp', [None])[0]
+            if comp == 'block':
+                self.staged_blocks[(blob_key, query['blockid'][0])] = body
+            elif comp == 'blocklist':
+                block_ids = [element.text for element in ElementTree.fromstring(body)]
+                data = b''.join(self.staged_blocks.pop((blob_key, block_id)) for block_id in block_ids)
+                self.blobs[blob_key] = (data, request.headers.get('x-ms-blob-content-md5'))
+            elif comp is None:
+                self.blobs[blob_key] = (body, request.headers.get('x-ms-blob-content-md5') or base64.b64encode(hashlib.md5(body).digest()).decode())
+            return self._send(request, 201, headers={**blob_headers, 'x-ms-request-server-encrypted': 'true'})
+
+        if request.command == 'DELETE':
+            self.blobs.pop(blob_key, None)
+            return self._send(request, 202, headers=blob_headers)
+
+        return self._send(request, 400, headers={**blob_headers, 'x-ms-error-code': 'UnsupportedHttpVerb'})
+
+def get_mock_environment(mock_url, account_name='devstoreaccount1', container_name='audio'):
+    """
+    :return: Environment variables (see env_template.txt) pointing the pipelines at a MockAzureServices server.
+    """
+    return {'AZURE_OPENAI_ENDPOINT': mock_url + '/',
+            'AZURE_OPENAI_API_KEY': 'mock-key',
+            'AZURE_OPENAI_ENDPOINTS_CONFIG': '',
+            'AZURE_AI_FOUNDRY_KEY': 'mock-key',
+            'STORAGE_BLOB_SAS': f'{mock_url}/{account_name}?sv=2025-01-05&sig=mock',
+            'STORAGE_CONTAINER_NAME': container_name,
+            'STORAGE_NAME': account_name,
+            'STORAGE_KEY': base64.b64encode(b'mock-storage-account-key').decode()}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run local stand-ins for Azure OpenAI, Azure AI Speech and Blob Storage.')
+    parser.add_argument('--port', type=int, default=18600)
+    parser.add_argument('--latency', type=float, default=DEFAULT_SERVICE_CONFIG['latency'], help='Seconds added to every request')
+    parser.add_argument('--latency-per-mb', type=float, default=DEFAULT_SERVICE_CONFIG['latency_per_mb'], help='Seconds added per MB of request body')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Share of requests answered with 429')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Share of requests answered with 500')
+    parser.add_argument('--queue-seconds', type=float, default=DEFAULT_SPEECH_JOB_CONFIG['queue_seconds'], help='Seconds a Speech job stays NotStarted')
+    parser.add_argument('--run-seconds', type=float, default=DEFAULT_SPEECH_JOB_CONFIG['run_seconds'], help='Seconds a Speech job stays Running')
+    args = parser.parse_args()
+
+    service_config = {'latency': args.latency, 'latency_per_mb': args.latency_per_mb, 'throttle_rate': args.throttle_rate, 'failure_rate': args.failure_rate}
+    mock_services = MockAzureServices(port=args.port, config={**{service: service_config for service in SERVICES},
+                                                              'speech_job': {'queue_seconds': args.queue_seconds, 'run_seconds': args.run_seconds}}).start()
+    for name, value in get_mock_environment(mock_services.url).items():
+        print(f'{name}={value}')
+    try:
+        while True:
+            time.sleep(10)
+            print(json.dumps(mock_services.stats()))
+    except KeyboardInterrupt:
+        mock_services.stop()
@@ -0,0 +1,367 @@
+# Rate limiting, retries and routing of Azure OpenAI requests.
+# RequestScheduler keeps the requests to one deployment within its requests-per-minute and tokens-per-minute limits, retries
+# throttled and failed requests with backoff and adapts its concurrency to the quota. EndpointPool spreads requests across several
+# deployments serving the same model (see endpoints_template.json) and fails over between them. The Whisper and gpt-4o-audio
+# backends in utils.py send their requests through an EndpointPool built with load_endpoint_pool.
+
+import json
+import os
+import random
+import threading
+import time
+
+import requests
+from openai import AzureOpenAI, APIConnectionError
+
+from metrics import metrics
+
+def estimate_audio_chat_tokens(audio_duration_seconds, max_tokens=4096):  
+    """  
+    Estimates the tokens a gpt-4o-audio request counts against the deployment's tokens-per-minute limit.  
+    Azure OpenAI counts max_tokens towards the limit when the request is admitted, input audio is roughly 10 tokens per second.  
+    :param audio_duration_seconds: Duration of the audio sent in the request.  
+    :param max_tokens: max_tokens of the request (default is 4096).  
+    :return: Estimated number of tokens.  
+    """  
+    return int(audio_duration_seconds * 10) + max_tokens
+
+def get_retry_after_seconds(error):  
+    """  
+    Reads the Retry-After delay from the response attached to an API error.  
+    :param error: Exception raised by the openai or requests client.  
+    :return: Delay in seconds, or None if the response has no Retry-After header.  
+    """  
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        pass # Retry-After given as an HTTP date, fall back to backoff
+    return None
+
+def get_error_status_code(error):  
+    """  
+    Returns the HTTP status code of an API error raised by the openai or requests client, or None.  
+    """  
+    status_code = getattr(error, 'status_code', None)
+    if status_code is None:
+        status_code = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status_code
+
+def is_retryable_error(error):  
+    """  
+    Returns True for errors worth retrying: throttling (429), timeouts, server errors (5xx) and connection failures.  
+    """  
+    if isinstance(error, (APIConnectionError, requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    status_code = get_error_status_code(error)
+    return status_code is not None and (status_code in (408, 429) or status_code >= 500)
+
+class TokenBucket:  
+    """  
+    Token bucket refilled continuously at rate_per_minute, holding at most one minute of tokens.  
+    """  
+
+    def __init__(self, rate_per_minute):
+        self.capacity = rate_per_minute
+        self.tokens = rate_per_minute
+        self.rate_per_second = rate_per_minute / 60
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        """  
+        Blocks until amount tokens are available and takes them.  
+        """  
+        amount = min(amount, self.capacity) # A single request larger than the bucket waits for a full bucket
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_second)
+                self.updated_at = now
+
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait_seconds = (amount - self.tokens) / self.rate_per_second
+            time.sleep(wait_seconds)
+
+class RequestScheduler:  
+    """  
+    Schedules requests to one Azure OpenAI deployment within its requests-per-minute and tokens-per-minute limits.  
+    Throttled (429), timed out and server error (5xx) responses are retried with jittered exponential backoff, honouring Retry-After.
+    Concurrency is halved whenever the deployment throttles and grows back by one slot after as many successes
+    as there are slots, so it settles at the highest rate the quota sustains.  
+    """  
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, max_concurrency=8, max_retries=6, base_delay=1.0, max_delay=60.0):
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.concurrency_limit = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.in_flight = 0
+        self.successes_since_increase = 0
+        self.paused_until = 0 # Set from Retry-After so all threads back off together
+        self.requests = 0
+        self.throttles = 0
+        self.retries = 0
+        self._condition = threading.Condition()
+
+    def _acquire_slot(self):
+        with self._condition:
+            while self.in_flight >= self.concurrency_limit:
+                self._condition.wait()
+            self.in_flight += 1
+
+    def _release_slot(self, outcome):
+        """  
+        :param outcome: "success", "throttled" or "failed". Only successes grow the concurrency limit, so it does not grow while
+                        the deployment answers with errors or timeouts.  
+        """  
+        with self._condition:
+            self.in_flight -= 1
+            if outcome == 'throttled':
+                self.throttles += 1
+                metrics.increment('throttles', service='openai')
+                self.concurrency_limit = max(1, self.concurrency_limit // 2)
+                self.successes_since_increase = 0
+            elif outcome == 'success':
+                self.successes_since_increase += 1
+                if self.successes_since_increase >= self.concurrency_limit and self.concurrency_limit < self.max_concurrency:
+                    self.concurrency_limit += 1
+                    self.successes_since_increase = 0
+            self._condition.notify_all()
+
+    def _wait_until_unpaused(self):
+        while True:
+            with self._condition:
+                wait_seconds = self.paused_until - time.monotonic()
+            if wait_seconds <= 0:
+                return
+            time.sleep(wait_seconds)
+
+    def call(self, fn, *args, estimated_tokens=0, max_retries=None, **kwargs):
+        """  
+        Calls fn(*args, **kwargs) once the rate limits allow it, retrying retryable errors.  
+        :param fn: Function making the request, e.g. client.chat.completions.create.  
+        :param estimated_tokens: Tokens the request counts against the tokens-per-minute limit (see estimate_audio_chat_tokens).  
+        :param max_retries: Overrides the scheduler's max_retries for this call.  
+        :return: Return value of fn. The last error is raised when retries are exhausted or the error is not retryable.  
+        """  
+        max_retries = self.max_retries if max_retries is None else max_retries
+
+        for attempt in range(max_retries + 1):
+            with metrics.span('rate_limit_wait'):
+                self._wait_until_unpaused()
+                if self.request_bucket:
+                    self.request_bucket.acquire(1)
+                if self.token_bucket and estimated_tokens:
+                    self.token_bucket.acquire(estimated_tokens)
+
+                self._acquire_slot()
+            outcome = 'failed'
+            try:
+                with self._condition:
+                    self.requests += 1
+                result = fn(*args, **kwargs)
+                outcome = 'success'
+                return result
+            except Exception as e:
+                throttled = get_error_status_code(e) == 429
+                if throttled:
+                    outcome = 'throttled'
+                if not is_retryable_error(e):
+                    raise
+
+                # Full jitter backoff, Retry-After from the service takes precedence
+                delay = get_retry_after_seconds(e)
+                if delay is None:
+                    delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                if throttled:
+                    with self._condition:
+                        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+                if attempt == max_retries:
+                    raise
+                print(f'Request failed ({get_error_status_code(e) or type(e).__name__}), retrying in {delay:.1f} seconds (attempt {attempt + 1} of {max_retries})')
+                with self._condition:
+                    self.retries += 1
+                metrics.increment('retries', service='openai')
+            finally:
+                self._release_slot(outcome)
+
+            time.sleep(delay)
+
+    def print_stats(self):
+        print(f'Requests: {self.requests}, retries: {self.retries}, throttled: {self.throttles}, concurrency limit: {self.concurrency_limit}')
+
+# Multiple Azure OpenAI deployments
+class ClientEndpoint:  
+    """  
+    One Azure OpenAI deployment in an EndpointPool, with its own request scheduler, health and latency statistics.  
+    """  
+
+    def __init__(self, name, client, deployment, weight=1, scheduler=None):
+        self.name = name
+        self.client = client
+        self.deployment = deployment
+        self.weight = weight
+        self.scheduler = scheduler or RequestScheduler()
+
+        self.in_flight = 0
+        self.latency_ewma = None # Exponentially weighted moving average of successful request latency in seconds
+        self.cooldown_until = 0 # Endpoint is skipped until this time after throttling or errors
+        self.consecutive_failures = 0
+        self.requests = 0
+        self.failures = 0
+
+class EndpointPool:  
+    """  
+    Routes requests across several Azure OpenAI deployments (e.g. in different regions) serving the same model.  
+    Each request goes to the healthy endpoint with the lowest in-flight requests x latency / weight. An endpoint that throttles
+    or fails is put in cooldown (Retry-After or exponential backoff) and the request fails over to the next endpoint.  
+    With a single endpoint there is nothing to fail over to, its scheduler retries the request with backoff instead.  
+    """  
+
+    def __init__(self, endpoints, cooldown_seconds=5, max_cooldown_seconds=120, max_attempts=None):
+        if not endpoints:
+            raise ValueError('EndpointPool needs at least one endpoint')
+        self.endpoints = endpoints
+        # Requests the pool can have in flight, callers size their concurrency to this so every endpoint added adds throughput
+        self.max_concurrency = sum(endpoint.scheduler.max_concurrency for endpoint in endpoints)
+        self.cooldown_seconds = cooldown_seconds
+        self.max_cooldown_seconds = max_cooldown_seconds
+        # At least as many attempts as a single endpoint's scheduler would make
+        self.max_attempts = max_attempts or (1 if len(endpoints) == 1 else 
+                                             max(3 * len(endpoints), max(endpoint.scheduler.max_retries for endpoint in endpoints) + 1))
+        self._lock = threading.Lock()
+
+    def _choose_endpoint(self):
+        """  
+        Picks the least loaded healthy endpoint and reserves a request slot on it, waiting if all endpoints are in cooldown.  
+        """  
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                healthy_endpoints = [endpoint for endpoint in self.endpoints if endpoint.cooldown_until <= now]
+
+                if healthy_endpoints:
+                    known_latencies = [endpoint.latency_ewma for endpoint in self.endpoints if endpoint.latency_ewma]
+                    default_latency = min(known_latencies) if known_latencies else 1.0 # Untried endpoints look as fast as the best one
+                    endpoint = min(healthy_endpoints, 
+                                   key=lambda endpoint: (endpoint.in_flight + 1) * (endpoint.latency_ewma or default_latency) / endpoint.weight)
+                    endpoint.in_flight += 1
+                    endpoint.requests += 1
+                    return endpoint
+
+                wait_seconds = min(endpoint.cooldown_until for endpoint in self.endpoints) - now
+            print(f'All endpoints are cooling down, waiting {wait_seconds:.1f} seconds')
+            time.sleep(wait_seconds)
+
+    def _record_result(self, endpoint, latency=None, error=None):
+        """  
+        Releases the request slot. latency is given for successful calls only, error for retryable failures, which put the endpoint
+        in cooldown. Neither is given for a non-retryable error, which says nothing about the endpoint's health or latency.  
+        """  
+        with self._lock:
+            endpoint.in_flight -= 1
+            if latency is not None:
+                endpoint.consecutive_failures = 0
+                endpoint.latency_ewma = latency if endpoint.latency_ewma is None else 0.8 * endpoint.latency_ewma + 0.2 * latency
+            elif error is not None:
+                endpoint.failures += 1
+                endpoint.consecutive_failures += 1
+                cooldown = get_retry_after_seconds(error)
+                if cooldown is None:
+                    cooldown = min(self.max_cooldown_seconds, self.cooldown_seconds * 2 ** (endpoint.consecutive_failures - 1))
+                endpoint.cooldown_until = time.monotonic() + cooldown
+
+    def call(self, request_fn, estimated_tokens=0):
+        """  
+        Sends a request to the best available endpoint, failing over to other endpoints on throttling and retryable errors.  
+        :param request_fn: Function called as request_fn(client, deployment) making the request.  
+        :param estimated_tokens: Tokens the request counts against the endpoint's tokens-per-minute limit.  
+        :return: Return value of request_fn. The last error is raised when all attempts fail or the error is not retryable.  
+        """  
+        for attempt in range(self.max_attempts):
+            endpoint = self._choose_endpoint()
+            start_time = time.monotonic()
+            try:
+                # Several endpoints fail over instead of retrying on the same one, the scheduler applies the endpoint's rate limits
+                with metrics.span('model_call', endpoint=endpoint.name, deployment=endpoint.deployment):
+                    result = endpoint.scheduler.call(request_fn, endpoint.client, endpoint.deployment, 
+                                                     estimated_tokens=estimated_tokens, max_retries=None if len(self.endpoints) == 1 else 0)
+            except Exception as e:
+                self._record_result(endpoint, error=e if is_retryable_error(e) else None)
+                if not is_retryable_error(e) or attempt == self.max_attempts - 1:
+                    raise
+                print(f'Endpoint {endpoint.name} failed ({get_error_status_code(e) or type(e).__name__}), failing over (attempt {attempt + 1} of {self.max_attempts})')
+                metrics.increment('retries', service='openai')
+                continue
+
+            self._record_result(endpoint, latency=time.monotonic() - start_time)
+            return result
+
+    def print_stats(self):
+        for endpoint in self.endpoints:
+            latency = f'{endpoint.latency_ewma:.2f}s' if endpoint.latency_ewma else 'n/a'
+            print(f'Endpoint {endpoint.name}: requests: {endpoint.requests}, failures: {endpoint.failures}, latency: {latency}, '
+                  f'concurrency limit: {endpoint.scheduler.concurrency_limit}')
+
+def create_azure_openai_client(endpoint_config):  
+    """  
+    Creates an AzureOpenAI client for one entry of the endpoints configuration.  
+    Retries are disabled on the client as they are handled by RequestScheduler and EndpointPool.  
+    """  
+    return AzureOpenAI(
+        api_key=endpoint_config.get('api_key') or os.getenv(endpoint_config.get('api_key_env', 'AZURE_OPENAI_API_KEY')),
+        api_version=endpoint_config['api_version'],
+        azure_endpoint=endpoint_config['endpoint'],
+        max_retries=0
+    )
+
+def load_endpoint_pool(config_path, model, api_version, requests_per_minute=None, tokens_per_minute=None, max_concurrency=8, client_factory=create_azure_openai_client):  
+    """  
+    Loads an EndpointPool for one model from a JSON configuration file (see endpoints_template.json).  
+    Without a configuration file the pool has a single endpoint built from AZURE_OPENAI_ENDPOINT and AZURE_OPENAI_API_KEY.  
+  
+    Args:  
+        config_path (str): Path to the JSON list of endpoints, or None.  
+        model (str): Model the endpoints must serve, entries with a different "model" are ignored (e.g. "gpt-4o-audio-preview").  
+        api_version (str): API version used when an entry does not set "api_version".  
+        requests_per_minute (int): Default requests-per-minute limit when an entry does not set one.  
+        tokens_per_minute (int): Default tokens-per-minute limit when an entry does not set one.  
+        max_concurrency (int): Default maximum concurrent requests per endpoint, the pool's max_concurrency is the sum over its endpoints.  
+        client_factory (callable): Creates the client for an entry, e.g. to point at local mock endpoints.  
+  
+    Returns:  
+        EndpointPool: Pool of the endpoints serving the model.  
+    """  
+    if config_path:
+        with open(config_path, 'r') as file:
+            endpoint_configs = [endpoint_config for endpoint_config in json.load(file) if endpoint_config.get('model', model) == model]
+    else:
+        endpoint_configs = [{'name': 'default', 'endpoint': os.getenv('AZURE_OPENAI_ENDPOINT'), 'deployment': model}]
+
+    endpoints = []
+    for endpoint_config in endpoint_configs:
+        endpoint_config = {'api_version': api_version, **endpoint_config}
+        scheduler = RequestScheduler(requests_per_minute=endpoint_config.get('requests_per_minute', requests_per_minute), 
+                                     tokens_per_minute=endpoint_config.get('tokens_per_minute', tokens_per_minute), 
+                                     max_concurrency=endpoint_config.get('max_concurrency', max_concurrency))
+        endpoints.append(ClientEndpoint(name=endpoint_config.get('name', endpoint_config['endpoint']), 
+                                        client=client_factory(endpoint_config), 
+                                        deployment=endpoint_config.get('deployment', model), 
+                                        weight=endpoint_config.get('weight', 1), 
+                                        scheduler=scheduler))
+
+    print(f'Loaded {len(endpoints)} endpoint(s) for {model}: {", ".join(endpoint.name for endpoint in endpoints)}')
+    return EndpointPool(endpoints)
@@ -0,0 +1,245 @@
+# Tracking of Speech batch transcription jobs.
+# TranscriptionJobTracker polls many jobs from one asyncio event loop, spacing the polls of each job by its status and audio
+# duration. TranscriptionWebhookReceiver receives the completion events of a registered web hook so jobs are polled as soon as they
+# complete. wait_for_transcriptions in utils.py combines the two for the Speech backends.
+
+import asyncio
+import hashlib
+import hmac
+import json
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from metrics import metrics
+
+class TranscriptionWebhookReceiver:  
+    """  
+    Small HTTP server for Speech service web hook events, running in a background thread.  
+    It answers the validation challenge, checks the event signature when a secret is set, and calls each listener with the
+    submission ID of every completed transcription. TranscriptionJobTracker.notify is the usual listener.  
+    """  
+
+    def __init__(self, host='0.0.0.0', port=8765, secret=None):
+        self.secret = secret
+        self.events = 0
+        self._listeners = []
+        receiver = self
+
+        class _WebhookRequestHandler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                receiver._handle_request(self)
+
+        self._server = ThreadingHTTPServer((host, port), _WebhookRequestHandler)
+        self.port = self._server.server_address[1]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        print(f'Web hook receiver listening on port {self.port}')
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def _send_response(self, request, status_code, body=b''):
+        request.send_response(status_code)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def _handle_request(self, request):
+        body = request.rfile.read(int(request.headers.get('Content-Length', 0)))
+        event_kind = request.headers.get('X-MicrosoftSpeechServices-Event', '').lower()
+
+        # The service validates a new web hook by expecting the validation token back
+        if event_kind == 'challenge':
+            validation_token = urllib.parse.parse_qs(urllib.parse.urlsplit(request.path).query).get('validationToken', [''])[0]
+            self._send_response(request, 200, validation_token.encode())
+            return
+
+        if self.secret:
+            expected_signature = hmac.new(self.secret.encode(), body, hashlib.sha256).hexdigest()
+            if not hmac.compare_digest(expected_signature, request.headers.get('X-MicrosoftSpeechServices-Signature', '').lower()):
+                self._send_response(request, 401)
+                return
+
+        try:
+            event = json.loads(body)
+        except ValueError:
+            self._send_response(request, 400)
+            return
+        self._send_response(request, 200)
+
+        if event_kind == 'transcriptioncompletion':
+            self.events += 1
+            submission_id = urllib.parse.urlsplit(event.get('self', '')).path.rstrip('/').split('/')[-1]
+            for listener in list(self._listeners):
+                listener(submission_id)
+
+class TranscriptionJobTracker:  
+    """  
+    Polls many Speech batch transcription jobs from one asyncio event loop.  
+    Each job has its own polling schedule: queued jobs back off quickly, running jobs are polled at a rate based on the audio
+    duration, and the interval grows while the status does not change. A job that exceeds its deadline is reported as "TimedOut".
+    The status requests are made by get_transcription_fn(submission_id) in worker threads, bounded by max_concurrent_requests.
+    It returns the transcription JSON, or None when the request failed (see get_transcription in utils.py).  
+    """  
+
+    def __init__(self, get_transcription_fn, min_poll_interval=5, max_poll_interval=120, max_concurrent_requests=16, 
+                 max_poll_errors=5, deadline_seconds=6 * 60 * 60):
+        self.get_transcription_fn = get_transcription_fn
+        self.min_poll_interval = min_poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.max_concurrent_requests = max_concurrent_requests
+        self.max_poll_errors = max_poll_errors
+        self.deadline_seconds = deadline_seconds
+        self.requests = 0
+        self.notifications = 0
+        self._loop = None
+        self._request_semaphore = None
+        self._wake_events = {}
+        self._notified = set()
+
+    def notify(self, submission_id):  
+        """  
+        Polls a job right away instead of waiting for its next scheduled poll, e.g. on a web hook event. Safe to call from any thread,
+        the job is woken up in the event loop tracking it. Events arriving before tracking starts are dropped, every job is polled when it starts.  
+        """  
+        loop = self._loop
+        if loop is None:
+            return
+        try:
+            loop.call_soon_threadsafe(self._on_notified, submission_id)
+        except RuntimeError:
+            pass # The event loop has closed, tracking is over
+
+    def _on_notified(self, submission_id):
+        self.notifications += 1
+        self._notified.add(submission_id)
+        wake_event = self._wake_events.get(submission_id)
+        if wake_event is not None:
+            wake_event.set()
+
+    def _bind_loop(self):
+        # The request semaphore and the wake events belong to one event loop, tracking in a new loop starts afresh
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._request_semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+            self._wake_events = {}
+            self._notified = set()
+        return loop
+
+    def _next_poll_interval(self, status, previous_status, poll_interval, audio_duration_seconds):
+        if status != previous_status:
+            # Batch transcription usually runs at a fraction of real time, so long audio is polled less often from the start
+            poll_interval = self.min_poll_interval if status != 'Running' or not audio_duration_seconds else audio_duration_seconds * 0.05
+        else:
+            poll_interval = poll_interval * (2 if status == 'NotStarted' else 1.5)
+
+        return min(self.max_poll_interval, max(self.min_poll_interval, poll_interval))
+
+    async def track(self, submission_id, audio_duration_seconds=None, on_succeeded=None, deadline_seconds=None):  
+        """  
+        Polls one job until it succeeds, fails or exceeds its deadline.  
+        :param submission_id: ID of the transcription submission.  
+        :param audio_duration_seconds: Total audio duration of the job, used to space the polls (optional).  
+        :param on_succeeded: Function called as on_succeeded(submission_id, transcription_response) in a worker thread as soon as the job succeeds, e.g. to download its result files.  
+        :param deadline_seconds: Seconds after which the job is given up on (default is the tracker's deadline_seconds).  
+        :return: Final transcription JSON, or {"status": "Failed" / "TimedOut", "error": ...}.  
+        """  
+        loop = self._bind_loop()
+        start_time = loop.time()
+        deadline = start_time + (deadline_seconds or self.deadline_seconds)
+        poll_interval = self.min_poll_interval
+        previous_status = None
+        poll_errors = 0
+        running_since = None
+
+        while True:
+            async with self._request_semaphore:
+                self.requests += 1
+                get_transcription_response = await asyncio.to_thread(self.get_transcription_fn, submission_id)
+            status = get_transcription_response.get("status") if get_transcription_response else None
+            metrics.increment('speech_polls', status=status or 'Error')
+
+            # Time in the queue and processing as seen by the polls, the first status seen after a change is up to one poll interval late
+            if status == "Running" and running_since is None:
+                running_since = loop.time()
+                metrics.observe('speech_queue', running_since - start_time)
+            if status in ("Succeeded", "Failed"):
+                metrics.observe('speech_processing', loop.time() - (running_since or start_time), error=None if status == "Succeeded" else status)
+
+            if status == "Succeeded":
+                print(f'Transcription {submission_id}: {status}')
+                if on_succeeded:
+                    try:
+                        await asyncio.to_thread(on_succeeded, submission_id, get_transcription_response)
+                    except Exception as e:
+                        print(f'Processing results of transcription {submission_id} failed: {e}')
+                        return {"status": "Failed", "error": f'Processing results failed: {e}'}
+                return get_transcription_response
+
+            if status == "Failed":
+                print(f'Transcription {submission_id}: {status}')
+                return get_transcription_response
+
+            if status is None:
+                poll_errors += 1
+                if poll_errors >= self.max_poll_errors:
+                    return {"status": "Failed", "error": "Could not get the transcription status"}
+                poll_interval = min(self.max_poll_interval, poll_interval * 2)
+            else:
+                poll_errors = 0
+                poll_interval = self._next_poll_interval(status, previous_status, poll_interval, audio_duration_seconds)
+                previous_status = status
+
+            remaining_seconds = deadline - loop.time()
+            if remaining_seconds <= 0:
+                print(f'Transcription {submission_id}: deadline exceeded with status {previous_status}')
+                return {"status": "TimedOut", "error": f'Not completed within the deadline, last status: {previous_status}'}
+
+            # Sleep until the next scheduled poll, or until notify is called for this job
+            if submission_id in self._notified:
+                self._notified.discard(submission_id)
+                continue
+            wake_event = self._wake_events.setdefault(submission_id, asyncio.Event())
+            try:
+                await asyncio.wait_for(wake_event.wait(), timeout=min(poll_interval, remaining_seconds))
+            except asyncio.TimeoutError:
+                pass
+            wake_event.clear()
+            self._notified.discard(submission_id)
+
+    async def track_all(self, submission_ids, audio_durations=None, on_succeeded=None):  
+        """  
+        Polls many jobs concurrently.  
+        :param submission_ids: IDs of the transcription submissions.  
+        :param audio_durations: Dict of audio duration in seconds per submission ID (optional).  
+        :param on_succeeded: As for track, called for each job as soon as it succeeds.  
+        :return: Dict of final transcription JSON per submission ID.  
+        """  
+        self._bind_loop()
+        self._wake_events.update({submission_id: asyncio.Event() for submission_id in submission_ids})
+        audio_durations = audio_durations or {}
+        final_responses = await asyncio.gather(*[self.track(submission_id, audio_durations.get(submission_id), on_succeeded) 
+                                                 for submission_id in submission_ids])
+        return dict(zip(submission_ids, final_responses))
+
+    def run(self, submission_ids, audio_durations=None, on_succeeded=None):  
+        """  
+        Runs track_all in a new event loop, for use from synchronous code.  
+        """  
+        return asyncio.run(self.track_all(submission_ids, audio_durations, on_succeeded))
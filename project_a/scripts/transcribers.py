@@ -0,0 +1,430 @@
+# Transcription backends behind one interface, and the pipeline shared by the scripts.
+# Each Transcriber wraps one of the transcribe_file_with_* backends in utils.py together with its clients and cache,
+# so scripts (and a router choosing a backend per file) only deal with transcribe_file / transcribe_files.
+
+import os
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import TranscriptionCache, SpeechModelCatalog, get_blob_service_client, get_audio_duration_seconds, transcribe_files_concurrently, \
+    transcribe_file_with_whisper, transcribe_file_with_4o_audio, transcribe_file_with_speech, \
+    transcribe_files_with_speech_batch
+from scheduling import load_endpoint_pool
+from metrics import metrics
+from accounting import UsageLedger, print_usage_summary
+from transcripts import combine_transcripts
+
+BACKENDS = ('whisper', '4o_audio', 'whisper_speech', 'base_speech')
+
+DEFAULT_SYSTEM_MESSAGE = '''You are generating a text transcript for documentation.
+    You will be given audio file, listen to it carefully ignoring background sounds.
+    Do not guess words that you cannot hear clearly. Say [inaudible] for words that you cannot hear clearly.
+    Do not say transcription or anything else at start or end of the transcription.
+    Do not say I can't assist with transcribing audio.
+    '''
+
+DEFAULT_PROMPT = '''Transcribe this audio file into text.'''
+
+SPEECH_API_URL = 'https://australiaeast.api.cognitive.microsoft.com' # 'https://eastus.api.cognitive.microsoft.com'
+
+# Locale, model display name and the model URL used when the model list cannot be fetched, per Speech backend
+SPEECH_BACKEND_MODELS = {
+    'whisper_speech': ('en-US', 'Whisper Large V2',
+                       'https://australiaeast.api.cognitive.microsoft.com/speechtotext/v3.2/models/base/7ebab5c6-7c8f-457b-a0de-25933374180d?api-version=3.2'), # OpenAI Whisper Model in Azure AI Speech (Whisper v2-large)
+    'base_speech': ('en-AU', 'Batch Transcription',
+                    'https://australiaeast.api.cognitive.microsoft.com/speechtotext/v3.2/models/base/7b06ba5e-9d1b-4a16-abde-a02efc587644?api-version=3.2'), # "20240614 Batch Transcription" "en-AU base model
+}
+
+class Transcriber(ABC):
+    """
+    Transcribes audio files with one backend.
+    transcribe_file returns the paths of the transcript files written and raises on failure, filling usage (if given) with the
+    audio duration, requests and tokens of the file. transcribe_files transcribes many files and records the outcome and usage of each,
+    by default with a thread pool; backends that batch files override it.
+    """
+    backend = None
+
+    def __init__(self, transcription_cache=None):
+        self.transcription_cache = transcription_cache
+
+    @abstractmethod
+    def transcribe_file(self, file_path, output_path, usage=None):
+        pass
+
+    def transcribe_files(self, file_paths, output_path, max_workers=4):
+        """
+        :return: List of status dicts (file_path, status, outputs, error, seconds, usage) in the order of file_paths.
+        """
+        return transcribe_files_concurrently(file_paths, lambda file_path, usage: self.transcribe_file(file_path, output_path, usage=usage), 
+                                             max_workers=max_workers)
+
+    def print_stats(self):
+        if self.transcription_cache:
+            self.transcription_cache.print_stats()
+
+class WhisperTranscriber(Transcriber):
+    """
+    Azure OpenAI Whisper deployments, see transcribe_file_with_whisper for the options.
+    """
+    backend = 'whisper'
+
+    def __init__(self, endpoint_pool, deployment_id="whisper", transcription_cache=None, **transcribe_options):
+        super().__init__(transcription_cache)
+        self.endpoint_pool = endpoint_pool
+        self.deployment_id = deployment_id
+        self.transcribe_options = transcribe_options
+
+    def transcribe_file(self, file_path, output_path, usage=None):
+        return transcribe_file_with_whisper(self.endpoint_pool, file_path, output_path, deployment_id=self.deployment_id,
+                                            transcription_cache=self.transcription_cache, usage=usage, **self.transcribe_options)
+
+    def print_stats(self):
+        super().print_stats()
+        self.endpoint_pool.print_stats()
+
+class AudioChatTranscriber(Transcriber):
+    """
+    Azure OpenAI gpt-4o-audio chat completions, see transcribe_file_with_4o_audio for the options.
+    """
+    backend = '4o_audio'
+
+    def __init__(self, endpoint_pool, system_message=DEFAULT_SYSTEM_MESSAGE, prompt=DEFAULT_PROMPT, deployment_id="gpt-4o-audio-preview",
+                 transcription_cache=None, chunk_checkpoint=None, **transcribe_options):
+        super().__init__(transcription_cache)
+        self.endpoint_pool = endpoint_pool
+        self.system_message = system_message
+        self.prompt = prompt
+        self.deployment_id = deployment_id
+        self.chunk_checkpoint = chunk_checkpoint
+        self.transcribe_options = transcribe_options
+
+    def transcribe_file(self, file_path, output_path, usage=None):
+        return transcribe_file_with_4o_audio(self.endpoint_pool, file_path, output_path, system_message=self.system_message, prompt=self.prompt,
+                                             deployment_id=self.deployment_id, transcription_cache=self.transcription_cache,
+                                             chunk_checkpoint=self.chunk_checkpoint, usage=usage, **self.transcribe_options)
+
+    def print_stats(self):
+        super().print_stats()
+        if self.chunk_checkpoint:
+            self.chunk_checkpoint.print_stats()
+        self.endpoint_pool.print_stats()
+
+class SpeechTranscriber(Transcriber):
+    """
+    Azure AI Speech batch transcription with a Whisper or base model.
+    Single files are transcribed with transcribe_file_with_speech, many files with as few jobs as possible through
+    transcribe_files_with_speech_batch. transcribe_options are passed to both (e.g. word_level_timestamps_enabled, save_raw_json).
+    """
+
+    def __init__(self, backend, api_url, api_version, subscription_key, model_url, locale, blob_service_client, storage_container,
+                 storage_account_name, storage_account_key, is_whisper=False, transcription_cache=None, batch_options=None, **transcribe_options):
+        super().__init__(transcription_cache)
+        self.backend = backend
+        self.api_url = api_url
+        self.api_version = api_version
+        self.subscription_key = subscription_key
+        self.model_url = model_url
+        self.locale = locale
+        self.blob_service_client = blob_service_client
+        self.storage_container = storage_container
+        self.storage_account_name = storage_account_name
+        self.storage_account_key = storage_account_key
+        self.is_whisper = is_whisper
+        self.batch_options = batch_options or {} # Only for transcribe_files, e.g. content_container_url, webhook_receiver
+        self.transcribe_options = transcribe_options
+
+    def _speech_arguments(self):
+        return dict(backend=self.backend, api_url=self.api_url, api_version=self.api_version, subscription_key=self.subscription_key,
+                    model_url=self.model_url, locale=self.locale, blob_service_client=self.blob_service_client,
+                    storage_container=self.storage_container, storage_account_name=self.storage_account_name,
+                    storage_account_key=self.storage_account_key, is_whisper=self.is_whisper, transcription_cache=self.transcription_cache)
+
+    def transcribe_file(self, file_path, output_path, usage=None):
+        return transcribe_file_with_speech(file_path, output_path, **self._speech_arguments(), usage=usage, **self.transcribe_options)
+
+    def transcribe_files(self, file_paths, output_path, max_workers=4):
+        return transcribe_files_with_speech_batch(file_paths, output_path, max_upload_workers=max_workers, **self._speech_arguments(),
+                                                  **self.batch_options, **self.transcribe_options)
+
+def create_transcriber(backend, cache_dir='../cache', deployment_id=None, api_version=None, requests_per_minute=None, tokens_per_minute=None,
+                       max_concurrency=4, system_message=DEFAULT_SYSTEM_MESSAGE, prompt=DEFAULT_PROMPT, api_url=SPEECH_API_URL,
+                       locale=None, model_display_name=None, batch_options=None, **transcribe_options):
+    """
+    Creates the transcriber of a backend with the clients configured from the environment (see env_template.txt).
+    :param backend: One of BACKENDS.
+    :param cache_dir: Transcription cache folder, None to disable the cache (default is "../cache").
+    :param deployment_id, api_version, requests_per_minute, tokens_per_minute: Azure OpenAI deployment and its rate limits (whisper and 4o_audio).
+    :param max_concurrency: Requests in flight per endpoint (whisper and 4o_audio), a file sends up to this many per endpoint of the pool.
+    :param system_message, prompt: Chat messages (4o_audio).
+    :param api_url, locale, model_display_name: Speech region and model, resolved through the cached model catalog (Speech backends).
+    :param batch_options: Options for transcribing many files in as few jobs as possible (Speech backends).
+    :param transcribe_options: Passed to the backend's transcribe function.
+    :return: Transcriber.
+    """
+    transcription_cache = TranscriptionCache(cache_dir) if cache_dir else None
+
+    if backend == 'whisper':
+        # Whisper deployments default to 3 requests per minute
+        deployment_id = deployment_id or "whisper"
+        endpoint_pool = load_endpoint_pool(os.getenv("AZURE_OPENAI_ENDPOINTS_CONFIG"), model=deployment_id, api_version=api_version or '2024-10-21',
+                                           requests_per_minute=requests_per_minute or 3, tokens_per_minute=tokens_per_minute,
+                                           max_concurrency=max_concurrency)
+        return WhisperTranscriber(endpoint_pool, deployment_id=deployment_id, transcription_cache=transcription_cache, **transcribe_options)
+
+    if backend == '4o_audio':
+        deployment_id = deployment_id or "gpt-4o-audio-preview"
+        endpoint_pool = load_endpoint_pool(os.getenv("AZURE_OPENAI_ENDPOINTS_CONFIG"), model=deployment_id, api_version=api_version or '2025-01-01-preview',
+                                           requests_per_minute=requests_per_minute or 60, tokens_per_minute=tokens_per_minute or 80000,
+                                           max_concurrency=max_concurrency)
+        chunk_checkpoint = TranscriptionCache(os.path.join(cache_dir, 'chunks')) if cache_dir else None
+        return AudioChatTranscriber(endpoint_pool, system_message=system_message, prompt=prompt, deployment_id=deployment_id,
+                                    transcription_cache=transcription_cache, chunk_checkpoint=chunk_checkpoint, **transcribe_options)
+
+    if backend in SPEECH_BACKEND_MODELS:
+        default_locale, default_model_display_name, default_model_url = SPEECH_BACKEND_MODELS[backend]
+        locale = locale or default_locale
+        api_version = api_version or '2024-11-15'
+
+        speech_model_catalog = SpeechModelCatalog(api_url=api_url, api_version=api_version, subscription_key=os.getenv("AZURE_AI_FOUNDRY_KEY"),
+                                                  cache_dir=os.path.join(cache_dir, 'models') if cache_dir else None)
+        model_url = speech_model_catalog.resolve_model_url(model_display_name or default_model_display_name, locale,
+                                                           default_model_url=default_model_url if locale == default_locale else None)
+
+        # Whisper models take displayFormWordLevelTimestampsEnabled, base models wordLevelTimestampsEnabled
+        return SpeechTranscriber(backend, api_url=api_url, api_version=api_version, subscription_key=os.getenv("AZURE_AI_FOUNDRY_KEY"),
+                                 model_url=model_url, locale=locale, blob_service_client=get_blob_service_client(os.getenv('STORAGE_BLOB_SAS')),
+                                 storage_container=os.getenv('STORAGE_CONTAINER_NAME'), storage_account_name=os.getenv('STORAGE_NAME'),
+                                 storage_account_key=os.getenv('STORAGE_KEY'), is_whisper=backend == 'whisper_speech', transcription_cache=transcription_cache,
+                                 batch_options=batch_options, **transcribe_options)
+
+    raise ValueError(f'Unknown backend {backend}, expected one of {", ".join(BACKENDS)}')
+
+# Starting estimates per backend, the router replaces seconds_per_audio_second with what it measures
+# cost_per_hour: approximate list price in USD per audio hour, update for your region and agreement
+# overhead_seconds: time before the first result regardless of the audio length (for Speech batch mostly the job queue)
+# locales: None when the model is multilingual
+BACKEND_PROFILES = {
+    'whisper': {'cost_per_hour': 0.36, 'overhead_seconds': 3, 'seconds_per_audio_second': 0.1, 
+                'diarization': False, 'word_timestamps': False, 'locales': None},
+    '4o_audio': {'cost_per_hour': 1.60, 'overhead_seconds': 3, 'seconds_per_audio_second': 0.15, 
+                 'diarization': False, 'word_timestamps': False, 'locales': None},
+    'whisper_speech': {'cost_per_hour': 0.18, 'overhead_seconds': 300, 'seconds_per_audio_second': 0.05, 
+                       'diarization': True, 'word_timestamps': True, 'locales': None},
+    'base_speech': {'cost_per_hour': 0.18, 'overhead_seconds': 300, 'seconds_per_audio_second': 0.05, 
+                    'diarization': True, 'word_timestamps': True, 'locales': (SPEECH_BACKEND_MODELS['base_speech'][0],)},
+}
+
+class BackendStats:
+    """
+    Measured processing speed per backend (seconds per audio second, exponentially weighted), saved to a JSON file so it carries over between runs.
+    """
+
+    def __init__(self, stats_file_path, smoothing=0.3):
+        self.stats_file_path = stats_file_path
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+        self.stats = {}
+        if os.path.exists(stats_file_path):
+            with open(stats_file_path, 'r') as file:
+                self.stats = json.load(file)
+
+    def seconds_per_audio_second(self, backend):
+        backend_stats = self.stats.get(backend)
+        return backend_stats['seconds_per_audio_second'] if backend_stats else BACKEND_PROFILES[backend]['seconds_per_audio_second']
+
+    def record(self, backend, audio_duration_seconds, seconds, files=1):
+        # Files answered from the transcription cache take less than the overhead and say nothing about the backend
+        if not audio_duration_seconds or seconds is None or seconds < BACKEND_PROFILES[backend]['overhead_seconds']:
+            return
+
+        observed = max(0, seconds - BACKEND_PROFILES[backend]['overhead_seconds']) / audio_duration_seconds
+        with self._lock:
+            backend_stats = self.stats.setdefault(backend, {'seconds_per_audio_second': observed, 'files': 0, 'audio_seconds': 0})
+            backend_stats['seconds_per_audio_second'] += self.smoothing * (observed - backend_stats['seconds_per_audio_second'])
+            backend_stats['files'] += files
+            backend_stats['audio_seconds'] += audio_duration_seconds
+
+    def save(self):
+        with self._lock:
+            os.makedirs(os.path.dirname(self.stats_file_path) or '.', exist_ok=True)
+            temp_file_path = self.stats_file_path + '.tmp'
+            with open(temp_file_path, 'w') as file:
+                json.dump(self.stats, file, indent=4)
+            os.replace(temp_file_path, self.stats_file_path)
+
+class RoutingTranscriber(Transcriber):
+    """
+    Sends each file to the backend that suits it best, e.g. short clips to Whisper and long recordings to Speech batch transcription.
+    Backends missing a required feature or not supporting the locale are skipped. Of the rest, those within the latency SLA and the cost budget are preferred,
+    and the one with the lowest cost + latency_cost_per_hour * estimated latency is chosen. The latency estimate uses
+    the file duration and the speed measured for each backend in earlier runs (BackendStats).
+    Transcribers are created on first use with transcriber_factory(backend, **transcriber_options).
+    """
+    backend = 'auto'
+
+    def __init__(self, backends=BACKENDS, cache_dir='../cache', locale=None, latency_sla_seconds=None, cost_budget_per_hour=None, latency_cost_per_hour=5.0,
+                 require_diarization=False, require_word_timestamps=False, transcriber_factory=create_transcriber, transcriber_options=None):
+        super().__init__()
+        self.backends = backends
+        self.cache_dir = cache_dir
+        self.locale = locale
+        self.latency_sla_seconds = latency_sla_seconds
+        self.cost_budget_per_hour = cost_budget_per_hour
+        self.latency_cost_per_hour = latency_cost_per_hour
+        self.require_diarization = require_diarization
+        self.require_word_timestamps = require_word_timestamps
+        self.transcriber_factory = transcriber_factory
+        self.transcriber_options = transcriber_options or {}
+        self.backend_stats = BackendStats(os.path.join(cache_dir or '../cache', 'backend_stats.json'))
+        self.transcribers = {}
+        self.routed_files = {}
+        self._lock = threading.Lock()
+
+    def estimate(self, backend, audio_duration_seconds):
+        """
+        :return: (estimated latency in seconds, estimated cost in USD) of transcribing audio_duration_seconds with backend.
+        """
+        profile = BACKEND_PROFILES[backend]
+        latency_seconds = profile['overhead_seconds'] + self.backend_stats.seconds_per_audio_second(backend) * audio_duration_seconds
+        return latency_seconds, profile['cost_per_hour'] * audio_duration_seconds / 3600
+
+    def choose_backend(self, file_path):
+        """
+        :return: (backend, audio duration in seconds) for a file.
+        """
+        # Roughly a minute per MB (128 kbps) when the duration cannot be read from the header
+        audio_duration_seconds = get_audio_duration_seconds(file_path) or os.path.getsize(file_path) / (1024 * 1024) * 60
+
+        candidates = [backend for backend in self.backends 
+                      if (BACKEND_PROFILES[backend]['diarization'] or not self.require_diarization) 
+                      and (BACKEND_PROFILES[backend]['word_timestamps'] or not self.require_word_timestamps) 
+                      and (not self.locale or not BACKEND_PROFILES[backend]['locales'] 
+                           or self.locale.lower() in [locale.lower() for locale in BACKEND_PROFILES[backend]['locales']])]
+        if not candidates:
+            raise ValueError(f'No backend supports the required features and locale {self.locale}')
+
+        estimates = {backend: self.estimate(backend, audio_duration_seconds) for backend in candidates}
+        if self.latency_sla_seconds:
+            candidates = [backend for backend in candidates if estimates[backend][0] <= self.latency_sla_seconds] or candidates
+        if self.cost_budget_per_hour:
+            candidates = [backend for backend in candidates if BACKEND_PROFILES[backend]['cost_per_hour'] <= self.cost_budget_per_hour] or candidates
+
+        backend = min(candidates, key=lambda backend: estimates[backend][1] + self.latency_cost_per_hour * estimates[backend][0] / 3600)
+        return backend, audio_duration_seconds
+
+    def get_transcriber(self, backend):
+        with self._lock:
+            if backend not in self.transcribers:
+                transcriber_options = dict(self.transcriber_options)
+                if self.locale and backend in SPEECH_BACKEND_MODELS:
+                    transcriber_options.setdefault('locale', self.locale)
+                self.transcribers[backend] = self.transcriber_factory(backend, cache_dir=self.cache_dir, **transcriber_options)
+            return self.transcribers[backend]
+
+    def transcribe_file(self, file_path, output_path, usage=None):
+        backend, audio_duration_seconds = self.choose_backend(file_path)
+        print(f'{os.path.basename(file_path)}: {audio_duration_seconds:.0f} seconds, routed to {backend}')
+        self.routed_files[backend] = self.routed_files.get(backend, 0) + 1
+
+        start_time = time.time()
+        output_file_paths = self.get_transcriber(backend).transcribe_file(file_path, output_path, usage=usage)
+        self.backend_stats.record(backend, audio_duration_seconds, time.time() - start_time)
+        self.backend_stats.save()
+        return output_file_paths
+
+    def transcribe_files(self, file_paths, output_path, max_workers=4):
+        # Group the files by backend, so Speech files go into as few batch jobs as possible, and run the groups side by side
+        files_by_backend = {}
+        audio_durations = {}
+        for file_path in file_paths:
+            backend, audio_durations[file_path] = self.choose_backend(file_path)
+            files_by_backend.setdefault(backend, []).append(file_path)
+        for backend, backend_file_paths in files_by_backend.items():
+            print(f'Routed to {backend}: {len(backend_file_paths)} file(s), {sum(audio_durations[f] for f in backend_file_paths) / 60:.1f} minutes')
+            self.routed_files[backend] = self.routed_files.get(backend, 0) + len(backend_file_paths)
+
+        def transcribe_group(backend):
+            try:
+                return self.get_transcriber(backend).transcribe_files(files_by_backend[backend], output_path, max_workers=max_workers)
+            except Exception as e:
+                return [{'file_path': file_path, 'status': 'failed', 'outputs': [], 'error': str(e), 'seconds': None, 'usage': {}} 
+                        for file_path in files_by_backend[backend]]
+
+        file_statuses = {}
+        with ThreadPoolExecutor(max_workers=max(1, len(files_by_backend))) as executor:
+            for backend, backend_file_statuses in zip(files_by_backend, executor.map(transcribe_group, files_by_backend)):
+                # The files of a Speech batch job are measured together, as the job's audio and time (see transcribe_files_with_speech_batch)
+                jobs = {}
+                for file_status in backend_file_statuses:
+                    file_status['backend'] = backend
+                    file_statuses[file_status['file_path']] = file_status
+                    if file_status['status'] != 'succeeded':
+                        continue
+                    usage = file_status.get('usage') or {}
+                    if 'job_seconds' in usage:
+                        job = jobs.setdefault(usage['submission_id'], {'audio_seconds': 0, 'seconds': usage['job_seconds'], 'files': 0})
+                        job['audio_seconds'] += audio_durations[file_status['file_path']]
+                        job['files'] += 1
+                    else:
+                        self.backend_stats.record(backend, audio_durations[file_status['file_path']], file_status['seconds'])
+                for job in jobs.values():
+                    self.backend_stats.record(backend, job['audio_seconds'], job['seconds'], files=job['files'])
+        self.backend_stats.save()
+
+        return [file_statuses[file_path] for file_path in file_paths]
+
+    def print_stats(self):
+        print(f'Files per backend: {self.routed_files}')
+        for transcriber in self.transcribers.values():
+            transcriber.print_stats()
+
+def run_transcription_pipeline(transcriber, file_paths, output_path, max_workers=4, status_file_path=None, dataset_path=None, usage_ledger_path=None):
+    """
+    Transcribes files with a transcriber, then prints the outcome, the usage and estimated cost, the transcriber's statistics and the time taken.
+    :param file_paths: List of audio file paths.
+    :param output_path: Folder the transcripts are saved to.
+    :param max_workers: Number of files transcribed (or uploaded, for Speech batches) at the same time (default is 4).
+    :param status_file_path: JSONL file the per-file status dicts are saved to (optional).
+    :param dataset_path: .jsonl, .parquet or .arrow file the structured transcripts of all succeeded files are combined into (optional).
+    :param usage_ledger_path: JSONL file the usage of each file and of the run is appended to, for 07_usage_report.py (optional).
+    :return: List of status dicts (file_path, status, outputs, error, seconds, usage) in the order of file_paths.
+    """
+    start_time = time.time()
+    os.makedirs(output_path, exist_ok=True)
+    print(f'Number of files: {len(file_paths)}, backend: {transcriber.backend}')
+
+    file_statuses = transcriber.transcribe_files(file_paths, output_path, max_workers=max_workers)
+
+    if status_file_path:
+        with open(status_file_path, 'w') as file:
+            for file_status in file_statuses:
+                file.write(json.dumps(file_status) + '\n')
+        print(f'Status summary saved to {status_file_path}')
+
+    if dataset_path:
+        combine_transcripts([output_file_path for file_status in file_statuses if file_status['status'] == 'succeeded' 
+                             for output_file_path in file_status['outputs']], dataset_path)
+
+    succeeded_count = sum(1 for file_status in file_statuses if file_status['status'] == 'succeeded')
+    print(f'Succeeded: {succeeded_count}, failed: {len(file_statuses) - succeeded_count}')
+    for file_status in file_statuses:
+        if file_status['status'] != 'succeeded':
+            print(f'{file_status["file_path"]}: {file_status["error"]}')
+
+    print_usage_summary(file_statuses, transcriber.backend)
+    if usage_ledger_path:
+        UsageLedger(usage_ledger_path).record_run(transcriber.backend, file_statuses, time.time() - start_time, workers=max_workers)
+        print(f'Usage recorded in {usage_ledger_path}')
+
+    transcriber.print_stats()
+    if metrics.enabled:
+        metrics.print_stats()
+
+    # Calculate time taken in seconds
+    time_taken = time.time() - start_time
+    print(f"Time taken: {time_taken:.2f} seconds")
+
+    return file_statuses
@@ -0,0 +1,233 @@
+# Common structured transcript for all backends, and writers for JSONL and Parquet / Arrow.
+# A transcript is a dict with the source file, backend, model, language, duration, text and a list of segments.
+# Each segment has start and end in seconds, speaker, channel, confidence, text and its words (start, end, word, confidence).
+# Values a backend does not provide are None, e.g. speakers for Whisper, or word timestamps for gpt-4o-audio.
+#
+# Transcripts are stored one segment per row, so search and analytics can load many files without reading the raw backend JSON.
+
+import os
+import json
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None # Only needed for the Parquet / Arrow writers: pip install pyarrow
+
+TRANSCRIPT_FORMATS = ('jsonl', 'parquet')
+
+def make_transcript(source, backend, segments, text=None, duration=None, language=None, model=None):
+    """
+    Builds a transcript from its segments.
+    :param source: Name of the audio file.
+    :param backend: Backend that transcribed it (e.g. "whisper", "base_speech").
+    :param segments: List of segment dicts (start, end, speaker, channel, confidence, text, words), in time order.
+    :param text: Full transcript text (default is the segment texts joined).
+    :return: Transcript dict.
+    """
+    for _s, segment in enumerate(segments):
+        segment['id'] = _s
+        for key in ('start', 'end', 'speaker', 'channel', 'confidence'):
+            segment.setdefault(key, None)
+        segment.setdefault('words', [])
+
+    if text is None:
+        text = ' '.join(segment['text'].strip() for segment in segments if segment.get('text'))
+
+    return {'source': source, 'backend': backend, 'model': model, 'language': language, 'duration': duration, 'text': text, 'segments': segments}
+
+def assign_words_to_segments(segments, words):
+    """
+    Adds each word to the segment its midpoint falls in, or to the last segment starting before it.
+    :param segments: Segments in time order, with start and end.
+    :param words: Words in time order, with start and end.
+    """
+    _s = 0
+    for word in words:
+        word_midpoint = (word['start'] + word['end']) / 2
+        while _s + 1 < len(segments) and segments[_s + 1]['start'] <= word_midpoint:
+            _s += 1
+        segments[_s]['words'].append(word)
+
+def transcript_from_verbose_json(result, source, backend='whisper', model=None):
+    """
+    Builds a transcript from a Whisper transcription (verbose_json layout, see stitch_transcription_parts).
+    Results in the plain json layout only have text, which becomes a single segment without timestamps.
+    """
+    segments = [{'start': round(segment['start'], 3), 'end': round(segment['end'], 3), 'text': segment['text'].strip(), 'words': []}
+                for segment in result.get('segments') or []]
+    words = [{'start': round(word['start'], 3), 'end': round(word['end'], 3), 'word': word['word'], 'confidence': None}
+             for word in result.get('words') or []]
+
+    if not segments:
+        segments = [{'text': result.get('text', ''), 'words': []}]
+    if words and segments[0].get('start') is not None:
+        assign_words_to_segments(segments, words)
+
+    duration = result.get('duration')
+    return make_transcript(source, backend, segments, text=result.get('text', ''), duration=float(duration) if duration is not None else None,
+                           language=result.get('language'), model=model)
+
+def transcript_from_speech_content(transcription_content, source, backend, model=None, locale=None):
+    """
+    Builds a transcript from the phrases and words of a Speech result file (see extract_transcription_content), one segment per phrase.
+    """
+    segments = [{'start': phrase['start'], 'end': phrase['end'], 'speaker': phrase['speaker'], 'channel': phrase['channel'],
+                 'confidence': phrase['confidence'], 'text': phrase['text'], 'words': []}
+                for phrase in transcription_content['phrases']]
+    for word in transcription_content['words']:
+        word = dict(word)
+        segments[word.pop('phrase')]['words'].append(word)
+
+    # Phrases of different channels are listed per channel, order them by time
+    segments.sort(key=lambda segment: (segment['start'], segment['channel'] or 0))
+
+    return make_transcript(source, backend, segments, text=transcription_content['text'], duration=transcription_content['duration'],
+                           language=locale, model=model)
+
+def transcript_from_chunks(chunk_texts, source, backend='4o_audio', model=None):
+    """
+    Builds a transcript from the text of consecutive audio chunks, one segment per chunk.
+    :param chunk_texts: List of (start, end, text) tuples in seconds, start and end None when unknown. Chunks without text are skipped.
+    """
+    segments = [{'start': start, 'end': end, 'text': text.strip(), 'words': []} for start, end, text in chunk_texts if text]
+    known_ends = [segment['end'] for segment in segments if segment['end'] is not None]
+    return make_transcript(source, backend, segments, duration=max(known_ends) if known_ends else None, model=model)
+
+# Storage layout: one row per segment, with the transcript fields repeated on each row
+def transcript_to_rows(transcript):
+    """
+    :return: List of segment rows (source, backend, model, language, duration, segment, start, end, speaker, channel, confidence, text, words).
+    """
+    return [{'source': transcript['source'], 'backend': transcript['backend'], 'model': transcript['model'], 'language': transcript['language'],
+             'duration': transcript['duration'], 'segment': segment['id'], 'start': segment['start'], 'end': segment['end'],
+             'speaker': segment['speaker'], 'channel': segment['channel'], 'confidence': segment['confidence'], 'text': segment['text'],
+             'words': segment['words']}
+            for segment in transcript['segments']]
+
+def transcripts_from_rows(rows):
+    """
+    Groups segment rows back into transcripts, in the order their sources first appear.
+    """
+    transcripts = {}
+    for row in rows:
+        key = (row['source'], row['backend'])
+        if key not in transcripts:
+            transcripts[key] = {'source': row['source'], 'backend': row['backend'], 'model': row['model'], 'language': row['language'],
+                                'duration': row['duration'], 'segments': []}
+        transcripts[key]['segments'].append({'start': row['start'], 'end': row['end'], 'speaker': row['speaker'], 'channel': row['channel'],
+                                             'confidence': row['confidence'], 'text': row['text'], 'words': list(row['words'] or [])})
+
+    return [make_transcript(transcript.pop('source'), transcript.pop('backend'), transcript.pop('segments'), **transcript)
+            for transcript in transcripts.values()]
+
+def write_transcripts_jsonl(transcripts, output_file_path):
+    """
+    Writes transcripts as JSON lines, one segment per line.
+    """
+    with open(output_file_path, 'w', encoding='utf-8') as file:
+        for transcript in transcripts:
+            for row in transcript_to_rows(transcript):
+                file.write(json.dumps(row, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+def read_transcripts_jsonl(file_path):
+    """
+    :return: List of transcripts of a file written by write_transcripts_jsonl.
+    """
+    with open(file_path, 'r', encoding='utf-8') as file:
+        return transcripts_from_rows(json.loads(line) for line in file if line.strip())
+
+def _get_arrow_schema():
+    word_type = pyarrow.struct([('start', pyarrow.float64()), ('end', pyarrow.float64()), ('word', pyarrow.string()), ('confidence', pyarrow.float64())])
+    return pyarrow.schema([('source', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+                           ('backend', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+                           ('model', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+                           ('language', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+                           ('duration', pyarrow.float64()),
+                           ('segment', pyarrow.int32()),
+                           ('start', pyarrow.float64()),
+                           ('end', pyarrow.float64()),
+                           ('speaker', pyarrow.int32()),
+                           ('channel', pyarrow.int32()),
+                           ('confidence', pyarrow.float64()),
+                           ('text', pyarrow.string()),
+                           ('words', pyarrow.list_(word_type))])
+
+def transcripts_to_arrow_table(transcripts):
+    """
+    :return: pyarrow Table of the segment rows of all transcripts.
+    """
+    if pyarrow is None:
+        raise ImportError('pyarrow is required for Parquet and Arrow transcripts: pip install pyarrow')
+
+    rows = [row for transcript in transcripts for row in transcript_to_rows(transcript)]
+    return pyarrow.Table.from_pylist(rows, schema=_get_arrow_schema())
+
+def write_transcripts_parquet(transcripts, output_file_path):
+    """
+    Writes transcripts to a Parquet file, one segment per row with the words as a nested list.
+    """
+    pyarrow.parquet.write_table(transcripts_to_arrow_table(transcripts), output_file_path, compression='zstd')
+
+def read_transcripts_parquet(file_path):
+    """
+    :return: List of transcripts of a file written by write_transcripts_parquet.
+    """
+    if pyarrow is None:
+        raise ImportError('pyarrow is required for Parquet and Arrow transcripts: pip install pyarrow')
+
+    return transcripts_from_rows(pyarrow.parquet.read_table(file_path).to_pylist())
+
+def write_transcripts(transcripts, output_file_path):
+    """
+    Writes transcripts in the format of the file extension: .jsonl, .parquet, or .arrow / .feather (Arrow IPC).
+    """
+    extension = os.path.splitext(output_file_path)[1].lower()
+    if extension == '.jsonl':
+        write_transcripts_jsonl(transcripts, output_file_path)
+    elif extension == '.parquet':
+        write_transcripts_parquet(transcripts, output_file_path)
+    elif extension in ('.arrow', '.feather'):
+        table = transcripts_to_arrow_table(transcripts)
+        with pyarrow.ipc.new_file(output_file_path, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        raise ValueError(f'Unknown transcript format {extension}, expected .jsonl, .parquet, .arrow or .feather')
+
+def read_transcripts(file_path):
+    """
+    Reads transcripts from a .jsonl or .parquet file.
+    """
+    if file_path.lower().endswith('.parquet'):
+        return read_transcripts_parquet(file_path)
+    return read_transcripts_jsonl(file_path)
+
+def save_transcript(transcript, output_path, backend, file_name, transcript_format='jsonl'):
+    """
+    Saves the structured transcript of one audio file next to its text transcript.
+    :param transcript_format: One of TRANSCRIPT_FORMATS.
+    :return: Path of the file written.
+    """
+    if transcript_format not in TRANSCRIPT_FORMATS:
+        raise ValueError(f'Unknown transcript format {transcript_format}, expected one of {", ".join(TRANSCRIPT_FORMATS)}')
+
+    output_file_path = os.path.join(output_path, f'{backend}_transcript_{file_name}.{transcript_format}')
+    write_transcripts([transcript], output_file_path)
+    print(f'Structured transcript saved to {output_file_path}')
+    return output_file_path
+
+def combine_transcripts(file_paths, output_file_path):
+    """
+    Combines the structured transcript files of many audio files into one dataset, in the format of its extension (see write_transcripts).
+    Other files in file_paths (text transcripts, raw JSON) are skipped.
+    :return: Number of transcripts written.
+    """
+    transcripts = []
+    for file_path in file_paths:
+        if os.path.splitext(file_path)[1].lower().lstrip('.') in TRANSCRIPT_FORMATS:
+            transcripts.extend(read_transcripts(file_path))
+
+    write_transcripts(transcripts, output_file_path)
+    print(f'{len(transcripts)} transcripts with {sum(len(transcript["segments"]) for transcript in transcripts)} segments saved to {output_file_path}')
+    return len(transcripts)
@@ -1,13 +1,37 @@
 import os  
+import asyncio
 import base64  
+import functools
+import hashlib
+import csv
+import glob
+import json
+import re
+import struct
+import subprocess
+import threading
+import time
 from io import BytesIO  
 from pydub import AudioSegment
+from pydub.silence import detect_silence, detect_nonsilent
+from mutagen import File as MutagenFile
 from mutagen.mp3 import MP3  
 
-from azure.storage.blob import BlobServiceClient, BlobSasPermissions, generate_blob_sas  
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import BlobServiceClient, BlobSasPermissions, ContainerSasPermissions, BlobBlock, ContentSettings, generate_blob_sas, generate_container_sas  
 
 from datetime import datetime, timedelta, timezone
 import requests  
+import urllib.parse
+from openai.types.chat import ChatCompletion
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import metrics
+from scheduling import estimate_audio_chat_tokens
+from speech_jobs import TranscriptionJobTracker
+from transcripts import save_transcript, transcript_from_verbose_json, transcript_from_speech_content, transcript_from_chunks
 
 def split_audio(file_path, chunk_length=30):  
     """  
@@ -19,7 +43,9 @@ def split_audio(file_path, chunk_length=30):
     print('Current working directory:', os.getcwd())  
       
     # Load the audio file  
-    audio = AudioSegment.from_file(file_path)
+    with metrics.span('decode', bytes=os.path.getsize(file_path)) as span:
+        audio = AudioSegment.from_file(file_path)
+        span.set(audio_seconds=len(audio) / 1000)
     print(f'len(audio): {len(audio)}')  # Length of the audio in milliseconds
 
     # bitrate = f"{audio.frame_rate // 1000}k"  # Approximate bit rate (in kbps)  
@@ -53,47 +79,625 @@ def split_audio(file_path, chunk_length=30):
     # print(f'Number of audio chunks: {len(chunks)}')
     return chunks  
   
+def _read_wav_stream_header(stream):  
+    """  
+    Reads the RIFF/WAVE header from a non-seekable stream, leaving the stream positioned at the first sample.  
+    :param stream: Binary stream (e.g. ffmpeg stdout) producing a WAV file.  
+    :return: Tuple of (channels, frame_rate, sample_width).  
+    """  
+    riff_header = stream.read(12)
+    if len(riff_header) < 12 or riff_header[0:4] != b'RIFF' or riff_header[8:12] != b'WAVE':
+        raise ValueError('Decoder output is not a WAV stream')
+
+    channels = frame_rate = sample_width = None
+    while True:
+        chunk_header = stream.read(8)
+        if len(chunk_header) < 8:
+            raise ValueError('WAV stream ended before the data chunk')
+        chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+
+        if chunk_id == b'data':
+            break # Size of the data chunk is unknown when writing to a pipe, samples are read until EOF
+
+        chunk_body = stream.read(chunk_size + (chunk_size % 2)) # Chunks are word aligned
+        if chunk_id == b'fmt ':
+            channels, frame_rate, _, _, bits_per_sample = struct.unpack('<HIIHH', chunk_body[2:16])
+            sample_width = bits_per_sample // 8
+
+    if not channels:
+        raise ValueError('WAV stream has no fmt chunk')
+
+    return channels, frame_rate, sample_width
+
+def find_silence_split_point(segment, window_start_ms, window_end_ms, min_silence_len=300, silence_thresh=-40):  
+    """  
+    Finds where to cut an audio segment so the boundary falls in a pause rather than in the middle of a word.  
+    :param segment: AudioSegment to be cut.  
+    :param window_start_ms: Start of the window (in milliseconds) in which to look for a pause.  
+    :param window_end_ms: End of the window (in milliseconds) in which to look for a pause.  
+    :param min_silence_len: Minimum length of a pause in milliseconds (default is 300 ms).  
+    :param silence_thresh: Level in dBFS below which audio is considered silent (default is -40 dBFS).  
+    :return: Cut position in milliseconds from the start of the segment.  
+    """  
+    window_end_ms = min(window_end_ms, len(segment))
+    window = segment[window_start_ms:window_end_ms]
+    target_ms = (window_start_ms + window_end_ms) // 2 # Pauses closest to the middle of the window are preferred
+
+    step_ms = 50
+    if len(window) <= step_ms:
+        return window_end_ms
+
+    silent_ranges = detect_silence(window, min_silence_len=min_silence_len, silence_thresh=silence_thresh, seek_step=10)
+    if silent_ranges:
+        split_points = [window_start_ms + (silence_start + silence_end) // 2 for silence_start, silence_end in silent_ranges]
+        return min(split_points, key=lambda split_point: abs(split_point - target_ms))
+
+    # No pause below the threshold, cut at the quietest point of the window instead
+    quietest_ms = min(range(0, len(window) - step_ms + 1, step_ms), key=lambda i: window[i:i + step_ms].rms)
+    return window_start_ms + quietest_ms + step_ms // 2
+
+def split_audio_stream(file_path, chunk_length=30, split_on_silence=False, search_window=5, min_silence_len=300, silence_thresh=-40):  
+    """  
+    Splits an audio file into chunks of specified length while it is being decoded.  
+    ffmpeg decodes the file to 16-bit PCM on a pipe and each chunk is yielded as soon as its samples have been read,
+    so peak memory depends on chunk_length and on how many chunks the caller keeps, not on the length of the file.  
+    :param file_path: Path to the input audio file (MP3 or WAV).  
+    :param chunk_length: Length of each chunk in seconds (default is 30 seconds).  
+    :param split_on_silence: Place chunk boundaries in pauses near chunk_length and drop chunks that are silent throughout (default is False).  
+    :param search_window: Seconds either side of chunk_length searched for a pause when split_on_silence is set (default is 5 seconds).  
+    :param min_silence_len: Minimum length of a pause in milliseconds when split_on_silence is set (default is 300 ms).  
+    :param silence_thresh: Level in dBFS below which audio is considered silent when split_on_silence is set (default is -40 dBFS).  
+    :return: Generator of (offset_ms, AudioSegment) tuples, offset_ms being the start of the chunk in the source audio.  
+    """  
+    command = [AudioSegment.converter, '-nostdin', '-v', 'error', '-i', file_path, '-vn', '-acodec', 'pcm_s16le', '-f', 'wav', '-']
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    try:
+        try:
+            channels, frame_rate, sample_width = _read_wav_stream_header(process.stdout)
+        except ValueError:
+            process.wait()
+            raise RuntimeError(f'ffmpeg failed to decode {file_path}: {process.stderr.read().decode(errors="replace")}')
+        print(f'**sample_rate: {frame_rate}, **channels: {channels}, **sample_width: {sample_width}')
+
+        def _read_segment(length_ms):
+            with metrics.span('decode') as span:
+                segment_data = process.stdout.read(int(length_ms * frame_rate / 1000) * channels * sample_width)
+                span.set(bytes=len(segment_data), audio_seconds=len(segment_data) / (frame_rate * channels * sample_width))
+            if not segment_data:
+                return None
+            return AudioSegment(data=segment_data, sample_width=sample_width, frame_rate=frame_rate, channels=channels)
+
+        chunk_length_ms = chunk_length * 1000
+        offset_ms = 0
+
+        if not split_on_silence:
+            while True:
+                chunk = _read_segment(chunk_length_ms)
+                if chunk is None:
+                    break
+
+                yield offset_ms, chunk
+                offset_ms += len(chunk)
+        else:
+            search_window_ms = search_window * 1000
+            pending = None
+            end_of_stream = False
+
+            while True:
+                # Keep enough audio buffered to search for a pause either side of the target length
+                buffered_ms = len(pending) if pending is not None else 0
+                if not end_of_stream and buffered_ms < chunk_length_ms + search_window_ms:
+                    segment = _read_segment(chunk_length_ms + search_window_ms - buffered_ms)
+                    if segment is None:
+                        end_of_stream = True
+                    else:
+                        pending = segment if pending is None else pending + segment
+                    continue
+
+                if pending is None or len(pending) == 0:
+                    break
+
+                if end_of_stream and len(pending) <= chunk_length_ms + search_window_ms:
+                    split_ms = len(pending) # Last chunk, keep the tail rather than sending a short fragment
+                else:
+                    with metrics.span('find_split_point'):
+                        split_ms = find_silence_split_point(pending, chunk_length_ms - search_window_ms, chunk_length_ms + search_window_ms, 
+                                                            min_silence_len=min_silence_len, silence_thresh=silence_thresh)
+
+                chunk, pending = pending[:split_ms], pending[split_ms:]
+
+                with metrics.span('detect_silence', audio_seconds=len(chunk) / 1000):
+                    is_nonsilent = bool(detect_nonsilent(chunk, min_silence_len=min_silence_len, silence_thresh=silence_thresh, seek_step=50))
+                if is_nonsilent:
+                    yield offset_ms, chunk
+                else:
+                    print(f'Dropping silent chunk at {offset_ms / 1000:.1f} seconds')
+                offset_ms += split_ms
+
+        if process.wait() != 0:
+            raise RuntimeError(f'ffmpeg failed to decode {file_path}: {process.stderr.read().decode(errors="replace")}')
+    finally:
+        # Stop the decoder if the caller stopped consuming chunks early
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        process.stdout.close()
+        process.stderr.close()
+  
+def _wav_header(chunk):  
+    """  
+    Builds the 44-byte PCM WAV header for an AudioSegment, so WAV chunks can be exported without re-encoding.  
+    """  
+    data_size = len(chunk.raw_data)
+    return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + data_size, b'WAVE', 
+                       b'fmt ', 16, 1, chunk.channels, chunk.frame_rate, chunk.frame_rate * chunk.frame_width, chunk.frame_width, chunk.sample_width * 8, 
+                       b'data', data_size)
+
 def export_chunk_to_base64(chunk, file_format="mp3", temp_file_path=None):  
     """  
     Exports an audio chunk to Base64 format.  
+    WAV chunks are not re-encoded, the header is built directly and prepended to the PCM samples.
+    Other formats are encoded once and the same bytes are written to temp_file_path when it is set.  
     :param chunk: AudioSegment object representing the chunk.  
     :param file_format: Format to export the chunk (default is "mp3").  
     :param temp_file_path: Path to save the temporary file (optional). 
     :return: Base64-encoded string of the chunk.  
     """  
+    with metrics.span('export_chunk_to_base64', file_format=file_format, audio_seconds=len(chunk) / 1000) as span:
+        chunk_base64 = _export_chunk_to_base64(chunk, file_format, temp_file_path)
+        span.set(bytes=len(chunk_base64))
+    return chunk_base64
 
-    if temp_file_path:  
-        
-        # Extract properties from the chunk  
-        bitrate = f"{chunk.frame_rate // 1000}k"  # Approximate bit rate (in kbps)  
-        sample_rate = chunk.frame_rate            # Sample rate (in Hz)  
-        channels = chunk.channels                 # Number of channels (e.g., mono or stereo) 
-        print(f"Bitrate: {bitrate}, Sample Rate: {sample_rate}, Channels: {channels}")
-  
-        # Export the chunk with extracted properties  
-        chunk.export(  
-            temp_file_path,  
-            format=file_format,  
-            bitrate=bitrate,  
-            parameters=["-ar", str(sample_rate), "-ac", str(channels)]  
-        )  
-    
-    # Save the chunk to a BytesIO object  
-    chunk_buffer = BytesIO()  
-    chunk.export(chunk_buffer, format=file_format)  # Export the chunk  
-      
-    # Get the binary data  
-    chunk_data = chunk_buffer.getvalue()  
+def _export_chunk_to_base64(chunk, file_format, temp_file_path):  
+    if file_format == "wav" and chunk.sample_width > 1: # 8-bit WAV is unsigned and needs converting, leave it to pydub
+        chunk_data = _wav_header(chunk) + chunk.raw_data
+
+        if temp_file_path:
+            with open(temp_file_path, 'wb') as temp_file:
+                temp_file.write(chunk_data)
+
+        return base64.b64encode(chunk_data).decode('ascii')
+
+    # Encode the chunk once, the temporary file gets the same bytes as the request
+    chunk_data = export_chunk_to_bytes(chunk, file_format=file_format)
     # print(f"Chunk size (bytes): {len(chunk_data)}")  
+
+    if temp_file_path:
+        with open(temp_file_path, 'wb') as temp_file:
+            temp_file.write(chunk_data)
       
     # Encode the chunk data to Base64  
-    chunk_base64 = base64.b64encode(chunk_data).decode('utf-8')  
+    chunk_base64 = base64.b64encode(chunk_data).decode('ascii')  
     # print(f"Base64 string length: {len(chunk_base64)}")  
       
     return chunk_base64  
 
+def export_offset_chunk_to_base64(audio_chunk, file_format="mp3"):  
+    """  
+    Exports an (offset_ms, AudioSegment) chunk of split_audio_stream to Base64, for the export stage of transcribe_chunks_pipelined.  
+    """  
+    return _export_chunk_to_base64(audio_chunk[1], file_format, None)
+
+def export_chunk_to_bytes(chunk, file_format="mp3"):  
+    """  
+    Exports an audio chunk to an in-memory file, e.g. for uploading to the Whisper API.  
+    :param chunk: AudioSegment object representing the chunk.  
+    :param file_format: Format to export the chunk (default is "mp3").  
+    :return: Bytes of the encoded chunk.  
+    """  
+    if file_format == "wav" and chunk.sample_width > 1:
+        return _wav_header(chunk) + chunk.raw_data
+
+    with metrics.span('encode_chunk', file_format=file_format, audio_seconds=len(chunk) / 1000) as span:
+        chunk_buffer = BytesIO()  
+        chunk.export(chunk_buffer, format=file_format)  
+        span.set(bytes=chunk_buffer.tell())
+    return chunk_buffer.getvalue()
+
+def run_concurrently(items, fn, max_concurrency=4, item_name='Item'):  
+    """  
+    Calls a function on each item of an iterable through a bounded thread pool, e.g. to transcribe audio chunks, or to upload or download files.  
+    Items are consumed lazily, so at most max_concurrency items are in flight at any time.  
+    :param items: Iterable of items (e.g. the audio chunks returned by split_audio).  
+    :param fn: Function called as fn(index, item) returning the result for that item.  
+    :param max_concurrency: Maximum number of items being processed at the same time (default is 4).  
+    :param item_name: Name of an item in the failure messages, e.g. "Chunk" or "Upload" (default is "Item").  
+    :return: List of results in item order. An item that raised an exception has the exception object as its result.  
+    """  
+    results = {}  
+    in_flight = {}  
+
+    def _collect(done_futures):
+        for future in done_futures:
+            index = in_flight.pop(future)
+            try:
+                results[index] = future.result()
+            except Exception as e:
+                print(f'{item_name} {index + 1} failed: {e}')
+                results[index] = e
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        for index, item in enumerate(items):
+            # Wait for a free slot before taking the next item from the iterable
+            if len(in_flight) >= max_concurrency:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                _collect(done)
+
+            in_flight[executor.submit(fn, index, item)] = index
+
+        done, _ = wait(in_flight)
+        _collect(done)
+
+    # Put the results back in item order
+    return [results[index] for index in sorted(results)]
+
+def transcribe_chunks_pipelined(chunks, export_chunk_fn, send_chunk_fn, skip_chunk_fn=None, write_result_fn=None, max_concurrency=4, 
+                                max_queued_chunks=None):  
+    """  
+    Transcribes audio chunks through a staged pipeline, so decoding, encoding and requests overlap instead of taking turns:
+    decode (reading the iterable) -> export (max_concurrency at a time) -> request (max_concurrency in flight) -> result writing.  
+    The stages run on an asyncio event loop with blocking calls in threads. Compressed formats are encoded by an ffmpeg process per
+    chunk, so exports run in parallel without a process pool; WAV chunks only get a header. The queues between the stages hold at most
+    max_queued_chunks chunks, so a slow stage holds back the stages before it and memory stays flat whatever the file length.  
+    :param chunks: Iterable of audio chunks, decoded lazily (e.g. split_audio_stream).  
+    :param export_chunk_fn: Function called as export_chunk_fn(chunk) returning the request payload.  
+    :param send_chunk_fn: Function called as send_chunk_fn(chunk_index, chunk, payload) returning the result for that chunk.  
+    :param skip_chunk_fn: Function called as skip_chunk_fn(chunk_index, chunk) before the export, returning a result that makes the
+                          export and request unnecessary (e.g. from a checkpoint) or None (optional).  
+    :param write_result_fn: Function called as write_result_fn(chunk_index, result) for each result of send_chunk_fn (optional).  
+    :param max_concurrency: Maximum number of requests in flight, and of chunks being exported (default is 4).  
+    :param max_queued_chunks: Size of each queue between stages (default is max_concurrency).  
+    :return: List of results in chunk order. A chunk that raised an exception has the exception object as its result.  
+    """  
+    max_queued_chunks = max_queued_chunks or max_concurrency
+    results = {}
+
+    def _fail(chunk_index, e):
+        print(f'Chunk {chunk_index + 1} failed: {e}')
+        results[chunk_index] = e
+
+    async def decode(decoded_chunks):
+        chunk_iterator = iter(chunks)
+        chunk_index = 0
+        while True:
+            chunk = await asyncio.to_thread(next, chunk_iterator, None)
+            if chunk is None:
+                return
+            with metrics.span('pipeline_backpressure', stage='decode'):
+                await decoded_chunks.put((chunk_index, chunk))
+            chunk_index += 1
+
+    async def export(decoded_chunks, exported_chunks):
+        while True:
+            item = await decoded_chunks.get()
+            if item is None:
+                return
+            chunk_index, chunk = item
+            try:
+                result = await asyncio.to_thread(skip_chunk_fn, chunk_index, chunk) if skip_chunk_fn else None
+                if result is not None:
+                    results[chunk_index] = result
+                    continue
+
+                with metrics.span('export_chunk') as span:
+                    payload = await asyncio.to_thread(export_chunk_fn, chunk)
+                    span.set(bytes=len(payload))
+            except Exception as e:
+                _fail(chunk_index, e)
+                continue
+
+            with metrics.span('pipeline_backpressure', stage='export'):
+                await exported_chunks.put((chunk_index, chunk, payload))
+
+    async def send(exported_chunks, sent_results):
+        while True:
+            with metrics.span('pipeline_starved', stage='request'):
+                item = await exported_chunks.get()
+            if item is None:
+                return
+            chunk_index, chunk, payload = item
+            try:
+                results[chunk_index] = await asyncio.to_thread(send_chunk_fn, chunk_index, chunk, payload)
+            except Exception as e:
+                _fail(chunk_index, e)
+                continue
+            if write_result_fn:
+                await sent_results.put((chunk_index, results[chunk_index]))
+
+    async def write(sent_results):
+        while True:
+            item = await sent_results.get()
+            if item is None:
+                return
+            try:
+                await asyncio.to_thread(write_result_fn, *item)
+            except Exception as e:
+                print(f'Writing the result of chunk {item[0] + 1} failed: {e}')
+
+    async def close_when_done(stage_tasks, queue, consumer_count):
+        # Tells each consumer of the next stage that no more chunks will come
+        await asyncio.gather(*stage_tasks)
+        for _ in range(consumer_count):
+            await queue.put(None)
+
+    async def run_stages():
+        # Enough threads for every exporter and sender plus the decoder and writer, the default executor has as few as 5
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=2 * max_concurrency + 2))
+        decoded_chunks, exported_chunks, sent_results = [asyncio.Queue(maxsize=max_queued_chunks) for _ in range(3)]
+        decoders = [asyncio.create_task(decode(decoded_chunks))]
+        exporters = [asyncio.create_task(export(decoded_chunks, exported_chunks)) for _ in range(max_concurrency)]
+        senders = [asyncio.create_task(send(exported_chunks, sent_results)) for _ in range(max_concurrency)]
+        writers = [asyncio.create_task(write(sent_results))] if write_result_fn else []
+        tasks = decoders + exporters + senders + writers
+        tasks += [asyncio.create_task(close_when_done(decoders, decoded_chunks, len(exporters))), 
+                  asyncio.create_task(close_when_done(exporters, exported_chunks, len(senders))), 
+                  asyncio.create_task(close_when_done(senders, sent_results, len(writers)))]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # A decoding error stops the pipeline, requests already sent finish in their threads
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run(run_stages())
+
+    # Put the results back in chunk order
+    return [results[chunk_index] for chunk_index in sorted(results)]
+
+def is_completed_chunk_result(completion_result):  
+    """  
+    :return: True if the chat completion of a chunk finished normally. Truncated ("length") and filtered ("content_filter")
+             results and exceptions are not checkpointed or cached, so a rerun sends the chunk again.  
+    """  
+    choices = getattr(completion_result, 'choices', None)
+    return bool(choices) and choices[0].finish_reason == "stop"
+
+def format_completion_result(chunk_index, completion_result):  
+    """  
+    Formats a chat completion result for one audio chunk as a line of the transcript file.  
+    :param chunk_index: Zero-based index of the audio chunk.  
+    :param completion_result: Chat completion returned for the chunk, or the exception raised while transcribing it.  
+    :return: Transcript line for the chunk (without trailing newline).  
+    """  
+    choices = getattr(completion_result, 'choices', None)
+
+    if choices and choices[0].finish_reason == "stop":
+        return f'Audio chunk {chunk_index+1}: ' + choices[0].message.content
+    elif choices and choices[0].finish_reason != "stop":
+        return f'Audio chunk {chunk_index+1}: ' + f'Skipped,{choices[0].finish_reason}'
+    else:
+        return f'Audio chunk {chunk_index+1}: ' + f'Skipped, {completion_result}'
+
+def get_completion_usage(completion_result):  
+    """  
+    Reads the token usage of a chat completion.  
+    :return: Dict with prompt_tokens, completion_tokens and audio_tokens (the audio part of the prompt tokens).  
+    """  
+    completion_usage = getattr(completion_result, 'usage', None)
+    prompt_tokens = getattr(completion_usage, 'prompt_tokens', None) or 0
+    audio_tokens = getattr(getattr(completion_usage, 'prompt_tokens_details', None), 'audio_tokens', None)
+    # Without the breakdown the prompt is counted as audio, which it mostly is
+    return {'prompt_tokens': prompt_tokens, 
+            'completion_tokens': getattr(completion_usage, 'completion_tokens', None) or 0, 
+            'audio_tokens': audio_tokens if audio_tokens is not None else prompt_tokens}
+
+def stitch_transcription_parts(transcription_parts):  
+    """  
+    Joins the verbose_json transcriptions of consecutive parts of an audio file into one transcription.  
+    Segment and word timestamps are shifted by the offset of their part so they refer to the original file.  
+    :param transcription_parts: List of (offset_ms, transcription) tuples in part order, transcription being a TranscriptionVerbose.  
+    :return: Dict in the verbose_json layout with text, duration, language, segments and words.  
+    """  
+    texts, segments, words = [], [], []
+    duration = 0
+    language = None
+
+    for offset_ms, transcription in transcription_parts:
+        offset_seconds = offset_ms / 1000
+        language = language or transcription.language
+        texts.append(transcription.text.strip())
+
+        for segment in transcription.segments or []:
+            segment = segment.model_dump()
+            segment['id'] = len(segments)
+            segment['start'] += offset_seconds
+            segment['end'] += offset_seconds
+            segments.append(segment)
+
+        for word in transcription.words or []:
+            word = word.model_dump()
+            word['start'] += offset_seconds
+            word['end'] += offset_seconds
+            words.append(word)
+
+        duration = max(duration, offset_seconds + float(transcription.duration))
+
+    return {'text': ' '.join(text for text in texts if text), 'duration': duration, 'language': language, 'segments': segments, 'words': words}
+
+# Transcription cache
+def get_file_hash(file_path, block_size=1024 * 1024):  
+    """  
+    Calculates the SHA-256 hash of a file's content without reading the whole file into memory.  
+    :param file_path: Path to the file.  
+    :param block_size: Number of bytes read at a time (default is 1 MB).  
+    :return: Hex digest of the file content.  
+    """  
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+def make_cache_key(**key_parts):  
+    """  
+    Builds a cache key from the audio content hash and the request parameters that affect the transcript.  
+    :param key_parts: Keyword arguments such as audio_hash, deployment, prompt, locale and temperature. Values must be JSON serialisable.  
+    :return: Hex digest identifying the combination of key parts.  
+    """  
+    return hashlib.sha256(json.dumps(key_parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+class TranscriptionCache:  
+    """  
+    On-disk cache of transcription results, one JSON file per key in cache_dir.  
+    Entries older than max_age_days are treated as misses and removed, and the oldest entries
+    are evicted once the cache grows beyond max_size_mb.  
+    """  
+
+    def __init__(self, cache_dir, max_size_mb=500, max_age_days=30):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_mb * 1024 * 1024
+        self.max_age_seconds = max_age_days * 24 * 60 * 60
+        self.hits = 0
+        self.misses = 0
+        self._size_bytes = None # Running size of the entries, counted by the first evict
+        self._lock = threading.Lock() # The cache is shared by the chunk transcription threads
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.json')
+
+    def get(self, key):
+        """  
+        Returns the cached value for key, or None on a miss.  
+        """  
+        entry_path = self._entry_path(key)
+        try:
+            entry_stat = os.stat(entry_path)
+            if time.time() - entry_stat.st_mtime > self.max_age_seconds:
+                os.remove(entry_path)
+                with self._lock:
+                    if self._size_bytes is not None:
+                        self._size_bytes -= entry_stat.st_size
+                raise FileNotFoundError(entry_path)
+
+            with open(entry_path, 'r') as file:
+                value = json.load(file)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """  
+        Stores a JSON serialisable value for key and evicts old entries if the cache is over its size limit.  
+        The size is tracked in memory, the directory is only scanned when an entry takes it over the limit.  
+        """  
+        entry_path = self._entry_path(key)
+        temp_path = f'{entry_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        entry_data = json.dumps(value).encode('utf-8')
+        with open(temp_path, 'wb') as file:
+            file.write(entry_data)
+        os.replace(temp_path, entry_path) # Atomic, readers never see a partially written entry
+
+        with self._lock:
+            # A replaced entry is counted twice, which at worst makes the next eviction scan early
+            if self._size_bytes is not None:
+                self._size_bytes += len(entry_data)
+            if self._size_bytes is None or self._size_bytes > self.max_size_bytes:
+                self.evict()
+
+    def evict(self):
+        """  
+        Removes expired entries, then the oldest entries until the cache is 10% below max_size_mb, so the next scan is
+        only needed after that much more is written. Called with the lock held.  
+        """  
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                entry_stat = entry.stat()
+            except OSError:
+                continue
+            if time.time() - entry_stat.st_mtime > self.max_age_seconds:
+                self._remove_entry(entry.path)
+                continue
+            entries.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+
+        total_size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, entry_path in sorted(entries):
+            if total_size <= self.max_size_bytes * 0.9:
+                break
+            self._remove_entry(entry_path)
+            total_size -= entry_size
+        self._size_bytes = total_size
+
+    def _remove_entry(self, entry_path):
+        try:
+            os.remove(entry_path)
+        except FileNotFoundError:
+            pass # Already removed by another process sharing the cache directory
+
+    def print_stats(self):
+        print(f'Transcription cache hits: {self.hits}, misses: {self.misses}')
+
+class SpeechRestClient:  
+    """  
+    Pooled HTTP session shared by the Speech REST helpers, so polling and downloads reuse keep-alive connections instead of
+    opening a new TCP and TLS connection per request.  
+    Every request has a (connect, read) timeout. GET and DELETE requests are retried on connection errors and on 429 and 5xx
+    responses with exponential backoff, honouring Retry-After. POST requests are not retried, so a job is never submitted twice.  
+    Each request is timed as the metrics stage given by stage (default "speech_request"), and its retries and throttled responses are counted.  
+    """  
+
+    def __init__(self, timeout=(10, 60), max_retries=3, backoff_factor=1, pool_maxsize=16):
+        self.timeout = timeout
+        retry = Retry(total=max_retries, backoff_factor=backoff_factor, status_forcelist=(429, 500, 502, 503, 504), 
+                      allowed_methods=frozenset({'GET', 'DELETE'}), respect_retry_after_header=True, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_maxsize, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, url, stage='speech_request', **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        with metrics.span(stage, method=method) as span:
+            response = self.session.request(method, url, **kwargs)
+            span.set(status_code=response.status_code)
+
+        # urllib3 keeps the responses it retried on in the retry history of the final response
+        retry_history = getattr(getattr(response.raw, 'retries', None), 'history', None) or ()
+        if retry_history:
+            metrics.increment('retries', len(retry_history), service='speech')
+        throttles = sum(1 for retry in retry_history if retry.status == 429) + (response.status_code == 429)
+        if throttles:
+            metrics.increment('throttles', throttles, service='speech')
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+_speech_rest_client = None
+_speech_rest_client_lock = threading.Lock()
+
+def get_speech_rest_client():  
+    """  
+    Returns the SpeechRestClient shared by the REST helpers when no client is passed to them, creating it on first use.  
+    """  
+    global _speech_rest_client
+    with _speech_rest_client_lock:
+        if _speech_rest_client is None:
+            _speech_rest_client = SpeechRestClient()
+        return _speech_rest_client
+
 # List Base Models request to get available base models for all locales
-def get_speech_to_text_models(api_url, api_version, subscription_key):  
+def get_speech_to_text_models(api_url, api_version, subscription_key, rest_client=None):  
     """  
     Fetches speech-to-text models from the specified API endpoint.  
   
@@ -101,9 +705,10 @@ def get_speech_to_text_models(api_url, api_version, subscription_key):
         api_url (str): The base URL of the API (e.g., "https://eastus.api.cognitive.microsoft.com").  
         api_version (str): The API version (e.g., "2024-11-15").  
         subscription_key (str): Azure AI Foundry resource key / Azure Speech resource subscription key.  
+        rest_client (SpeechRestClient): Client whose pooled session is used (default is the shared client).  
   
     Returns:  
-        dict: The JSON response from the API if successful.  
+        dict: The JSON response from the API if successful, with "values" holding the models of all pages.  
         None: If the request fails.  
     """  
     # Construct the full URL  
@@ -120,22 +725,146 @@ def get_speech_to_text_models(api_url, api_version, subscription_key):
         "Ocp-Apim-Subscription-Key": subscription_key  
     }  
       
+    models_response = None
     try:  
-        # Make the GET request  
-        response = requests.get(url, headers=headers)  
-          
-        # Check if the request was successful  
-        if response.status_code == 200:  
-            return response.json()  # Return the JSON response  
-        else:  
-            print(f"Error: {response.status_code} - {response.text}")  
-            return None  
+        # The model list is returned in pages
+        while url:
+            # Make the GET request  
+            response = (rest_client or get_speech_rest_client()).get(url, headers=headers, stage='speech_list_models')  
+              
+            # Check if the request was successful  
+            if response.status_code != 200:  
+                print(f"Error: {response.status_code} - {response.text}")  
+                return None  
+
+            page = response.json()
+            if models_response is None:
+                models_response = page
+            else:
+                models_response["values"].extend(page.get("values", []))
+            url = page.get("@nextLink")
+
+        models_response.pop("@nextLink", None)
+        return models_response  
     except requests.exceptions.RequestException as e:  
         print(f"Request failed: {e}")  
         return None  
 
+def get_speech_region(api_url):  
+    """  
+    Returns the region of a Speech endpoint (e.g. "eastus" for https://eastus.api.cognitive.microsoft.com), or the host name with
+    its port made file name safe for other hosts, such as a custom domain or the local mock services.  
+    """  
+    parsed_url = urllib.parse.urlsplit(api_url)
+    if (parsed_url.hostname or '').endswith('.api.cognitive.microsoft.com'):
+        return parsed_url.hostname.split('.')[0]
+    return re.sub(r'[^A-Za-z0-9.-]', '_', parsed_url.netloc or api_url)
+
+class SpeechModelCatalog:  
+    """  
+    Base speech-to-text models of a region, cached on disk for ttl_hours and indexed by display name and locale.  
+    Jobs resolve a model URL locally (e.g. "Whisper Large V2" for "en-AU") instead of listing the models or relying on a hard-coded URL.
+    The cached list is used past its TTL when the models cannot be listed. With cache_dir None the models are listed once per catalog.  
+    """  
+
+    def __init__(self, api_url, api_version, subscription_key, cache_dir='../cache/models', ttl_hours=24):
+        self.api_url = api_url
+        self.api_version = api_version
+        self.subscription_key = subscription_key
+        self.region = get_speech_region(api_url)
+        self.cache_file_path = os.path.join(cache_dir, f'speech_to_text_models_{self.region}.json') if cache_dir else None
+        self.ttl_seconds = ttl_hours * 60 * 60
+        self.models = None
+        self._models_by_locale = {}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def load(self, refresh=False):  
+        """  
+        Loads the models from the cache file, listing them from the API when the file is missing, unreadable, expired or refresh is True.  
+        :return: List of model JSON.  
+        """  
+        cached_models = None
+        if self.cache_file_path and os.path.exists(self.cache_file_path):
+            try:
+                with open(self.cache_file_path, 'r') as file:
+                    cached_models = json.load(file)
+                if not isinstance(cached_models, dict) or 'fetched_at' not in cached_models or 'values' not in cached_models:
+                    raise ValueError('unexpected content')
+            except (OSError, ValueError) as e:
+                print(f'Ignoring the speech-to-text models cache {self.cache_file_path}: {e}')
+                cached_models = None
+
+        if cached_models and not refresh and time.time() - cached_models['fetched_at'] < self.ttl_seconds:
+            self._index(cached_models['values'])
+            return self.models
+
+        models_response = get_speech_to_text_models(api_url=self.api_url, api_version=self.api_version, subscription_key=self.subscription_key)
+        if models_response is None:
+            if cached_models is None:
+                raise RuntimeError(f'Could not list the speech-to-text models of {self.region}')
+            print(f'Could not list the speech-to-text models, using the cached list from {datetime.fromtimestamp(cached_models["fetched_at"])}')
+            self._index(cached_models['values'])
+            return self.models
+
+        if self.cache_file_path:
+            temp_file_path = f'{self.cache_file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(temp_file_path, 'w') as file:
+                json.dump({'fetched_at': time.time(), 'values': models_response.get('values', [])}, file)
+            os.replace(temp_file_path, self.cache_file_path) # Atomic, an interrupted write leaves the previous list
+        print(f'Listed {len(models_response.get("values", []))} speech-to-text models of {self.region}')
+
+        self._index(models_response.get('values', []))
+        return self.models
+
+    def _index(self, models):
+        # Newest first, so lookups return the latest version of a model
+        self.models = sorted(models, key=lambda model: model.get('createdDateTime', ''), reverse=True)
+        self._models_by_locale = {}
+        for model in self.models:
+            self._models_by_locale.setdefault(model.get('locale', '').lower(), []).append(model)
+
+    def find(self, display_name=None, locale=None, feature='supportsTranscriptions'):  
+        """  
+        Finds models, newest first.  
+        :param display_name: Text the display name contains, case insensitive (e.g. "Whisper Large V2").  
+        :param locale: Locale of the model (e.g. "en-AU").  
+        :param feature: Feature the model must support, a key of properties.features (default is "supportsTranscriptions", None for any).  
+        :return: List of model JSON.  
+        """  
+        if self.models is None:
+            self.load()
+
+        models = self._models_by_locale.get(locale.lower(), []) if locale else self.models
+        if display_name:
+            models = [model for model in models if display_name.lower() in model.get('displayName', '').lower()]
+        if feature:
+            models = [model for model in models if model.get('properties', {}).get('features', {}).get(feature)]
+
+        return models
+
+    def resolve_model_url(self, display_name, locale, default_model_url=None):  
+        """  
+        Returns the URL of the newest model matching display_name and locale.  
+        :param default_model_url: Returned when no model matches or the models cannot be listed (optional).  
+        :return: Model URL.  
+        """  
+        try:
+            models = self.find(display_name=display_name, locale=locale)
+        except RuntimeError as e:
+            models = []
+            print(e)
+
+        if models:
+            print(f'Model for "{display_name}", {locale}: {models[0].get("displayName")} - {models[0]["self"]}')
+            return models[0]['self']
+        if default_model_url:
+            print(f'No model found for "{display_name}", {locale}, using {default_model_url}')
+            return default_model_url
+        raise ValueError(f'No speech-to-text model found for "{display_name}", {locale}')
+
   
-def submit_transcription_request(api_url, api_version, subscription_key, content_urls, locale, transcription_display_name, model_url, word_level_timestamps_enabled=True, is_whisper=False):  
+def submit_transcription_request(api_url, api_version, subscription_key, content_urls, locale, transcription_display_name, model_url, word_level_timestamps_enabled=True, is_whisper=False, content_container_url=None, rest_client=None):  
     """  
     Submits a transcription request to the Azure Speech-to-Text API.  
   
@@ -143,11 +872,13 @@ def submit_transcription_request(api_url, api_version, subscription_key, content
         api_url (str): The base URL of the API (e.g. "https://eastus.api.cognitive.microsoft.com").  
         api_version (str): The API version (e.g. "2024-11-15").  
         subscription_key (str): Azure AI Foundry resource key / Azure Speech resource subscription key.  
-        content_urls (list): List of URLs pointing to audio files to be transcribed.  
+        content_urls (list): List of URLs pointing to audio files to be transcribed (up to 1000 per transcription).  
         locale (str): Locale of the audio files (e.g. "en-US").  
         display_name (str): A name for the transcription job.  
         model_url (str): URL of the specific speech-to-text model to use.  (e.g. "https://eastus.api.cognitive.microsoft.com/speechtotext/models/base/69adf293-9664-4040-932b-02ed16332e00?api-version=2024-11-15")
         word_level_timestamps_enabled (bool): Whether to enable word-level timestamps in the transcription.  
+        content_container_url (str): SAS URL of a container, all audio files in it are transcribed. Used instead of content_urls when set.  
+        rest_client (SpeechRestClient): Client whose pooled session is used (default is the shared client).  
   
     Returns:  
         dict: The JSON response from the API if successful.  
@@ -160,7 +891,6 @@ def submit_transcription_request(api_url, api_version, subscription_key, content
   
     # Prepare the request payload  
     payload = {  
-        "contentUrls": content_urls,  
         "locale": locale,  
         "displayName": transcription_display_name,  
         "model": {  
@@ -180,6 +910,12 @@ def submit_transcription_request(api_url, api_version, subscription_key, content
         }  
     } 
 
+    # Either a list of files or a whole container
+    if content_container_url:
+        payload["contentContainerUrl"] = content_container_url
+    else:
+        payload["contentUrls"] = content_urls
+
     # Word level timestamp property name depends on the model type
     if is_whisper:
         payload["properties"]["displayFormWordLevelTimestampsEnabled"] = word_level_timestamps_enabled
@@ -194,7 +930,7 @@ def submit_transcription_request(api_url, api_version, subscription_key, content
   
     try:  
         # Make the POST request  
-        response = requests.post(url, headers=headers, json=payload)  
+        response = (rest_client or get_speech_rest_client()).post(url, headers=headers, json=payload, stage='speech_submit')  
   
         # Check if the request was successful  
         if response.status_code == 201:  
@@ -207,14 +943,15 @@ def submit_transcription_request(api_url, api_version, subscription_key, content
         return None
     
 # Get submitted transcription identified by given ID
-def get_transcription(api_url, api_version, submission_id, subscription_key):  
+def get_transcription(api_url, api_version, submission_id, subscription_key, rest_client=None):  
     """  
     Submits a transcription request to the Azure Speech-to-Text API.  
   
     Args:  
         api_url (str): The base URL of the API (e.g. "https://eastus.api.cognitive.microsoft.com").  
         api_version (str): The API version (e.g. "2024-11-15").  
-        subscription_key (str): Azure AI Foundry resource key / Azure Speech resource subscription key.          
+        subscription_key (str): Azure AI Foundry resource key / Azure Speech resource subscription key.  
+        rest_client (SpeechRestClient): Client whose pooled session is used (default is the shared client).  
   
     Returns:  
         dict: The JSON response from the API if successful.  
@@ -234,7 +971,7 @@ def get_transcription(api_url, api_version, submission_id, subscription_key):
   
     try:  
         # Make the GET request  
-        response = requests.get(url, headers=headers)  
+        response = (rest_client or get_speech_rest_client()).get(url, headers=headers, stage='speech_poll')  
   
         # Check if the request was successful  
         if response.status_code == 200:
@@ -247,18 +984,19 @@ def get_transcription(api_url, api_version, submission_id, subscription_key):
         return None
 
 # Get transcription files
-def get_transcription_files(api_url, api_version, submission_id, subscription_key):  
+def get_transcription_files(api_url, api_version, submission_id, subscription_key, rest_client=None):  
     """  
-    Submits a transcription request to the Azure Speech-to-Text API.  
+    Gets the result files of a transcription, following @nextLink until all pages have been read.  
   
     Args:  
         api_url (str): The base URL of the API (e.g. "https://eastus.api.cognitive.microsoft.com").  
         api_version (str): The API version (e.g. "2024-11-15").  
         submission_id (str): The ID of the transcription submission.        
-        subscription_key (str): Azure AI Foundry resource key / Azure Speech resource subscription key.          
+        subscription_key (str): Azure AI Foundry resource key / Azure Speech resource subscription key.  
+        rest_client (SpeechRestClient): Client whose pooled session is used (default is the shared client).  
   
     Returns:  
-        dict: The JSON response from the API if successful.  
+        dict: The JSON response from the API if successful, with "values" holding the files of all pages.  
         None: If the request fails.  
     """  
     # Construct the full URL for the transcription submission endpoint  
@@ -273,24 +1011,35 @@ def get_transcription_files(api_url, api_version, submission_id, subscription_ke
         "Content-Type": "application/json"  
     }  
   
+    files_response = None
     try:  
-        # Make the GET request  
-        response = requests.get(url, headers=headers)  
+        # Jobs with many audio files return their result files in pages
+        while url:
+            # Make the GET request  
+            response = (rest_client or get_speech_rest_client()).get(url, headers=headers, stage='speech_list_files')  
   
-        # Check if the request was successful  
-        if response.status_code == 200:
-            return response.json()  # Return the JSON response  
-        else:  
-            print(f"Error: {response.status_code} - {response.text}")  
-            return None  
+            # Check if the request was successful  
+            if response.status_code != 200:
+                print(f"Error: {response.status_code} - {response.text}")  
+                return None  
+
+            page = response.json()
+            if files_response is None:
+                files_response = page
+            else:
+                files_response["values"].extend(page.get("values", []))
+            url = page.get("@nextLink")
+
+        files_response.pop("@nextLink", None)
+        return files_response  
     except requests.exceptions.RequestException as e:  
         print(f"Request failed: {e}")  
         return None 
 
 # To download the transcription file from the content URL SAS URI
-def download_file_from_web(url, save_path):  
+def download_file_from_web(url, save_path, rest_client=None):  
     try:  
-        response = requests.get(url, stream=True)  
+        response = (rest_client or get_speech_rest_client()).get(url, stream=True)  
         response.raise_for_status()  # Raise an error for bad status codes  
         with open(save_path, 'wb') as file:  
             for chunk in response.iter_content(chunk_size=8192):  
@@ -299,6 +1048,215 @@ def download_file_from_web(url, save_path):
     except requests.exceptions.RequestException as e:  
         print(f"Error downloading file: {e}")     
 
+# Download a transcription result file into memory, optionally saving the raw JSON while it streams in
+def download_transcription_result(url, save_path=None, rest_client=None, chunk_size=64 * 1024):  
+    """  
+    Downloads and parses a transcription result file without reading it back from disk.  
+  
+    Args:  
+        url (str): Content URL (SAS URI) of the result file.  
+        save_path (str): Path the raw JSON is written to as it is downloaded (optional).  
+        rest_client (SpeechRestClient): Client whose pooled session is used (default is the shared client).  
+  
+    Returns:  
+        dict: The parsed transcription JSON. Raises on download errors.  
+    """  
+    with metrics.span('speech_download') as span:
+        response = (rest_client or get_speech_rest_client()).get(url, stream=True, stage='speech_download_request')  
+        response.raise_for_status()
+
+        content = bytearray()
+        raw_file = open(save_path, 'wb') if save_path else None
+        try:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                content += chunk
+                if raw_file:
+                    raw_file.write(chunk)
+        finally:
+            if raw_file:
+                raw_file.close()
+        span.set(bytes=len(content))
+
+    return json.loads(content)
+
+def download_transcription_results(urls, save_paths=None, max_workers=8, rest_client=None):  
+    """  
+    Downloads and parses the result files of a transcription in parallel.  
+    :param urls: Content URLs of the result files.  
+    :param save_paths: Paths the raw JSON files are saved to, or None per file / overall to keep them in memory only.  
+    :param max_workers: Number of files downloaded at the same time (default is 8).  
+    :return: List of parsed transcription JSON, or the exception raised, in the order of urls.  
+    """  
+    save_paths = save_paths or [None] * len(urls)
+
+    def download_result(_i, url):
+        return download_transcription_result(url, save_path=save_paths[_i], rest_client=rest_client)
+
+    return run_concurrently(urls, download_result, max_concurrency=max_workers, item_name='Download')
+
+def get_transcription_report_details(transcription_report):  
+    """  
+    Reads the outcome of each file from the TranscriptionReport file of a job.  
+    :param transcription_report: Parsed report (successfulTranscriptionsCount, failedTranscriptionsCount, details).  
+    :return: Dict of source blob URL without SAS -> dict with status ("Succeeded" or "Failed") and error.  
+    """  
+    return {get_blob_url_without_sas(detail.get('source', '')): {'status': detail.get('status'), 
+                                                                 'error': ': '.join(filter(None, [detail.get('errorKind'), detail.get('errorMessage')])) or None}
+            for detail in transcription_report.get('details') or []}
+
+def get_speech_model_id(model_url):  
+    """  
+    Returns the ID at the end of a Speech model URL, used as the deployment in the usage ledger.  
+    """  
+    return model_url.split('?')[0].rstrip('/').split('/')[-1] if model_url else None
+
+SPEECH_TICKS_PER_SECOND = 10_000_000
+
+def extract_transcription_content(transcription_data):  
+    """  
+    Extracts the text, phrases and word timestamps of a transcription JSON in one pass over its recognized phrases.  
+    :param transcription_data: Transcription JSON of one result file.  
+    :return: Dict with text, duration, phrases (start, end, channel, speaker, confidence, text) and words (start, end, word, confidence, phrase index), times in seconds.  
+    """  
+    phrases = []
+    words = []
+    for _p, recognized_phrase in enumerate(transcription_data.get('recognizedPhrases', [])):
+        best = (recognized_phrase.get('nBest') or [{}])[0]
+        phrase_start = recognized_phrase.get('offsetInTicks', 0) / SPEECH_TICKS_PER_SECOND
+        phrases.append({'start': round(phrase_start, 3), 
+                        'end': round(phrase_start + recognized_phrase.get('durationInTicks', 0) / SPEECH_TICKS_PER_SECOND, 3), 
+                        'channel': recognized_phrase.get('channel'), 
+                        'speaker': recognized_phrase.get('speaker'), 
+                        'confidence': best.get('confidence'), 
+                        'text': best.get('display', '')})
+
+        # Whisper models return the display form words, other models the lexical words
+        for word in best.get('displayWords') or best.get('words') or []:
+            word_start = word.get('offsetInTicks', 0) / SPEECH_TICKS_PER_SECOND
+            words.append({'start': round(word_start, 3), 
+                          'end': round(word_start + word.get('durationInTicks', 0) / SPEECH_TICKS_PER_SECOND, 3), 
+                          'word': word.get('displayText', word.get('word', '')), 
+                          'confidence': word.get('confidence'), 
+                          'phrase': _p})
+
+    return {'text': (transcription_data.get('combinedRecognizedPhrases') or [{}])[0].get('display', ''), 
+            'duration': transcription_data.get('durationInTicks', 0) / SPEECH_TICKS_PER_SECOND, 
+            'phrases': phrases, 
+            'words': words}
+
+# Register a web hook that the Speech service calls when a transcription completes
+def register_transcription_webhook(api_url, api_version, subscription_key, web_url, secret=None, display_name='Transcription completion', rest_client=None):  
+    """  
+    Registers a web hook for transcription completion events with the Azure Speech-to-Text API.  
+    The service validates the web hook first by sending a challenge request to web_url, so the receiver needs to be running and reachable.  
+  
+    Args:  
+        api_url (str): The base URL of the API (e.g. "https://eastus.api.cognitive.microsoft.com").  
+        api_version (str): The API version (e.g. "2024-11-15").  
+        subscription_key (str): Azure AI Foundry resource key / Azure Speech resource subscription key.  
+        web_url (str): Public URL of the web hook receiver.  
+        secret (str): Secret used by the service to sign the events (optional).  
+        display_name (str): A name for the web hook.  
+        rest_client (SpeechRestClient): Client whose pooled session is used (default is the shared client).  
+  
+    Returns:  
+        dict: The JSON response from the API if successful.  
+        None: If the request fails.  
+    """  
+    url = f"{api_url}/speechtotext/v3.2/webhooks"
+    print(f'Web hook registration URL: {url}')
+
+    payload = {  
+        "webUrl": web_url,  
+        "displayName": display_name,  
+        "events": {  
+            "transcriptionCompletion": True  
+        }  
+    }
+    if secret:
+        payload["properties"] = {"secret": secret}
+
+    headers = {  
+        "Ocp-Apim-Subscription-Key": subscription_key,  
+        "Content-Type": "application/json"  
+    }  
+
+    try:  
+        response = (rest_client or get_speech_rest_client()).post(url, headers=headers, json=payload, stage='speech_webhook')  
+
+        if response.status_code == 201:  
+            return response.json()  
+        else:  
+            print(f"Error: {response.status_code} - {response.text}")  
+            return None  
+    except requests.exceptions.RequestException as e:  
+        print(f"Request failed: {e}")  
+        return None
+
+# Delete a web hook identified by given ID
+def delete_webhook(api_url, api_version, webhook_id, subscription_key, rest_client=None):  
+    """  
+    Deletes a web hook registered with the Azure Speech-to-Text API.  
+  
+    Returns:  
+        bool: True if the web hook was deleted.  
+    """  
+    url = f"{api_url}/speechtotext/v3.2/webhooks/{webhook_id}"
+
+    headers = {  
+        "Ocp-Apim-Subscription-Key": subscription_key  
+    }  
+
+    try:  
+        response = (rest_client or get_speech_rest_client()).delete(url, headers=headers, stage='speech_webhook')  
+
+        if response.status_code == 204:  
+            return True  
+        else:  
+            print(f"Error: {response.status_code} - {response.text}")  
+            return False  
+    except requests.exceptions.RequestException as e:  
+        print(f"Request failed: {e}")  
+        return False
+
+# Save the combined display text of a downloaded transcription JSON to a text file
+def save_transcription_text(transcription_data, output_file_path):
+    transcription_text = transcription_data.get('combinedRecognizedPhrases', [{}])[0].get('display', '')
+    with open(output_file_path, 'w') as text_file:
+        text_file.write(transcription_text)
+    print(f'Transcription text saved to {output_file_path}')
+
+# Save the transcript text of each result file and its structured transcript (phrases, speakers and word timestamps),
+# or when transcript_format is None, a compact segments JSON if the raw JSON is not kept
+def save_speech_transcription_outputs(transcription_data_by_file, output_path, backend, file_name, save_raw_json=True, transcript_format='jsonl', 
+                                      model=None, locale=None):
+    output_file_paths = []
+    for _f, transcription_data in transcription_data_by_file.items():
+        output_file_path_txt = os.path.join(output_path, f'{backend}_transcript_{_f}_' + file_name +'.txt')
+        if save_raw_json and not transcript_format:
+            save_transcription_text(transcription_data, output_file_path_txt)
+            output_file_paths.append(output_file_path_txt)
+            continue
+
+        transcription_content = extract_transcription_content(transcription_data)
+        with open(output_file_path_txt, 'w') as text_file:
+            text_file.write(transcription_content['text'])
+        print(f'Transcription text saved to {output_file_path_txt}')
+        output_file_paths.append(output_file_path_txt)
+
+        if transcript_format:
+            transcript = transcript_from_speech_content(transcription_content, file_name, backend, model=model, locale=locale)
+            output_file_paths.append(save_transcript(transcript, output_path, backend, f'{_f}_{file_name}', transcript_format=transcript_format))
+            continue
+
+        output_file_path_segments = os.path.join(output_path, f'{backend}_segments_{_f}_' + file_name +'.json')
+        with open(output_file_path_segments, 'w') as file:
+            json.dump({'phrases': transcription_content['phrases'], 'words': transcription_content['words']}, file)
+        print(f'Segments saved to {output_file_path_segments}')
+        output_file_paths.append(output_file_path_segments)
+
+    return output_file_paths
+
 # Azure storage
 def get_blob_service_client(storage_account_sas_url):
     # Create a BlobServiceClient object
@@ -306,12 +1264,117 @@ def get_blob_service_client(storage_account_sas_url):
 
     return blob_service_client_sas
 
+def get_stream_md5(stream, read_size=4 * 1024 * 1024):  
+    """  
+    Returns the MD5 digest of a seekable binary stream and rewinds it to where it was.  
+    """  
+    start_position = stream.tell()
+    md5 = hashlib.md5()
+    for block in iter(lambda: stream.read(read_size), b''):
+        md5.update(block)
+    stream.seek(start_position)
+
+    return md5.digest()
+
+def get_existing_blob_md5(blob_client):  
+    """  
+    Returns the Content-MD5 stored on a blob, or None when the blob does not exist or has no MD5.  
+    """  
+    try:
+        content_md5 = blob_client.get_blob_properties().content_settings.content_md5
+    except ResourceNotFoundError:
+        return None
+
+    return bytes(content_md5) if content_md5 else None
+
 # Azure storage
-def upload_binary_data_to_azure_storage(blob_service_client, storage_container, storage_path, storage_file_name, binary_data):
-    blob_client = blob_service_client.get_blob_client(container=storage_container, blob=storage_path+'/'+storage_file_name)
+def upload_binary_data_to_azure_storage(blob_service_client, storage_container, storage_path, storage_file_name, binary_data, 
+                                        block_size=4 * 1024 * 1024, max_concurrency=4, skip_if_unchanged=True):
+    """  
+    Uploads bytes or a binary file handle to a block blob.  
+    File handles are read one block at a time and the blocks are staged in parallel, so at most max_concurrency blocks are in memory.
+    The MD5 of the content is stored on the blob, and the upload is skipped when the blob already has the same MD5.  
+    :param binary_data: Bytes or a binary file handle opened for reading.  
+    :param block_size: Size of each staged block in bytes (default is 4 MiB). Content up to one block is uploaded in a single request.  
+    :param max_concurrency: Number of blocks uploaded at the same time (default is 4).  
+    :param skip_if_unchanged: Skip the upload when the existing blob has the same MD5 (default is True).  
+    :return: True if the content was uploaded, False if the upload was skipped.  
+    """  
+    with metrics.span('upload', storage_file_name=storage_file_name) as span:
+        uploaded_bytes = _upload_stream_to_blob(blob_service_client.get_blob_client(container=storage_container, blob=storage_path+'/'+storage_file_name), 
+                                                BytesIO(binary_data) if isinstance(binary_data, (bytes, bytearray)) else binary_data, 
+                                                block_size, max_concurrency, skip_if_unchanged)
+        span.set(bytes=uploaded_bytes, skipped=uploaded_bytes is None)
+    if uploaded_bytes is None:
+        print(f'Skipped upload of {storage_path}/{storage_file_name}, the blob is unchanged')
+    return uploaded_bytes is not None
 
-    # Upload the blob data - default blob type is BlockBlob
-    blob_client.upload_blob(binary_data, blob_type="BlockBlob", overwrite=True)
+def _upload_stream_to_blob(blob_client, stream, block_size, max_concurrency, skip_if_unchanged):  
+    """  
+    Uploads a stream for upload_binary_data_to_azure_storage.  
+    :return: Number of bytes uploaded, or None when the upload was skipped.  
+    """  
+    # Hash the content before uploading only when there is a blob to compare with
+    if skip_if_unchanged and stream.seekable():
+        existing_md5 = get_existing_blob_md5(blob_client)
+        if existing_md5 and existing_md5 == get_stream_md5(stream):
+            return None
+
+    md5 = hashlib.md5()
+    first_block = stream.read(block_size)
+    next_block = stream.read(block_size) if len(first_block) == block_size else b''
+    md5.update(first_block)
+
+    # Small content - default blob type is BlockBlob
+    if not next_block:
+        blob_client.upload_blob(first_block, blob_type="BlockBlob", overwrite=True, 
+                                content_settings=ContentSettings(content_md5=bytearray(md5.digest())))
+        return len(first_block)
+
+    # Large content - stage blocks in parallel and commit the block list
+    block_ids = []
+    uploaded_bytes = 0
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        in_flight = set()
+        block = first_block
+        while block:
+            block_id = base64.b64encode(f'{len(block_ids):08d}'.encode()).decode()
+            block_ids.append(block_id)
+            uploaded_bytes += len(block)
+            in_flight.add(executor.submit(blob_client.stage_block, block_id=block_id, data=block, length=len(block)))
+
+            if len(in_flight) >= max_concurrency:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result() # Raise staging errors before reading more blocks
+
+            block, next_block = next_block, (stream.read(block_size) if next_block else b'')
+            md5.update(block)
+
+        for future in in_flight:
+            future.result()
+
+    blob_client.commit_block_list([BlobBlock(block_id=block_id) for block_id in block_ids], 
+                                  content_settings=ContentSettings(content_md5=bytearray(md5.digest())))
+    return uploaded_bytes
+
+def upload_files_to_azure_storage(blob_service_client, storage_container, uploads, max_workers=4, **upload_kwargs):  
+    """  
+    Uploads many local files to Azure Blob Storage at the same time, streaming each from disk.  
+    :param uploads: List of (file_path, storage_path, storage_file_name) tuples.  
+    :param max_workers: Number of files uploaded at the same time (default is 4).  
+    :param upload_kwargs: Passed to upload_binary_data_to_azure_storage (block_size, max_concurrency, skip_if_unchanged).  
+    :return: List of True (uploaded), False (skipped as unchanged) or the exception raised, in the order of uploads.  
+    """  
+
+    def upload_file(_i, upload):
+        file_path, storage_path, storage_file_name = upload
+        with open(file_path, "rb") as audio_file:
+            return upload_binary_data_to_azure_storage(blob_service_client=blob_service_client, storage_container=storage_container, 
+                                                       storage_path=storage_path, storage_file_name=storage_file_name, 
+                                                       binary_data=audio_file, **upload_kwargs)
+
+    return run_concurrently(uploads, upload_file, max_concurrency=max_workers, item_name='Upload')
  
 # Generate a SAS URI for a file in Azure Storage.  
 # Returns SAS URI for the specified blob.  
@@ -336,4 +1399,817 @@ def generate_sas_uri(storage_account_name, storage_account_key, container_name,
     # Construct the SAS URI  
     sas_uri = f"https://{storage_account_name}.blob.core.windows.net/{container_name}/{blob_name_with_path}?{sas_token}"  
   
-    return sas_uri  
\ No newline at end of file
+    return sas_uri
+
+def estimate_sas_expiry_minutes(audio_duration_seconds=None, queued_jobs=1, minutes_per_queued_job=15, min_expiry_minutes=60, max_expiry_minutes=24 * 60):  
+    """  
+    Estimates how long a SAS URI given to Speech batch transcription needs to stay valid.  
+    The service reads the audio when a job starts, which can be long after submission when many jobs are queued, and long audio
+    is read while it is being processed. The estimate allows minutes_per_queued_job per job submitted together plus the audio duration.  
+    :param audio_duration_seconds: Total audio duration of the submitted jobs (optional).  
+    :param queued_jobs: Number of jobs submitted together (default is 1).  
+    :return: Expiry in minutes, between min_expiry_minutes and max_expiry_minutes.  
+    """  
+    expiry_minutes = queued_jobs * minutes_per_queued_job + (audio_duration_seconds or 0) / 60
+
+    return int(min(max_expiry_minutes, max(min_expiry_minutes, expiry_minutes)))
+
+class SasProvider:  
+    """  
+    Read SAS URIs for the blobs of one container, signed once per container instead of once per blob.  
+    The container SAS is signed for refresh_margin_minutes more than requested, and reused for every blob as long as it still
+    covers the validity requested, so thousands of files are signed with one HMAC. Without an account key, a user delegation key is requested
+    through blob_service_client, which then needs an Azure AD credential (e.g. DefaultAzureCredential from azure-identity).  
+    """  
+
+    def __init__(self, storage_account_name, container_name, storage_account_key=None, blob_service_client=None, refresh_margin_minutes=10):
+        if not storage_account_key and not blob_service_client:
+            raise ValueError('SasProvider needs a storage account key or a blob service client for a user delegation key')
+
+        self.storage_account_name = storage_account_name
+        self.container_name = container_name
+        self.storage_account_key = storage_account_key
+        self.blob_service_client = blob_service_client
+        self.refresh_margin = timedelta(minutes=refresh_margin_minutes)
+        self.tokens_signed = 0
+        self._tokens = {} # Permission string -> (SAS token, expiry time)
+        self._lock = threading.Lock()
+
+    def _get_container_sas(self, expiry_minutes, permission):
+        now = datetime.now(timezone.utc)
+        required_until = now + timedelta(minutes=expiry_minutes)
+        with self._lock:
+            sas_token, token_expiry_time = self._tokens.get(str(permission), (None, None))
+            if sas_token and token_expiry_time >= required_until:
+                return sas_token
+
+            expiry_time = required_until + self.refresh_margin
+            if self.storage_account_key:
+                sas_token = generate_container_sas(account_name=self.storage_account_name, container_name=self.container_name, 
+                                                   account_key=self.storage_account_key, permission=permission, expiry=expiry_time)
+            else:
+                user_delegation_key = self.blob_service_client.get_user_delegation_key(key_start_time=now - timedelta(minutes=5), 
+                                                                                       key_expiry_time=expiry_time)
+                sas_token = generate_container_sas(account_name=self.storage_account_name, container_name=self.container_name, 
+                                                   user_delegation_key=user_delegation_key, permission=permission, expiry=expiry_time)
+
+            self.tokens_signed += 1
+            self._tokens[str(permission)] = (sas_token, expiry_time)
+            return sas_token
+
+    def blob_url(self, storage_path, storage_file_name, expiry_minutes=60):  
+        """  
+        Returns a SAS URI granting read access to one blob for at least expiry_minutes.  
+        """  
+        sas_token = self._get_container_sas(expiry_minutes, ContainerSasPermissions(read=True))
+        blob_name_with_path = urllib.parse.quote(f"{storage_path}/{storage_file_name}")
+        return f"https://{self.storage_account_name}.blob.core.windows.net/{self.container_name}/{blob_name_with_path}?{sas_token}"
+
+    def container_url(self, expiry_minutes=60):  
+        """  
+        Returns a SAS URI granting read and list access to the container, e.g. for contentContainerUrl.  
+        """  
+        sas_token = self._get_container_sas(expiry_minutes, ContainerSasPermissions(read=True, list=True))
+        return f"https://{self.storage_account_name}.blob.core.windows.net/{self.container_name}?{sas_token}"
+
+_sas_providers = {}
+_sas_providers_lock = threading.Lock()
+
+def get_sas_provider(storage_account_name, container_name, storage_account_key=None, blob_service_client=None):  
+    """  
+    Returns the SasProvider shared in this process for a container, so SAS tokens are reused across files and jobs.  
+    """  
+    with _sas_providers_lock:
+        provider_key = (storage_account_name, container_name)
+        if provider_key not in _sas_providers:
+            _sas_providers[provider_key] = SasProvider(storage_account_name, container_name, storage_account_key=storage_account_key, 
+                                                       blob_service_client=blob_service_client)
+        return _sas_providers[provider_key]
+
+# Transcription backends, each transcribes one file and returns the paths of the transcript files written
+def transcribe_file_with_whisper(endpoint_pool, file_path, output_path, deployment_id="whisper", transcription_cache=None, 
+                                 max_file_size_mb=25, split_for_latency=False, part_length=600, max_concurrency=None, transcript_format='jsonl', usage=None):  
+    """  
+    Transcribes an audio file with an Azure OpenAI Whisper deployment.  
+    Files larger than max_file_size_mb (or all files if split_for_latency is set) are split into parts at pauses,
+    the parts are transcribed in parallel and the texts and segment timestamps stitched back together.  
+  
+    Args:  
+        endpoint_pool (EndpointPool): Pool of Whisper deployments (see load_endpoint_pool).  
+        file_path (str): Path to the audio file.  
+        output_path (str): Folder the transcript is saved to.  
+        deployment_id (str): Model name, part of the cache key (default is "whisper").  
+        transcription_cache (TranscriptionCache): Cache of earlier results (optional).  
+        max_file_size_mb (int): Files above this size are split into parts (default is 25 MB, the Whisper limit).  
+        split_for_latency (bool): Split files below max_file_size_mb too, for lower latency.  
+        part_length (int): Target length of each part in seconds.  
+        max_concurrency (int): Number of parts sent at the same time (default is the max_concurrency of endpoint_pool).  
+        transcript_format (str): Format of the structured transcript with segment timestamps, "jsonl" or "parquet" (see transcripts.py).
+                                 None saves only the segments JSON of files transcribed in parts.  
+        usage (dict): Filled with the audio duration, requests and billed audio seconds of the file (optional, see accounting.py).  
+  
+    Returns:  
+        list: Paths of the transcript files written.  
+    """  
+    file_name = os.path.basename(file_path)
+    max_concurrency = max_concurrency or endpoint_pool.max_concurrency
+    split_into_parts = split_for_latency or os.path.getsize(file_path) > max_file_size_mb * 1024 * 1024
+    print(f'{file_name}: split_into_parts: {split_into_parts}')
+
+    cache_key = make_cache_key(audio_hash=get_file_hash(file_path), backend='whisper', deployment=deployment_id, prompt=None, temperature=0, 
+                               part_length=part_length if split_into_parts else None)
+    result = transcription_cache.get(cache_key) if transcription_cache else None
+    found_in_cache = result is not None
+
+    if found_in_cache:
+        print(f'{file_name}: transcription found in cache, skipping the Whisper request')
+    elif split_into_parts:
+
+        def transcribe_part(_p, audio_part):
+            part_offset_ms, part = audio_part
+            print(f'{file_name}: processing part {_p + 1} starting at {part_offset_ms / 1000:.1f} seconds')
+
+            # Parts are sent as MP3 to stay well below the file size limit
+            part_data = export_chunk_to_bytes(part, file_format='mp3')
+
+            # verbose_json returns segment timestamps, used to rebuild the timeline of the whole file
+            part_result = endpoint_pool.call(lambda client, deployment: client.audio.transcriptions.create(
+                file=(f'part_{_p}.mp3', part_data),
+                model=deployment,
+                temperature=0,
+                response_format="verbose_json"
+            ))
+            return part_offset_ms, part_result
+
+        audio_parts = split_audio_stream(file_path, chunk_length=part_length, split_on_silence=True)
+        transcription_parts = run_concurrently(audio_parts, transcribe_part, max_concurrency=max_concurrency, item_name='Part')
+
+        failed_parts = [str(_p + 1) for _p, transcription_part in enumerate(transcription_parts) if isinstance(transcription_part, Exception)]
+        if failed_parts:
+            raise RuntimeError(f'Transcription of {file_name} failed for part(s) {", ".join(failed_parts)}, rerun to retry')
+
+        print(f'{file_name}: number of parts: {len(transcription_parts)}')
+        result = stitch_transcription_parts(transcription_parts)
+    else:
+        # Read the file once so a retried request sends the same bytes again
+        with open(file_path, "rb") as audio_file:
+            audio_data = audio_file.read()
+
+        result = endpoint_pool.call(lambda client, deployment: client.audio.transcriptions.create(
+            file=(file_name, audio_data),            
+            model=deployment,
+            temperature=0,
+            # prompt='''You are generating a text transcript for documentation. 
+            # You will be given audio file, listen to it carefully ignoring background sounds.
+            # Do not guess words that you cannot hear clearly.''',    
+            # text, srt, json; verbose_json adds the language, duration and segment timestamps
+            response_format="verbose_json"
+        )).model_dump()
+
+    if transcription_cache and not found_in_cache:
+        transcription_cache.put(cache_key, result)
+
+    if usage is not None:
+        # Whisper is billed per second of audio sent, results from the cache cost nothing
+        audio_seconds = float(result.get('duration') or 0) or get_audio_duration_seconds(file_path)
+        usage.update(deployment=deployment_id, cached=found_in_cache, audio_seconds=audio_seconds, 
+                     requests=0 if found_in_cache else (len(transcription_parts) if split_into_parts else 1), 
+                     billed_audio_seconds=0 if found_in_cache else (result.get('usage') or {}).get('seconds') or audio_seconds, 
+                     part_length=part_length if split_into_parts else None)
+
+    output_file_paths = []
+
+    output_file_path = os.path.join(output_path, 'whisper_transcript_' + file_name +'.txt')
+    with open(output_file_path, "w") as file:  
+        file.write(result['text'])
+    print(f"Transcription saved to {output_file_path}")
+    output_file_paths.append(output_file_path)
+
+    if transcript_format:
+        output_file_paths.append(save_transcript(transcript_from_verbose_json(result, file_name, model=deployment_id), output_path, 'whisper', 
+                                                 file_name, transcript_format=transcript_format))
+    # Save the stitched segment timestamps when the file was transcribed in parts
+    elif split_into_parts:
+        output_file_path_segments = os.path.join(output_path, 'whisper_segments_' + file_name +'.json')
+        with open(output_file_path_segments, "w") as file:  
+            file.write(json.dumps(result['segments'], indent=4))
+        print(f"Segments saved to {output_file_path_segments}")
+        output_file_paths.append(output_file_path_segments)
+
+    return output_file_paths
+
+def build_audio_chat_messages(system_message, prompt, chunk_base64, audio_format):  
+    """  
+    Builds the chat completions messages asking the model to transcribe a Base64-encoded audio chunk.  
+    """  
+    return [ 
+        {
+            "role": "system",
+            "content": [
+                {
+                    "type": "text",
+                    "text": system_message
+                }
+            ]
+        },
+        { 
+            "role": "user", 
+            "content": [ 
+                {  
+                    "type": "text", 
+                    "text": prompt
+                }, 
+                { 
+                    "type": "input_audio", 
+                    "input_audio": { 
+                        "data": chunk_base64, 
+                        "format": audio_format # mp3, wav
+                    } 
+                } 
+            ] 
+        }, 
+    ] 
+
+def transcribe_file_with_4o_audio(endpoint_pool, file_path, output_path, system_message, prompt, deployment_id="gpt-4o-audio-preview", 
+                                  transcription_cache=None, chunk_checkpoint=None, chunk_length=30, split_on_silence=True, max_concurrency=None, max_tokens=4096, 
+                                  transcript_format='jsonl', usage=None, max_queued_chunks=None):  
+    """  
+    Transcribes an audio file with an Azure OpenAI gpt-4o-audio deployment, sending the file in chunks through chat completions.  
+    Chunks go through a pipeline (see transcribe_chunks_pipelined): decoded lazily, encoded while earlier chunks are being sent,
+    and each chunk result is checkpointed so a rerun only sends missing chunks.  
+  
+    Args:  
+        endpoint_pool (EndpointPool): Pool of gpt-4o-audio deployments (see load_endpoint_pool).  
+        file_path (str): Path to the audio file (MP3 or WAV).  
+        output_path (str): Folder the transcript is saved to.  
+        system_message (str): System message of each request.  
+        prompt (str): User prompt sent with each chunk.  
+        deployment_id (str): Model name, part of the cache keys (default is "gpt-4o-audio-preview").  
+        transcription_cache (TranscriptionCache): Cache of earlier results for the whole file (optional).  
+        chunk_checkpoint (TranscriptionCache): Cache of per-chunk results (optional).  
+        chunk_length (int): Length of each chunk in seconds.  
+        split_on_silence (bool): Place chunk boundaries in pauses and skip silent chunks.  
+        max_concurrency (int): Maximum number of chunks in flight (default is the max_concurrency of endpoint_pool).  
+        max_queued_chunks (int): Chunks waiting between two pipeline stages, bounds the memory used (default is max_concurrency).  
+        max_tokens (int): max_tokens of each request.  
+        transcript_format (str): Format of the structured transcript with one segment per chunk, "jsonl", "parquet" or None (see transcripts.py).  
+        usage (dict): Filled with the audio duration, requests and tokens of the file (optional, see accounting.py).  
+  
+    Returns:  
+        list: Paths of the transcript files written.  
+    """  
+    file_name = os.path.basename(file_path)
+    file_format = os.path.splitext(file_path)[1].split('.')[1].lower() # mp3, wav, etc.
+    max_concurrency = max_concurrency or endpoint_pool.max_concurrency
+    audio_hash = get_file_hash(file_path)
+    chunk_spans = {} # Chunk index -> (offset_ms, duration_ms), for the segment timestamps
+    request_usages = {} # Chunk index -> tokens of the request made for it by this run
+    chunk_keys = {} # Chunk index -> checkpoint key
+
+    def check_chunk_checkpoint(_c, audio_chunk):
+
+        chunk_offset_ms, chunk = audio_chunk
+        chunk_spans[_c] = (chunk_offset_ms, len(chunk))
+        print(f'{file_name}: processing chunk {_c + 1} starting at {chunk_offset_ms / 1000:.1f} seconds')
+
+        # Resume from the checkpoint if this chunk was already transcribed by an earlier run
+        chunk_keys[_c] = make_cache_key(audio_hash=audio_hash, chunk_index=_c, chunk_offset_ms=chunk_offset_ms, chunk_duration_ms=len(chunk), 
+                                        deployment=deployment_id, system_message=system_message, prompt=prompt, temperature=0)
+        checkpointed_result = chunk_checkpoint.get(chunk_keys[_c]) if chunk_checkpoint else None
+        if checkpointed_result is not None:
+            print(f'{file_name}: chunk {_c + 1} found in checkpoint, skipping request')
+            return ChatCompletion.model_validate(checkpointed_result)
+        return None
+
+    def transcribe_chunk(_c, audio_chunk, chunk_base64):
+
+        _, chunk = audio_chunk
+
+        # Make the audio chat completions request with the chunk exported to Base64
+        completion_result_chunk = endpoint_pool.call(lambda client, deployment: client.chat.completions.create( 
+            model=deployment, 
+            modalities=["text"],  # ["text", "audio"]
+            temperature=0,
+            max_tokens=max_tokens,
+            messages=build_audio_chat_messages(system_message, prompt, chunk_base64, file_format)
+        ), estimated_tokens=estimate_audio_chat_tokens(len(chunk) / 1000, max_tokens=max_tokens)) 
+        request_usages[_c] = get_completion_usage(completion_result_chunk)
+
+        return completion_result_chunk
+
+    def checkpoint_chunk(_c, completion_result_chunk):
+        if is_completed_chunk_result(completion_result_chunk):
+            chunk_checkpoint.put(chunk_keys[_c], completion_result_chunk.model_dump())
+
+    cache_key = make_cache_key(audio_hash=audio_hash, backend='4o_audio', deployment=deployment_id, 
+                               system_message=system_message, prompt=prompt, temperature=0, chunk_length=chunk_length, split_on_silence=split_on_silence)
+    cached_result = transcription_cache.get(cache_key) if transcription_cache else None
+
+    if cached_result is not None:
+        print(f'{file_name}: transcription found in cache, skipping the chat completions requests')
+        completion_result_list = [ChatCompletion.model_validate(completion_result) for completion_result in cached_result['completions']]
+        chunk_spans.update(enumerate(cached_result['chunk_spans']))
+    else:
+        # Decode, export and send the chunks in overlapping stages, results come back in chunk order
+        audio_chunks = split_audio_stream(file_path, chunk_length=chunk_length, split_on_silence=split_on_silence)
+        completion_result_list = transcribe_chunks_pipelined(audio_chunks, functools.partial(export_offset_chunk_to_base64, file_format=file_format), 
+                                                             transcribe_chunk, skip_chunk_fn=check_chunk_checkpoint, 
+                                                             write_result_fn=checkpoint_chunk if chunk_checkpoint else None, 
+                                                             max_concurrency=max_concurrency, max_queued_chunks=max_queued_chunks)
+
+        # Only cache complete transcripts, a rerun retries the failed, truncated and filtered chunks
+        if transcription_cache and all(is_completed_chunk_result(completion_result) for completion_result in completion_result_list):
+            transcription_cache.put(cache_key, {'completions': [completion_result.model_dump() for completion_result in completion_result_list], 
+                                                'chunk_spans': [chunk_spans[_c] for _c in range(len(completion_result_list))]})
+
+    print(f'{file_name}: number of audio chunks: {len(completion_result_list)}')
+
+    if usage is not None:
+        # Chunks from the checkpoint or the cache were paid for by an earlier run
+        audio_seconds = get_audio_duration_seconds(file_path) or max((offset_ms + duration_ms for offset_ms, duration_ms in chunk_spans.values()), default=0) / 1000
+        usage.update(deployment=deployment_id, cached=cached_result is not None, audio_seconds=audio_seconds, requests=len(request_usages), 
+                     chunks=len(completion_result_list), chunk_length=chunk_length, max_concurrency=max_concurrency, 
+                     **{key: sum(request_usage[key] for request_usage in request_usages.values()) for key in ('prompt_tokens', 'completion_tokens', 'audio_tokens')})
+
+    # Save the variable to the file
+    output_file_path = os.path.join(output_path, '4o_audio_transcript_' + file_name +'.txt')
+    with open(output_file_path, "w") as file:  
+        for _r, completion_result in enumerate(completion_result_list):
+            file.write(format_completion_result(_r, completion_result) + "\n")
+    print(f"Transcription saved to {output_file_path}")
+    output_file_paths = [output_file_path]
+
+    if transcript_format:
+        chunk_texts = []
+        for _r, completion_result in enumerate(completion_result_list):
+            choices = getattr(completion_result, 'choices', None)
+            chunk_offset_ms, chunk_duration_ms = chunk_spans.get(_r, (None, None))
+            chunk_texts.append((chunk_offset_ms / 1000 if chunk_offset_ms is not None else None, 
+                                (chunk_offset_ms + chunk_duration_ms) / 1000 if chunk_offset_ms is not None else None, 
+                                choices[0].message.content if choices and choices[0].finish_reason == "stop" else None))
+        transcript = transcript_from_chunks(chunk_texts, file_name, backend='4o_audio', model=deployment_id)
+        output_file_paths.append(save_transcript(transcript, output_path, '4o_audio', file_name, transcript_format=transcript_format))
+
+    return output_file_paths
+
+def transcribe_file_with_speech(file_path, output_path, backend, api_url, api_version, subscription_key, model_url, locale, 
+                                blob_service_client, storage_container, storage_account_name, storage_account_key, storage_path='uploads', 
+                                is_whisper=False, word_level_timestamps_enabled=True, sas_expiry_minutes=None, poll_interval=5, save_raw_json=True, 
+                                transcription_cache=None, transcript_format='jsonl', usage=None):  
+    """  
+    Transcribes an audio file with Azure AI Speech batch transcription: uploads it to Blob Storage, submits a transcription job,
+    waits for the job to complete and saves the transcript of each result file.  
+  
+    Args:  
+        file_path (str): Path to the audio file.  
+        output_path (str): Folder the transcripts are saved to.  
+        backend (str): Name used for the output files and the cache key (e.g. "whisper_speech", "base_speech").  
+        api_url (str): The base URL of the API (e.g. "https://eastus.api.cognitive.microsoft.com").  
+        api_version (str): The API version (e.g. "2024-11-15").  
+        subscription_key (str): Azure AI Foundry resource key / Azure Speech resource subscription key.  
+        model_url (str): URL of the speech-to-text model to use.  
+        locale (str): Locale of the audio file (e.g. "en-US").  
+        blob_service_client (BlobServiceClient): Client used to upload the audio file.  
+        storage_container (str): Container the audio file is uploaded to.  
+        storage_account_name (str): Storage account name, used to sign the SAS URI.  
+        storage_account_key (str): Storage account key, used to sign the SAS URI.  
+        storage_path (str): Folder in the container the audio file is uploaded to (default is "uploads").  
+        is_whisper (bool): Set to True for Whisper models.  
+        word_level_timestamps_enabled (bool): Whether to enable word-level timestamps in the transcription.  
+        sas_expiry_minutes (int): Expiry of the SAS URI given to the service (default is estimated from the audio duration).  
+        poll_interval (int): Seconds between status checks of the transcription job.  
+        save_raw_json (bool): Save the downloaded result JSON. When False and transcript_format is None, the phrase and word timestamps are saved to a compact segments JSON instead.  
+        transcription_cache (TranscriptionCache): Cache of earlier results (optional).  
+        transcript_format (str): Format of the structured transcript with phrases, speakers and word timestamps, "jsonl", "parquet" or None (see transcripts.py).  
+        usage (dict): Filled with the audio duration, billed audio seconds and job of the file (optional, see accounting.py).  
+  
+    Returns:  
+        list: Paths of the transcript files written.  
+    """  
+    file_name = os.path.basename(file_path)
+    usage = usage if usage is not None else {}
+
+    cache_key = make_cache_key(audio_hash=get_file_hash(file_path), backend=backend, model=model_url, locale=locale, word_level_timestamps_enabled=word_level_timestamps_enabled)
+    transcription_data_by_file = transcription_cache.get(cache_key) if transcription_cache else None
+
+    found_in_cache = transcription_data_by_file is not None
+
+    if found_in_cache:
+        print(f'{file_name}: transcription found in cache, skipping upload and batch transcription')
+    else:
+        transcription_data_by_file = _run_speech_transcription(file_path, output_path, backend, api_url, api_version, subscription_key, model_url, locale, 
+                                                               blob_service_client, storage_container, storage_account_name, storage_account_key, storage_path, 
+                                                               is_whisper, word_level_timestamps_enabled, sas_expiry_minutes, poll_interval, save_raw_json, usage)
+        if transcription_cache:
+            transcription_cache.put(cache_key, transcription_data_by_file)
+
+    # Batch transcription is billed per hour of audio transcribed
+    audio_seconds = sum(transcription_data.get('durationInTicks', 0) for transcription_data in transcription_data_by_file.values()) / SPEECH_TICKS_PER_SECOND
+    usage.update(deployment=get_speech_model_id(model_url), locale=locale, cached=found_in_cache, audio_seconds=audio_seconds, 
+                 billed_audio_seconds=0 if found_in_cache else audio_seconds)
+
+    return save_speech_transcription_outputs(transcription_data_by_file, output_path, backend, file_name, save_raw_json=save_raw_json, 
+                                             transcript_format=transcript_format, model=model_url, locale=locale)
+
+def _run_speech_transcription(file_path, output_path, backend, api_url, api_version, subscription_key, model_url, locale, 
+                              blob_service_client, storage_container, storage_account_name, storage_account_key, storage_path, 
+                              is_whisper, word_level_timestamps_enabled, sas_expiry_minutes, poll_interval, save_raw_json, usage):  
+    """  
+    Uploads, submits and polls a Speech batch transcription for transcribe_file_with_speech.  
+    :param usage: Dict the submission ID is added to.  
+    :return: Dict of transcription JSON per result file index.  
+    """  
+    file_name = os.path.basename(file_path)
+
+    # Upload the local audio file to Azure Blob Storage
+    with open(file_path, "rb") as audio_file:  
+        upload_binary_data_to_azure_storage(blob_service_client=blob_service_client,
+                                            storage_container=storage_container, 
+                                            storage_path=storage_path, 
+                                            storage_file_name=file_name, 
+                                            binary_data=audio_file)
+    print(f"Uploaded {file_path} to Azure Blob Storage at {storage_container}/{storage_path}/{file_name}")
+
+    # Generate SAS URI for the uploaded file in Azure Storage for use with the transcription API
+    audio_duration_seconds = get_audio_duration_seconds(file_path)
+    sas_provider = get_sas_provider(storage_account_name, storage_container, storage_account_key=storage_account_key, blob_service_client=blob_service_client)
+    audio_file_sas = sas_provider.blob_url(storage_path=storage_path, 
+                                           storage_file_name=file_name, 
+                                           expiry_minutes=sas_expiry_minutes or estimate_sas_expiry_minutes(audio_duration_seconds))
+
+    # Submit transcription request to Azure AI Speech service
+    transcription_request_response = submit_transcription_request(api_url=api_url, 
+                                                                  api_version=api_version, 
+                                                                  subscription_key=subscription_key, 
+                                                                  content_urls=[audio_file_sas], 
+                                                                  locale=locale, 
+                                                                  transcription_display_name='Transcription of ' + file_name, 
+                                                                  model_url=model_url,
+                                                                  word_level_timestamps_enabled=word_level_timestamps_enabled,
+                                                                  is_whisper=is_whisper)
+    if not transcription_request_response or not transcription_request_response.get('self'):
+        raise RuntimeError(f'Transcription request for {file_name} failed')
+
+    submission_id = transcription_request_response['self'].split('/')[-1]  # Extract submission ID from the self link
+    usage['submission_id'] = submission_id
+    print(f'Started polling for transcription result with submission ID: {submission_id}')
+
+    get_transcription_response = wait_for_transcriptions(api_url, api_version, subscription_key, [submission_id], poll_interval=poll_interval, 
+                                                         audio_durations={submission_id: audio_duration_seconds})[submission_id]
+    if get_transcription_response.get("status") != "Succeeded":
+        raise RuntimeError(f'Transcription of {file_name} failed with error: {get_transcription_response}')
+
+    # Get transcription files
+    get_transcription_files_response = get_transcription_files(api_url=api_url, api_version=api_version, submission_id=submission_id, subscription_key=subscription_key)
+    if not get_transcription_files_response:
+        raise RuntimeError(f'Could not list the result files of transcription {submission_id} for {file_name}')
+
+    # The report tells whether the service could transcribe the file, a failed file may still have a result without recognized phrases
+    for report_file in [file_info for file_info in get_transcription_files_response.get("values", []) if file_info.get("kind") == 'TranscriptionReport']:
+        try:
+            report_details = get_transcription_report_details(download_transcription_result(report_file.get("links", {}).get("contentUrl")))
+        except Exception as e:
+            print(f"Error downloading {report_file.get('name')}: {e}")
+            continue
+        failed_details = [detail for detail in report_details.values() if detail['status'] == 'Failed']
+        if failed_details:
+            raise RuntimeError(f'Transcription of {file_name} failed: {failed_details[0]["error"]}')
+
+    # There could be multiple files, so each file is saved with a unique name
+    result_files = [(str(_f), file_info) for _f, file_info in enumerate(get_transcription_files_response.get("values", [])) 
+                    if file_info.get("kind") == 'Transcription']
+    save_paths = [os.path.join(output_path, f'{backend}_transcript_{_f}_' + file_name +'.json') if save_raw_json else None for _f, _ in result_files]
+
+    # Download the transcription files from the content URL SAS URIs in parallel
+    transcription_results = download_transcription_results([file_info.get("links", {}).get("contentUrl") for _, file_info in result_files], save_paths)
+
+    transcription_data_by_file = {}
+    for (_f, file_info), transcription_result in zip(result_files, transcription_results):
+        if isinstance(transcription_result, Exception):
+            raise RuntimeError(f'Download of {file_info.get("name")} for {file_name} failed: {transcription_result}')
+        transcription_data_by_file[_f] = transcription_result
+
+    return transcription_data_by_file
+
+def get_audio_duration_seconds(file_path):  
+    """  
+    Returns the duration of an audio file from its header, or None when the format is not recognised.  
+    """  
+    try:
+        audio_info = MutagenFile(file_path)
+    except Exception:
+        return None
+
+    return audio_info.info.length if audio_info is not None and audio_info.info else None
+
+def wait_for_transcriptions(api_url, api_version, subscription_key, submission_ids, poll_interval=5, max_poll_errors=5, 
+                            audio_durations=None, on_succeeded=None, deadline_seconds=6 * 60 * 60, webhook_receiver=None, fallback_poll_interval=120):  
+    """  
+    Polls transcription jobs until each one has succeeded, failed or exceeded the deadline.  
+  
+    Args:  
+        api_url (str): The base URL of the API (e.g. "https://eastus.api.cognitive.microsoft.com").  
+        api_version (str): The API version (e.g. "2024-11-15").  
+        subscription_key (str): Azure AI Foundry resource key / Azure Speech resource subscription key.  
+        submission_ids (list): IDs of the transcription submissions.  
+        poll_interval (int): Shortest interval between status requests for a job, in seconds.  
+        max_poll_errors (int): A job is reported as failed after this many consecutive failed status requests.  
+        audio_durations (dict): Audio duration in seconds per submission ID, used to space the polls (optional).  
+        on_succeeded (function): Called as on_succeeded(submission_id, transcription_response) as soon as a job succeeds (optional).  
+        deadline_seconds (int): Seconds after which a job is reported as "TimedOut".  
+        webhook_receiver (TranscriptionWebhookReceiver): Running receiver of a registered web hook (optional). Jobs are then
+                                                         polled as soon as their completion event arrives, and otherwise only
+                                                         every fallback_poll_interval seconds in case an event is lost.  
+  
+    Returns:  
+        dict: Final transcription JSON per submission ID. Jobs that did not succeed or fail have {"status": "Failed" / "TimedOut", "error": ...}.  
+    """  
+    if webhook_receiver:
+        poll_interval = max(poll_interval, fallback_poll_interval)
+
+    get_transcription_fn = functools.partial(get_transcription, api_url, api_version, subscription_key=subscription_key)
+    job_tracker = TranscriptionJobTracker(get_transcription_fn, min_poll_interval=poll_interval, 
+                                          max_poll_interval=max(120, poll_interval * 5), max_poll_errors=max_poll_errors, 
+                                          deadline_seconds=deadline_seconds)
+    if webhook_receiver:
+        webhook_receiver.add_listener(job_tracker.notify)
+    try:
+        return job_tracker.run(submission_ids, audio_durations, on_succeeded)
+    finally:
+        if webhook_receiver:
+            webhook_receiver.remove_listener(job_tracker.notify)
+            print(f'Web hook events: {job_tracker.notifications}, status requests: {job_tracker.requests}')
+
+def get_blob_url_without_sas(url):  
+    """  
+    Returns the blob URL without its SAS query string and with the path unquoted, used to match result files to source files.  
+    """  
+    parsed_url = urllib.parse.urlsplit(url)
+    return f'{parsed_url.scheme}://{parsed_url.netloc}{urllib.parse.unquote(parsed_url.path)}'
+
+def get_output_file_names(file_paths):  
+    """  
+    Names the transcripts of a batch after each file's path relative to the folder the files have in common, so files with the
+    same name in different folders (a/x.wav and b/x.wav) do not overwrite each other's transcripts. Files in one folder keep their name.  
+    :return: Dict of file path -> name used in the transcript file names (folders joined with "__").  
+    """  
+    absolute_paths = {file_path: os.path.abspath(file_path) for file_path in file_paths}
+    try:
+        common_dir = os.path.commonpath([os.path.dirname(absolute_path) for absolute_path in absolute_paths.values()])
+    except ValueError:
+        return {file_path: os.path.basename(file_path) for file_path in file_paths} # No files, or paths on different drives
+    return {file_path: os.path.relpath(absolute_path, common_dir).replace(os.sep, '__') for file_path, absolute_path in absolute_paths.items()}
+
+def transcribe_files_with_speech_batch(file_paths, output_path, backend, api_url, api_version, subscription_key, model_url, locale, 
+                                       blob_service_client, storage_container, storage_account_name, storage_account_key, storage_path='uploads', 
+                                       is_whisper=False, word_level_timestamps_enabled=True, sas_expiry_minutes=None, poll_interval=30, 
+                                       max_files_per_job=1000, content_container_url=None, max_upload_workers=4, deadline_seconds=6 * 60 * 60, 
+                                       webhook_receiver=None, save_raw_json=True, transcription_cache=None, transcript_format='jsonl'):  
+    """  
+    Transcribes many audio files with as few Azure AI Speech batch transcription jobs as possible.  
+    Files are uploaded and grouped into jobs of up to max_files_per_job content URLs (1000 is the service limit), or a single job
+    transcribing a whole container when content_container_url is set. All jobs are polled together, and each result file is
+    matched back to its audio file through the "source" URL in the result. Transcripts are named after each file's path relative
+    to the folder the files have in common (see get_output_file_names).  
+  
+    Args:  
+        file_paths (list): Paths of the audio files.  
+        content_container_url (str): SAS URL (read and list) of storage_container, transcribed as one job. A container job transcribes
+                                     every blob in it, so it is only used when the container holds exactly the files of this batch,
+                                     otherwise the files are submitted by URL. The files are still uploaded first.  
+        max_files_per_job (int): Maximum number of content URLs per transcription job.  
+        max_upload_workers (int): Number of files uploaded to storage at the same time.  
+        deadline_seconds (int): Seconds after which a job that has not completed is given up on.  
+        webhook_receiver (TranscriptionWebhookReceiver): Running receiver of a registered web hook, to react to completion events instead of polling (optional).  
+        save_raw_json (bool): Save the downloaded result JSON, otherwise (with transcript_format None) a compact segments JSON with phrase and word timestamps.  
+        sas_expiry_minutes (int): Expiry of the SAS URIs given to the service (default is estimated from the number of jobs and the audio duration).  
+        Other arguments are as for transcribe_file_with_speech.  
+  
+    Returns:  
+        list: Status dicts (file_path, status, outputs, error, seconds, usage) in the order of file_paths. The seconds of a transcribed
+              file are its audio's share of its job's time, and usage has the job's submission_id, job_seconds and job_audio_seconds.  
+    """  
+    batch_start_time = time.time()
+    file_statuses = {file_path: {'file_path': file_path, 'status': 'failed', 'outputs': [], 'error': None, 'seconds': None, 
+                                 'usage': {'deployment': get_speech_model_id(model_url), 'locale': locale}} for file_path in file_paths}
+    cache_keys = {}
+    pending_files = {} # Blob URL without SAS -> local file path
+    output_file_names = get_output_file_names(file_paths)
+
+    def write_outputs(file_path, transcription_data_by_file, submission_id=None):
+        file_statuses[file_path]['outputs'].extend(save_speech_transcription_outputs(transcription_data_by_file, output_path, backend, 
+                                                                                     output_file_names[file_path], save_raw_json=save_raw_json, 
+                                                                                     transcript_format=transcript_format, model=model_url, locale=locale))
+        file_statuses[file_path]['status'] = 'succeeded'
+
+        # Batch transcription is billed per hour of audio transcribed, results from the cache (no submission) cost nothing
+        audio_seconds = sum(transcription_data.get('durationInTicks', 0) for transcription_data in transcription_data_by_file.values()) / SPEECH_TICKS_PER_SECOND
+        file_statuses[file_path]['usage'].update(cached=submission_id is None, submission_id=submission_id, audio_seconds=audio_seconds, 
+                                                 billed_audio_seconds=audio_seconds if submission_id else 0)
+
+    # Upload the files that are not in the cache
+    uploads = []
+    audio_durations_by_file = {}
+    for file_path in file_paths:
+        file_hash = get_file_hash(file_path)
+        cache_keys[file_path] = make_cache_key(audio_hash=file_hash, backend=backend, model=model_url, locale=locale, word_level_timestamps_enabled=word_level_timestamps_enabled)
+        cached_result = transcription_cache.get(cache_keys[file_path]) if transcription_cache else None
+        if cached_result is not None:
+            print(f'{os.path.basename(file_path)}: transcription found in cache')
+            write_outputs(file_path, cached_result)
+            continue
+
+        # The content hash keeps files with the same name from different folders apart
+        uploads.append((file_path, f'{storage_path}/{file_hash[:16]}', os.path.basename(file_path)))
+        audio_durations_by_file[file_path] = get_audio_duration_seconds(file_path) or 0
+
+    upload_results = upload_files_to_azure_storage(blob_service_client, storage_container, uploads, max_workers=max_upload_workers)
+
+    # One container SAS signs all files, valid long enough for every job to be started
+    sas_provider = get_sas_provider(storage_account_name, storage_container, storage_account_key=storage_account_key, blob_service_client=blob_service_client)
+    sas_expiry_minutes = sas_expiry_minutes or estimate_sas_expiry_minutes(sum(audio_durations_by_file.values()), 
+                                                                           queued_jobs=-(-len(uploads) // max_files_per_job))
+    content_urls = []
+    uploaded_blob_names = set()
+    for (file_path, file_storage_path, storage_file_name), upload_result in zip(uploads, upload_results):
+        if isinstance(upload_result, Exception):
+            file_statuses[file_path]['error'] = f'Upload failed: {upload_result}'
+            continue
+
+        audio_file_sas = sas_provider.blob_url(storage_path=file_storage_path, storage_file_name=storage_file_name, expiry_minutes=sas_expiry_minutes)
+        pending_files[get_blob_url_without_sas(audio_file_sas)] = file_path
+        uploaded_blob_names.add(f'{file_storage_path}/{storage_file_name}')
+        content_urls.append(audio_file_sas)
+
+    print(f'Files to transcribe: {len(content_urls)} of {len(file_paths)}')
+
+    # A container job transcribes (and bills) every blob in the container, including those left by earlier runs
+    if content_container_url and content_urls:
+        container_name = urllib.parse.urlsplit(content_container_url).path.rstrip('/').split('/')[-1]
+        other_blob_names = None
+        if container_name == storage_container:
+            try:
+                other_blob_names = {blob.name for blob in blob_service_client.get_container_client(storage_container).list_blobs()} - uploaded_blob_names
+            except Exception as e:
+                print(f'Listing container {storage_container} failed: {e}')
+        if other_blob_names is None:
+            print(f'The content container is not the upload container {storage_container} or could not be listed, submitting the files by URL')
+            content_container_url = None
+        elif other_blob_names:
+            print(f'Container {storage_container} holds {len(other_blob_names)} blob(s) outside this batch, submitting the files by URL')
+            content_container_url = None
+
+    # Submit as few jobs as the service allows
+    if content_container_url and content_urls:
+        job_content = [(None, content_container_url)]
+    else:
+        job_content = [(content_urls[i:i + max_files_per_job], None) for i in range(0, len(content_urls), max_files_per_job)]
+
+    submission_ids = []
+    audio_durations = {}
+    job_start_times = {}
+    for _j, (job_content_urls, job_container_url) in enumerate(job_content):
+        job_start_time = time.time()
+        transcription_request_response = submit_transcription_request(api_url=api_url, 
+                                                                      api_version=api_version, 
+                                                                      subscription_key=subscription_key, 
+                                                                      content_urls=job_content_urls, 
+                                                                      content_container_url=job_container_url, 
+                                                                      locale=locale, 
+                                                                      transcription_display_name=f'Batch transcription {_j + 1} of {len(job_content)}', 
+                                                                      model_url=model_url,
+                                                                      word_level_timestamps_enabled=word_level_timestamps_enabled,
+                                                                      is_whisper=is_whisper)
+        if transcription_request_response and transcription_request_response.get('self'):
+            submission_id = transcription_request_response['self'].split('/')[-1]
+            submission_ids.append(submission_id)
+            job_start_times[submission_id] = job_start_time
+            job_file_paths = [pending_files[get_blob_url_without_sas(url)] for url in job_content_urls] if job_content_urls else pending_files.values()
+            audio_durations[submission_id] = sum(audio_durations_by_file[file_path] for file_path in job_file_paths)
+        else:
+            print(f'Transcription request {_j + 1} of {len(job_content)} failed')
+    print(f'Submitted {len(submission_ids)} transcription job(s) for {len(content_urls)} file(s)')
+
+    # Download the results of each job as soon as it succeeds and map each result file back to its audio file
+    def download_job_results(submission_id, get_transcription_response):
+        get_transcription_files_response = get_transcription_files(api_url=api_url, api_version=api_version, submission_id=submission_id, subscription_key=subscription_key)
+        job_files = (get_transcription_files_response or {}).get("values", [])
+        result_files = [file_info for file_info in job_files if file_info.get("kind") == 'Transcription']
+        report_files = [file_info for file_info in job_files if file_info.get("kind") == 'TranscriptionReport']
+        transcription_results = download_transcription_results([file_info.get("links", {}).get("contentUrl") for file_info in result_files + report_files])
+
+        # The report has the outcome of each file, a file the service could not transcribe may still have a result without recognized phrases
+        failed_sources = set()
+        for file_info, transcription_report in zip(report_files, transcription_results[len(result_files):]):
+            if isinstance(transcription_report, Exception):
+                print(f"Error downloading {file_info.get('name')}: {transcription_report}")
+                continue
+
+            print(f'Transcription {submission_id}: {transcription_report.get("successfulTranscriptionsCount")} file(s) succeeded, '
+                  f'{transcription_report.get("failedTranscriptionsCount")} failed')
+            for source, report_detail in get_transcription_report_details(transcription_report).items():
+                if report_detail['status'] == 'Failed' and source in pending_files:
+                    failed_sources.add(source)
+                    file_statuses[pending_files[source]]['error'] = f'Transcription failed: {report_detail["error"]}'
+                    file_statuses[pending_files[source]]['usage']['submission_id'] = submission_id
+
+        for file_info, transcription_data in zip(result_files, transcription_results):
+            if isinstance(transcription_data, Exception):
+                print(f"Error downloading {file_info.get('name')}: {transcription_data}")
+                continue
+
+            source = get_blob_url_without_sas(transcription_data.get('source', ''))
+            file_path = pending_files.get(source)
+            if file_path is None:
+                print(f'No local file for result {file_info.get("name")} with source {source}')
+                continue
+            if source in failed_sources:
+                continue
+
+            if save_raw_json:
+                output_file_path_json = os.path.join(output_path, f'{backend}_transcript_0_' + output_file_names[file_path] +'.json')
+                with open(output_file_path_json, 'w') as file:
+                    json.dump(transcription_data, file)
+                file_statuses[file_path]['outputs'].append(output_file_path_json)
+
+            write_outputs(file_path, {'0': transcription_data}, submission_id=submission_id)
+            if transcription_cache:
+                transcription_cache.put(cache_keys[file_path], {'0': transcription_data})
+
+        # The files of a job are transcribed together, so each file gets the share of the job time (submission to results) of its audio
+        job_seconds = time.time() - job_start_times[submission_id]
+        job_file_statuses = [file_status for file_status in file_statuses.values() 
+                             if file_status['status'] == 'succeeded' and file_status['usage'].get('submission_id') == submission_id]
+        job_audio_seconds = sum(file_status['usage']['audio_seconds'] for file_status in job_file_statuses)
+        for file_status in job_file_statuses:
+            audio_share = file_status['usage']['audio_seconds'] / job_audio_seconds if job_audio_seconds else 1 / len(job_file_statuses)
+            file_status['seconds'] = round(job_seconds * audio_share, 2)
+            file_status['usage'].update(job_seconds=round(job_seconds, 2), job_audio_seconds=job_audio_seconds)
+
+    final_responses = wait_for_transcriptions(api_url, api_version, subscription_key, submission_ids, poll_interval=poll_interval, 
+                                              audio_durations=audio_durations, on_succeeded=download_job_results, deadline_seconds=deadline_seconds, 
+                                              webhook_receiver=webhook_receiver)
+    for submission_id, get_transcription_response in final_responses.items():
+        if get_transcription_response.get("status") != "Succeeded":
+            print(f'Transcription {submission_id} failed with error: {get_transcription_response}')
+
+    # Results from the cache take no time, files without a result waited for the whole batch
+    for file_status in file_statuses.values():
+        if file_status['usage'].get('cached'):
+            file_status['seconds'] = 0.0
+        elif file_status['seconds'] is None:
+            file_status['seconds'] = round(time.time() - batch_start_time, 2)
+        if file_status['status'] == 'failed' and not file_status['error']:
+            file_status['error'] = 'No transcription result'
+
+    return [file_statuses[file_path] for file_path in file_paths]
+
+# Batch processing
+AUDIO_FILE_EXTENSIONS = ('.mp3', '.wav', '.m4a', '.ogg', '.flac', '.aac', '.wma', '.webm', '.mp4')
+
+def list_audio_files(input_spec):  
+    """  
+    Lists the audio files to transcribe from a folder, a glob pattern or a manifest file.  
+    A CSV manifest needs a file_path column, a JSONL manifest a "file_path" key on each line. Relative paths are relative to the manifest.  
+    :param input_spec: Folder, glob pattern (e.g. "../audio_files/*.mp3") or path to a .csv / .jsonl manifest.  
+    :return: Sorted list of file paths.  
+    """  
+    if os.path.isdir(input_spec):
+        file_paths = [os.path.join(input_spec, file_name) for file_name in os.listdir(input_spec) if file_name.lower().endswith(AUDIO_FILE_EXTENSIONS)]
+    elif input_spec.lower().endswith(('.csv', '.jsonl')) and os.path.isfile(input_spec):
+        manifest_dir = os.path.dirname(input_spec)
+        with open(input_spec, 'r', newline='') as file:
+            if input_spec.lower().endswith('.csv'):
+                manifest_rows = list(csv.DictReader(file))
+            else:
+                manifest_rows = [json.loads(line) for line in file if line.strip()]
+        file_paths = [os.path.join(manifest_dir, row['file_path']) for row in manifest_rows]
+    else:
+        file_paths = [file_path for file_path in glob.glob(input_spec, recursive=True) if os.path.isfile(file_path)]
+
+    return sorted(file_paths)
+
+def transcribe_files_concurrently(file_paths, transcribe_file_fn, max_workers=4):  
+    """  
+    Transcribes many files in one process through a thread pool, recording the outcome of each file.  
+    :param file_paths: List of audio file paths.  
+    :param transcribe_file_fn: Function called as transcribe_file_fn(file_path, usage) returning the list of output paths.
+                               usage is a dict it fills with the audio duration, requests and tokens of the file (see accounting.py).  
+    :param max_workers: Number of files transcribed at the same time (default is 4).  
+    :return: List of status dicts (file_path, status, outputs, error, seconds, usage) in the order of file_paths.  
+    """  
+
+    def transcribe_file(_i, file_path):
+        file_start_time = time.time()
+        usage = {}
+        try:
+            with metrics.span('transcribe_file', file_path=file_path):
+                output_file_paths = transcribe_file_fn(file_path, usage)
+            return {'file_path': file_path, 'status': 'succeeded', 'outputs': output_file_paths, 'error': None, 
+                    'seconds': round(time.time() - file_start_time, 2), 'usage': usage}
+        except Exception as e:
+            print(f'Transcription of {file_path} failed: {e}')
+            return {'file_path': file_path, 'status': 'failed', 'outputs': [], 'error': str(e), 
+                    'seconds': round(time.time() - file_start_time, 2), 'usage': usage}
+
+    return run_concurrently(file_paths, transcribe_file, max_concurrency=max_workers, item_name='File')
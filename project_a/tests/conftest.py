@@ -0,0 +1,30 @@
+# Tests of the transcription scripts, run from the repository root or project_a with: python -m pytest project_a/tests
+# The scripts are plain modules in project_a/scripts, so that directory is put on the import path.
+# Tests that call Azure services run against the local mocks of mock_services.py, without credentials or quota.
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from mock_services import MockAzureServices, get_mock_environment
+
+@pytest.fixture
+def start_mock_services(monkeypatch):
+    """
+    Starts MockAzureServices with the given config and points the environment variables of the scripts at it.
+    """
+    mocks = []
+
+    def _start(config=None):
+        mock = MockAzureServices(config=config).start()
+        mocks.append(mock)
+        for name, value in get_mock_environment(mock.url).items():
+            monkeypatch.setenv(name, value)
+        return mock
+
+    yield _start
+    for mock in mocks:
+        mock.stop()
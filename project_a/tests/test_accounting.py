@@ -0,0 +1,66 @@
+import pytest
+
+from accounting import PRICES, UsageLedger, estimate_cost, make_usage_record, percentile, read_usage_ledger, summarize_usage
+
+def test_estimate_cost_per_audio_hour():
+    assert estimate_cost('whisper', {'billed_audio_seconds': 1800}) == pytest.approx(PRICES['whisper']['per_audio_hour'] / 2)
+    assert estimate_cost('base_speech', {'billed_audio_seconds': 3600}) == pytest.approx(PRICES['base_speech']['per_audio_hour'])
+    assert estimate_cost('whisper', {}) == 0
+
+def test_estimate_cost_per_token():
+    prices = {'4o_audio': {'audio_input_per_million': 40.0, 'text_input_per_million': 2.0, 'text_output_per_million': 10.0}}
+    usage = {'prompt_tokens': 1_500_000, 'audio_tokens': 1_000_000, 'completion_tokens': 100_000}
+
+    # 1M audio tokens, the remaining 0.5M prompt tokens are text
+    assert estimate_cost('4o_audio', usage, prices) == pytest.approx(40.0 + 1.0 + 1.0)
+
+def test_estimate_cost_unknown_backend():
+    assert estimate_cost('auto', {'billed_audio_seconds': 3600}) is None
+
+def test_make_usage_record():
+    file_status = {'file_path': 'a.mp3', 'status': 'succeeded', 'seconds': 30.0, 
+                   'usage': {'audio_seconds': 600, 'billed_audio_seconds': 600, 'deployment': 'whisper'}}
+
+    record = make_usage_record(file_status, 'whisper')
+
+    assert record['rtf'] == 0.05
+    assert record['cost_usd'] == pytest.approx(PRICES['whisper']['per_audio_hour'] / 6)
+    assert (record['deployment'], record['cached']) == ('whisper', False)
+
+def test_summarize_usage_leaves_cached_files_out_of_rates():
+    records = [make_usage_record({'file_path': f'{_f}.mp3', 'status': 'succeeded', 'seconds': 60.0, 
+                                  'usage': {'audio_seconds': 3600, 'billed_audio_seconds': 3600, 'deployment': 'whisper'}}, 'whisper') 
+               for _f in range(2)]
+    records.append(make_usage_record({'file_path': 'cached.mp3', 'status': 'succeeded', 'seconds': 0.1, 
+                                      'usage': {'audio_seconds': 3600, 'deployment': 'whisper', 'cached': True}}, 'whisper'))
+    records.append(make_usage_record({'file_path': 'failed.mp3', 'status': 'failed', 'seconds': 5.0, 'usage': {}}, 'whisper'))
+
+    summary, = summarize_usage(records, group_by=('backend',))
+
+    assert (summary['files'], summary['failed'], summary['cached']) == (4, 1, 1)
+    assert summary['audio_hours'] == 3
+    assert summary['rtf'] == pytest.approx(60 / 3600, abs=1e-4)
+    assert summary['cost_per_audio_hour'] == pytest.approx(PRICES['whisper']['per_audio_hour'])
+
+def test_percentile():
+    assert percentile([], 50) is None
+    assert percentile([3, 1, 2, 4], 50) == 2
+    assert percentile(list(range(1, 101)), 95) == 95
+
+def batch_file_status(file_path, audio_seconds, seconds):
+    return {'file_path': file_path, 'status': 'succeeded', 'seconds': seconds, 
+            'usage': {'submission_id': 'job-1', 'audio_seconds': audio_seconds, 'billed_audio_seconds': audio_seconds, 
+                      'job_seconds': 900.0, 'job_audio_seconds': 3 * 3600}}
+
+def test_batch_files_count_their_job_once(tmp_path):
+    file_statuses = [batch_file_status('long.mp3', 2 * 3600, 600.0), batch_file_status('short.mp3', 3600, 300.0)]
+    ledger = UsageLedger(str(tmp_path / 'usage_ledger.jsonl'))
+
+    run_record = ledger.record_run('base_speech', file_statuses, 1000.0, workers=4)
+    records = read_usage_ledger(ledger.ledger_path)
+
+    assert [(record['type'], record.get('batch_job'), record.get('rtf')) for record in records] == \
+        [('file', 'job-1', round(900 / (3 * 3600), 4)), ('file', 'job-1', round(900 / (3 * 3600), 4)), ('run', None, None)]
+    assert (run_record['audio_seconds'], run_record['wall_seconds'], run_record['workers']) == (3 * 3600, 1000.0, 4)
+    summary, = summarize_usage(records, group_by=('backend',))
+    assert summary['rtf'] == pytest.approx(900 / (3 * 3600), abs=1e-4)
@@ -0,0 +1,76 @@
+import json
+
+import pytest
+import requests
+
+from metrics import Metrics, _NOOP_SPAN
+
+def test_disabled_metrics_record_nothing():
+    metrics = Metrics()
+
+    with metrics.span('upload', bytes=10) as span:
+        span.set(skipped=True)
+    metrics.increment('retries', service='speech')
+    metrics.observe('speech_queue', 1.0)
+
+    assert metrics.span('upload') is _NOOP_SPAN
+    assert metrics.summary() == {'stages': {}, 'counters': []}
+
+def test_span_records_duration_errors_and_summed_attributes(tmp_path):
+    metrics = Metrics(enabled=True, json_log_path=str(tmp_path / 'spans.jsonl'))
+
+    with metrics.span('upload', storage_file_name='a.wav') as span:
+        span.set(bytes=100)
+    with pytest.raises(OSError):
+        with metrics.span('upload', bytes=50, audio_seconds=2.5):
+            raise OSError('connection reset')
+    metrics.close()
+
+    stage = metrics.summary()['stages']['upload']
+    assert (stage['count'], stage['errors'], stage['bytes'], stage['audio_seconds']) == (2, 1, 150, 2.5)
+    assert 0 <= stage['max_seconds'] <= stage['seconds']
+    with open(tmp_path / 'spans.jsonl') as file:
+        spans = [json.loads(line) for line in file]
+    assert [(span['span'], span['error'], span.get('storage_file_name')) for span in spans] == [('upload', None, 'a.wav'), ('upload', 'OSError', None)]
+
+def test_increment_counts_per_label_set():
+    metrics = Metrics(enabled=True)
+
+    metrics.increment('retries', service='speech')
+    metrics.increment('retries', 2, service='speech')
+    metrics.increment('retries', service='openai')
+    metrics.reset()
+    metrics.increment('throttles', service='openai', deployment='whisper')
+
+    assert metrics.summary()['counters'] == [{'name': 'throttles', 'deployment': 'whisper', 'service': 'openai', 'value': 1}]
+
+def test_prometheus_text_format():
+    metrics = Metrics(enabled=True, buckets=(0.1, 1))
+    metrics.observe('speech_queue', 0.05)
+    metrics.observe('speech_queue', 0.5, audio_seconds=60)
+    metrics.observe('speech_queue', 5)
+    metrics.increment('throttles', 3, service='open"ai')
+
+    lines = metrics.to_prometheus().splitlines()
+
+    assert lines[:7] == ['# HELP transcription_stage_seconds Time spent per pipeline stage.',
+                         '# TYPE transcription_stage_seconds histogram',
+                         'transcription_stage_seconds_bucket{stage="speech_queue",le="0.1"} 1',
+                         'transcription_stage_seconds_bucket{stage="speech_queue",le="1"} 2',
+                         'transcription_stage_seconds_bucket{stage="speech_queue",le="+Inf"} 3',
+                         'transcription_stage_seconds_sum{stage="speech_queue"} 5.55',
+                         'transcription_stage_seconds_count{stage="speech_queue"} 3']
+    assert 'transcription_stage_audio_seconds_total{stage="speech_queue"} 60' in lines
+    assert lines[-2:] == ['# TYPE transcription_throttles_total counter', 'transcription_throttles_total{service="open\\"ai"} 3']
+
+def test_metrics_http_server():
+    metrics = Metrics(enabled=True).start_http_server(port=0, host='127.0.0.1')
+    metrics.increment('retries', service='speech')
+    try:
+        port = metrics._server.server_address[1]
+        response = requests.get(f'http://127.0.0.1:{port}/metrics', timeout=5)
+        assert response.status_code == 200
+        assert 'transcription_retries_total{service="speech"} 1' in response.text
+        assert requests.get(f'http://127.0.0.1:{port}/other', timeout=5).status_code == 404
+    finally:
+        metrics.close()
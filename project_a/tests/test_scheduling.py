@@ -0,0 +1,171 @@
+import json
+import time
+
+import pytest
+
+from scheduling import RequestScheduler, TokenBucket, ClientEndpoint, EndpointPool, load_endpoint_pool, estimate_audio_chat_tokens, is_retryable_error, \
+    get_retry_after_seconds
+
+class FakeResponse:
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+
+class FakeAPIError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f'HTTP {status_code}')
+        self.status_code = status_code
+        self.response = FakeResponse(headers)
+
+def fail_then_succeed(errors):
+    """
+    Request function raising the given errors in turn, then returning "ok".
+    """
+    calls = []
+
+    def request_fn(*args):
+        calls.append(args)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return 'ok'
+
+    request_fn.calls = calls
+    return request_fn
+
+def transcribe(client, deployment):
+    return client.audio.transcriptions.create(file=('chunk.mp3', b'\0' * 16000), model=deployment, response_format='verbose_json')
+
+def test_is_retryable_error():
+    assert all(is_retryable_error(FakeAPIError(status_code)) for status_code in (408, 429, 500, 503))
+    assert not any(is_retryable_error(FakeAPIError(status_code)) for status_code in (400, 401, 404))
+    assert not is_retryable_error(ValueError('not an API error'))
+
+def test_get_retry_after_seconds():
+    assert get_retry_after_seconds(FakeAPIError(429, {'retry-after-ms': '1500'})) == 1.5
+    assert get_retry_after_seconds(FakeAPIError(429, {'retry-after': '2'})) == 2
+    assert get_retry_after_seconds(FakeAPIError(429, {'retry-after': 'Wed, 21 Oct 2015 07:28:00 GMT'})) is None
+    assert get_retry_after_seconds(ValueError()) is None
+
+# RequestScheduler
+def test_scheduler_retries_and_halves_concurrency_on_throttling():
+    scheduler = RequestScheduler(max_concurrency=8, base_delay=0.001)
+    request_fn = fail_then_succeed([FakeAPIError(429, {'retry-after': '0'}), FakeAPIError(500)])
+
+    assert scheduler.call(request_fn) == 'ok'
+    assert len(request_fn.calls) == 3
+    assert (scheduler.requests, scheduler.retries, scheduler.throttles) == (3, 2, 1)
+    assert scheduler.concurrency_limit == 4 # Halved by the 429, not grown back by the 500 or a single success
+    assert scheduler.in_flight == 0
+
+def test_scheduler_grows_concurrency_only_on_success():
+    scheduler = RequestScheduler(max_concurrency=4, base_delay=0.001, max_retries=0)
+    scheduler.concurrency_limit = 2
+
+    for _r in range(4):
+        with pytest.raises(FakeAPIError):
+            scheduler.call(fail_then_succeed([FakeAPIError(503)]))
+    assert scheduler.concurrency_limit == 2
+
+    for _r in range(2):
+        scheduler.call(lambda: 'ok')
+    assert scheduler.concurrency_limit == 3
+
+def test_scheduler_does_not_retry_non_retryable_errors():
+    scheduler = RequestScheduler(base_delay=0.001)
+    request_fn = fail_then_succeed([FakeAPIError(400)])
+
+    with pytest.raises(FakeAPIError):
+        scheduler.call(request_fn)
+    assert len(request_fn.calls) == 1 and scheduler.retries == 0
+
+def test_scheduler_gives_up_after_max_retries():
+    scheduler = RequestScheduler(base_delay=0.001, max_retries=2)
+    request_fn = fail_then_succeed([FakeAPIError(500)] * 5)
+
+    with pytest.raises(FakeAPIError):
+        scheduler.call(request_fn)
+    assert len(request_fn.calls) == 3
+
+def test_token_bucket_waits_for_refill():
+    token_bucket = TokenBucket(600) # 10 tokens per second
+    token_bucket.acquire(600)
+
+    start_time = time.monotonic()
+    token_bucket.acquire(2)
+    assert 0.1 <= time.monotonic() - start_time < 1
+
+def test_estimate_audio_chat_tokens_counts_max_tokens():
+    assert estimate_audio_chat_tokens(30, max_tokens=1000) == 1300
+
+# EndpointPool
+def make_endpoint(name, **scheduler_options):
+    return ClientEndpoint(name=name, client=name, deployment='whisper', scheduler=RequestScheduler(base_delay=0.001, **scheduler_options))
+
+def test_pool_single_endpoint_retries_through_its_scheduler():
+    endpoint_pool = EndpointPool([make_endpoint('only')])
+    request_fn = fail_then_succeed([FakeAPIError(429, {'retry-after': '0'})] * 4)
+
+    assert endpoint_pool.call(request_fn) == 'ok'
+    assert endpoint_pool.max_attempts == 1
+    assert len(request_fn.calls) == 5
+    assert endpoint_pool.endpoints[0].scheduler.retries == 4
+
+def test_pool_fails_over_to_another_endpoint():
+    endpoint_pool = EndpointPool([make_endpoint('first'), make_endpoint('second')], cooldown_seconds=60)
+    request_fn = fail_then_succeed([FakeAPIError(503)])
+
+    assert endpoint_pool.call(request_fn) == 'ok'
+    failed_endpoint, = [endpoint for endpoint in endpoint_pool.endpoints if endpoint.failures]
+    healthy_endpoint, = [endpoint for endpoint in endpoint_pool.endpoints if not endpoint.failures]
+    assert [client for client, _ in request_fn.calls] == [failed_endpoint.name, healthy_endpoint.name]
+    assert failed_endpoint.cooldown_until > 0 and failed_endpoint.latency_ewma is None
+    assert healthy_endpoint.latency_ewma is not None
+    assert all(endpoint.in_flight == 0 for endpoint in endpoint_pool.endpoints)
+
+    # The failed endpoint is skipped while it cools down
+    endpoint_pool.call(request_fn)
+    assert request_fn.calls[-1][0] == healthy_endpoint.name
+
+def test_pool_does_not_fail_over_non_retryable_errors():
+    endpoint_pool = EndpointPool([make_endpoint('first'), make_endpoint('second')])
+    request_fn = fail_then_succeed([FakeAPIError(400)])
+
+    with pytest.raises(FakeAPIError):
+        endpoint_pool.call(request_fn)
+    assert len(request_fn.calls) == 1
+    # A bad request says nothing about the endpoint, it is neither put in cooldown nor timed
+    assert all(endpoint.failures == 0 and endpoint.cooldown_until == 0 and endpoint.latency_ewma is None for endpoint in endpoint_pool.endpoints)
+
+def test_pool_max_concurrency_is_sum_over_endpoints():
+    endpoint_pool = EndpointPool([make_endpoint('first', max_concurrency=4), make_endpoint('second', max_concurrency=2)])
+
+    assert endpoint_pool.max_concurrency == 6
+    assert endpoint_pool.max_attempts == 7 # At least as many attempts as one scheduler's retries
+
+# Against the mock Azure OpenAI service
+def test_single_endpoint_pool_rides_out_throttling(start_mock_services):
+    mock = start_mock_services({'openai': {'latency': 0, 'throttle_rate': 0.4, 'retry_after': 0}, 'seed': 1})
+    endpoint_pool = load_endpoint_pool(None, model='whisper', api_version='2024-10-21')
+
+    results = [endpoint_pool.call(transcribe) for _r in range(10)]
+
+    assert all(result.text for result in results)
+    assert mock.stats()['openai transcriptions']['throttled'] > 0
+    assert endpoint_pool.endpoints[0].scheduler.throttles == mock.stats()['openai transcriptions']['throttled']
+
+def test_pool_fails_over_from_unreachable_endpoint(start_mock_services, tmp_path):
+    mock = start_mock_services({'openai': {'latency': 0}})
+    config_path = tmp_path / 'endpoints.json'
+    config_path.write_text(json.dumps([{'name': 'unreachable', 'endpoint': 'http://127.0.0.1:9/', 'model': 'whisper', 'api_key': 'key'},
+                                       {'name': 'mock', 'endpoint': mock.url + '/', 'model': 'whisper', 'api_key': 'key'},
+                                       {'name': 'other-model', 'endpoint': mock.url + '/', 'model': 'gpt-4o-audio-preview', 'api_key': 'key'}]))
+    endpoint_pool = load_endpoint_pool(str(config_path), model='whisper', api_version='2024-10-21', max_concurrency=2)
+
+    results = [endpoint_pool.call(transcribe) for _r in range(4)]
+
+    assert [endpoint.name for endpoint in endpoint_pool.endpoints] == ['unreachable', 'mock']
+    assert endpoint_pool.max_concurrency == 4
+    assert all(result.text for result in results)
+    unreachable_endpoint, mock_endpoint = endpoint_pool.endpoints
+    assert unreachable_endpoint.failures == 1 # Then in cooldown for the rest of the test
+    assert mock_endpoint.requests == 4
+    assert mock.stats()['openai transcriptions']['requests'] == 4
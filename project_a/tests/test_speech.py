@@ -0,0 +1,219 @@
+import json
+import os
+
+import pytest
+
+import utils
+from mock_services import estimate_audio_seconds
+from utils import SpeechModelCatalog, SpeechRestClient, TranscriptionCache, get_speech_region, extract_transcription_content, get_blob_service_client, get_sas_provider, get_output_file_names, transcribe_files_with_speech_batch
+
+MODEL_URL = 'https://eastus.api.cognitive.microsoft.com/speechtotext/v3.2/models/base/mock-0'
+
+@pytest.fixture
+def speech_batch(start_mock_services, tmp_path):
+    """
+    Starts the mock services with Speech jobs that complete at once, and returns a function transcribing files with one batch.
+    """
+    mock = start_mock_services({'blob': {'latency': 0}, 'speech': {'latency': 0}, 'speech_job': {'queue_seconds': 0, 'run_seconds': 0}})
+    blob_service_client = get_blob_service_client(os.environ['STORAGE_BLOB_SAS'])
+    output_path = tmp_path / 'output'
+    output_path.mkdir()
+
+    def _transcribe(file_paths, **batch_options):
+        return transcribe_files_with_speech_batch(file_paths, str(output_path), 'whisper_speech', mock.url, '2024-11-15', 'mock-key', MODEL_URL, 'en-US',
+                                                  blob_service_client, os.environ['STORAGE_CONTAINER_NAME'], os.environ['STORAGE_NAME'],
+                                                  os.environ['STORAGE_KEY'], is_whisper=True, poll_interval=1, **batch_options)
+
+    _transcribe.mock = mock
+    _transcribe.blob_service_client = blob_service_client
+    _transcribe.output_path = output_path
+    return _transcribe
+
+def write_audio_files(tmp_path, sizes):
+    """
+    Writes files of the given sizes as <folder>/x.mp3, so every file has the same name. The mock results have a duration
+    proportional to the size, which tells which file a result belongs to.
+    """
+    file_paths = []
+    for _f, size in enumerate(sizes):
+        (tmp_path / f'folder{_f}').mkdir()
+        file_path = tmp_path / f'folder{_f}' / 'x.mp3'
+        file_path.write_bytes(bytes([_f + 1]) * size)
+        file_paths.append(str(file_path))
+    return file_paths
+
+def test_get_output_file_names_keeps_files_with_the_same_name_apart(tmp_path):
+    file_paths = [os.path.join('audio', 'a', 'x.mp3'), os.path.join('audio', 'b', 'x.mp3')]
+
+    assert get_output_file_names(file_paths) == {file_paths[0]: 'a__x.mp3', file_paths[1]: 'b__x.mp3'}
+    assert get_output_file_names([file_paths[0]]) == {file_paths[0]: 'x.mp3'}
+
+def test_speech_batch_maps_each_result_to_its_file(speech_batch, tmp_path):
+    file_paths = write_audio_files(tmp_path, [16000, 48000, 80000])
+
+    file_statuses = speech_batch(file_paths, max_files_per_job=2)
+
+    assert [file_status['status'] for file_status in file_statuses] == ['succeeded'] * 3
+    assert speech_batch.mock.stats()['speech submit']['requests'] == 2
+    for file_path, file_status in zip(file_paths, file_statuses):
+        assert file_status['usage']['audio_seconds'] == pytest.approx(estimate_audio_seconds(os.path.getsize(file_path)), abs=0.01)
+    output_names = sorted(os.listdir(speech_batch.output_path))
+    assert [name for name in output_names if name.endswith('.txt')] == \
+        [f'whisper_speech_transcript_0_folder{_f}__x.mp3.txt' for _f in range(3)]
+
+def test_speech_batch_splits_job_time_by_audio(speech_batch, tmp_path):
+    file_paths = write_audio_files(tmp_path, [16000, 48000, 80000])
+    transcription_cache = TranscriptionCache(str(tmp_path / 'cache'))
+
+    file_statuses = speech_batch(file_paths, max_files_per_job=2, transcription_cache=transcription_cache)
+
+    jobs = {}
+    for file_status in file_statuses:
+        jobs.setdefault(file_status['usage']['submission_id'], []).append(file_status)
+    assert [len(job_file_statuses) for job_file_statuses in jobs.values()] == [2, 1]
+    for job_file_statuses in jobs.values():
+        job_usage = job_file_statuses[0]['usage']
+        assert sum(file_status['seconds'] for file_status in job_file_statuses) == pytest.approx(job_usage['job_seconds'], abs=0.02)
+        assert job_usage['job_audio_seconds'] == pytest.approx(sum(file_status['usage']['audio_seconds'] for file_status in job_file_statuses))
+    first_job = list(jobs.values())[0]
+    assert first_job[1]['seconds'] == pytest.approx(3 * first_job[0]['seconds'], abs=0.03)
+
+    # Results from the cache take no time
+    cached_file_statuses = speech_batch(file_paths, transcription_cache=transcription_cache)
+    assert [(file_status['usage']['cached'], file_status['seconds']) for file_status in cached_file_statuses] == [(True, 0.0)] * 3
+
+def record_submissions(monkeypatch):
+    submissions = []
+    submit_transcription_request = utils.submit_transcription_request
+
+    def _submit_transcription_request(**kwargs):
+        submissions.append(kwargs)
+        return submit_transcription_request(**kwargs)
+
+    monkeypatch.setattr(utils, 'submit_transcription_request', _submit_transcription_request)
+    return submissions
+
+def test_speech_batch_uses_container_job_for_clean_container(speech_batch, tmp_path, monkeypatch):
+    submissions = record_submissions(monkeypatch)
+    file_paths = write_audio_files(tmp_path, [16000, 32000])
+    sas_provider = get_sas_provider(os.environ['STORAGE_NAME'], os.environ['STORAGE_CONTAINER_NAME'], storage_account_key=os.environ['STORAGE_KEY'])
+
+    file_statuses = speech_batch(file_paths, content_container_url=sas_provider.container_url())
+
+    assert [file_status['status'] for file_status in file_statuses] == ['succeeded'] * 2
+    assert len(submissions) == 1
+    assert submissions[0]['content_container_url'] and not submissions[0]['content_urls']
+
+def test_speech_batch_submits_by_url_when_container_holds_other_blobs(speech_batch, tmp_path, monkeypatch):
+    submissions = record_submissions(monkeypatch)
+    file_paths = write_audio_files(tmp_path, [16000, 32000])
+    container_name = os.environ['STORAGE_CONTAINER_NAME']
+    speech_batch.blob_service_client.get_container_client(container_name).upload_blob('earlier/left.mp3', b'\0' * 1000)
+    sas_provider = get_sas_provider(os.environ['STORAGE_NAME'], container_name, storage_account_key=os.environ['STORAGE_KEY'])
+
+    file_statuses = speech_batch(file_paths, content_container_url=sas_provider.container_url())
+
+    assert [file_status['status'] for file_status in file_statuses] == ['succeeded'] * 2
+    assert len(submissions) == 1
+    assert submissions[0]['content_container_url'] is None and len(submissions[0]['content_urls']) == 2
+    transcribed_urls = [content_url for transcription in speech_batch.mock.transcriptions.values() for content_url in transcription['content_urls']]
+    assert not [content_url for content_url in transcribed_urls if 'left.mp3' in content_url]
+
+@pytest.mark.parametrize('failure', ['throttle_rate', 'failure_rate'])
+def test_speech_rest_client_retries_get_but_not_post(start_mock_services, failure):
+    mock = start_mock_services({'speech': {'latency': 0, 'retry_after': 0, failure: 1.0}})
+    rest_client = SpeechRestClient(max_retries=2, backoff_factor=0)
+    transcriptions_url = f'{mock.url}/speechtotext/transcriptions?api-version=2024-11-15'
+
+    assert rest_client.get(transcriptions_url).status_code in (429, 500)
+    assert rest_client.post(transcriptions_url, json={}).status_code in (429, 500)
+
+    assert mock.stats()['speech list']['requests'] == 3
+    assert mock.stats()['speech submit']['requests'] == 1
+
+def test_speech_rest_client_returns_response_after_transient_errors(start_mock_services):
+    mock = start_mock_services({'speech': {'latency': 0, 'retry_after': 0, 'failure_rate': 0.5}, 'seed': 1})
+    rest_client = SpeechRestClient(max_retries=10, backoff_factor=0)
+
+    for _ in range(5):
+        assert rest_client.get(f'{mock.url}/speechtotext/v3.2/models/base?api-version=2024-11-15').status_code == 200
+    assert mock.stats()['speech models']['failed'] > 0
+
+def test_extract_transcription_content_reads_phrases_and_words():
+    transcription_data = {
+        'durationInTicks': 45_000_000,
+        'combinedRecognizedPhrases': [{'channel': 0, 'display': 'Hello world. Bye.'}],
+        'recognizedPhrases': [
+            {'channel': 0, 'speaker': 1, 'offsetInTicks': 5_000_000, 'durationInTicks': 20_000_000,
+             'nBest': [{'confidence': 0.9, 'display': 'Hello world.',
+                        'displayWords': [{'displayText': 'Hello', 'offsetInTicks': 5_000_000, 'durationInTicks': 8_000_000},
+                                         {'displayText': 'world.', 'offsetInTicks': 14_000_000, 'durationInTicks': 11_000_000}]}]},
+            {'channel': 0, 'speaker': 2, 'offsetInTicks': 30_000_000, 'durationInTicks': 5_000_000,
+             'nBest': [{'confidence': 0.8, 'display': 'Bye.',
+                        'words': [{'word': 'bye', 'offsetInTicks': 30_000_000, 'durationInTicks': 5_000_000, 'confidence': 0.8}]}]},
+            {'channel': 0, 'offsetInTicks': 40_000_000, 'durationInTicks': 1_000_000}]}
+
+    content = extract_transcription_content(transcription_data)
+
+    assert content['text'] == 'Hello world. Bye.'
+    assert content['duration'] == 4.5
+    assert [(phrase['start'], phrase['end'], phrase['speaker'], phrase['text']) for phrase in content['phrases']] == \
+        [(0.5, 2.5, 1, 'Hello world.'), (3.0, 3.5, 2, 'Bye.'), (4.0, 4.1, None, '')]
+    assert [(word['start'], word['end'], word['word'], word['phrase']) for word in content['words']] == \
+        [(0.5, 1.3, 'Hello', 0), (1.4, 2.5, 'world.', 0), (3.0, 3.5, 'bye', 1)]
+    assert extract_transcription_content({}) == {'text': '', 'duration': 0.0, 'phrases': [], 'words': []}
+
+@pytest.fixture
+def model_catalog(start_mock_services, tmp_path):
+    mock = start_mock_services({'speech': {'latency': 0}})
+
+    def _model_catalog():
+        return SpeechModelCatalog(mock.url, '2024-11-15', 'mock-key', cache_dir=str(tmp_path / 'models'))
+
+    _model_catalog.mock = mock
+    return _model_catalog
+
+def test_model_catalog_lists_models_once_and_resolves_urls(model_catalog):
+    assert len(model_catalog().load()) == 4
+    model_catalog_from_cache = model_catalog()
+
+    assert model_catalog_from_cache.resolve_model_url('whisper large v2', 'en-AU').endswith('/models/base/mock-1')
+    assert [model['locale'] for model in model_catalog_from_cache.find(display_name='Batch Transcription')] == ['en-AU', 'en-US']
+    assert model_catalog.mock.stats()['speech models']['requests'] == 1
+
+def test_get_speech_region():
+    assert get_speech_region('https://eastus.api.cognitive.microsoft.com') == 'eastus'
+    assert get_speech_region('http://127.0.0.1:18600') == '127.0.0.1_18600'
+    assert get_speech_region('https://my-speech.cognitiveservices.azure.com/') == 'my-speech.cognitiveservices.azure.com'
+
+def test_model_catalog_without_cache_dir_writes_nothing(model_catalog, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    catalog = SpeechModelCatalog(model_catalog.mock.url, '2024-11-15', 'mock-key', cache_dir=None)
+
+    assert len(catalog.load()) == 4
+    assert catalog.cache_file_path is None and os.listdir(tmp_path) == []
+
+def test_model_catalog_falls_back_to_default_url(model_catalog):
+    assert model_catalog().resolve_model_url('Whisper Large V2', 'fr-FR', default_model_url='https://mock/default') == 'https://mock/default'
+    with pytest.raises(ValueError):
+        model_catalog().resolve_model_url('Whisper Large V2', 'fr-FR')
+
+def test_model_catalog_refreshes_corrupt_cache(model_catalog):
+    catalog = model_catalog()
+    with open(catalog.cache_file_path, 'w') as file:
+        file.write('{"values": [')
+
+    assert len(catalog.load()) == 4
+    with open(catalog.cache_file_path) as file:
+        assert len(json.load(file)['values']) == 4
+
+def test_model_catalog_uses_expired_cache_when_listing_fails(model_catalog, monkeypatch):
+    catalog = model_catalog()
+    catalog.load()
+    catalog.ttl_seconds = 0
+    monkeypatch.setattr(utils, 'get_speech_to_text_models', lambda **kwargs: None)
+
+    assert len(catalog.load(refresh=True)) == 4
+    os.remove(catalog.cache_file_path)
+    with pytest.raises(RuntimeError):
+        catalog.load()
@@ -0,0 +1,140 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import threading
+import time
+
+import pytest
+import requests
+
+from speech_jobs import TranscriptionJobTracker, TranscriptionWebhookReceiver
+
+def scripted_statuses(*statuses):
+    """
+    Returns a get_transcription_fn answering each submission with the given statuses in turn, then the last one.
+    None stands for a failed status request.
+    """
+    calls = {}
+
+    def _get_transcription(submission_id):
+        call = calls[submission_id] = calls.get(submission_id, -1) + 1
+        status = statuses[min(call, len(statuses) - 1)]
+        return {'self': f'https://mock/transcriptions/{submission_id}', 'status': status} if status else None
+
+    _get_transcription.calls = calls
+    return _get_transcription
+
+def test_tracker_polls_until_succeeded_and_processes_results():
+    get_transcription_fn = scripted_statuses('NotStarted', 'Running', 'Running', 'Succeeded')
+    processed = []
+    job_tracker = TranscriptionJobTracker(get_transcription_fn, min_poll_interval=0.01, max_poll_interval=0.02)
+
+    final_responses = job_tracker.run(['a', 'b'], on_succeeded=lambda submission_id, response: processed.append(submission_id))
+
+    assert {submission_id: response['status'] for submission_id, response in final_responses.items()} == {'a': 'Succeeded', 'b': 'Succeeded'}
+    assert sorted(processed) == ['a', 'b']
+    assert get_transcription_fn.calls == {'a': 3, 'b': 3}
+    assert job_tracker.requests == 8
+
+def test_tracker_tracks_single_job_without_track_all():
+    job_tracker = TranscriptionJobTracker(scripted_statuses('Running', 'Failed'), min_poll_interval=0.01)
+
+    assert asyncio.run(job_tracker.track('a'))['status'] == 'Failed'
+    # A second event loop gets its own semaphore
+    assert asyncio.run(job_tracker.track('b'))['status'] == 'Failed'
+
+def test_tracker_gives_up_after_deadline_and_poll_errors():
+    job_tracker = TranscriptionJobTracker(scripted_statuses('Running'), min_poll_interval=0.01, deadline_seconds=0.1)
+    assert job_tracker.run(['a'])['a'] == {'status': 'TimedOut', 'error': 'Not completed within the deadline, last status: Running'}
+
+    job_tracker = TranscriptionJobTracker(scripted_statuses(None), min_poll_interval=0.01, max_poll_interval=0.01, max_poll_errors=3)
+    assert job_tracker.run(['a'])['a']['status'] == 'Failed'
+    assert job_tracker.requests == 3
+
+def test_tracker_reports_failed_result_processing():
+    def on_succeeded(submission_id, response):
+        raise OSError('disk full')
+
+    job_tracker = TranscriptionJobTracker(scripted_statuses('Succeeded'), min_poll_interval=0.01)
+
+    assert job_tracker.run(['a'], on_succeeded=on_succeeded)['a'] == {'status': 'Failed', 'error': 'Processing results failed: disk full'}
+
+def test_tracker_next_poll_interval():
+    job_tracker = TranscriptionJobTracker(scripted_statuses('Running'), min_poll_interval=5, max_poll_interval=120)
+
+    assert job_tracker._next_poll_interval('NotStarted', None, 5, 600) == 5
+    assert job_tracker._next_poll_interval('NotStarted', 'NotStarted', 5, 600) == 10
+    assert job_tracker._next_poll_interval('Running', 'NotStarted', 10, 600) == 30
+    assert job_tracker._next_poll_interval('Running', 'Running', 30, 600) == 45
+    assert job_tracker._next_poll_interval('Running', 'Running', 100, 600) == 120
+
+def test_tracker_notify_from_other_thread_polls_job_at_once():
+    polled = threading.Event()
+    get_transcription_fn = scripted_statuses('Running', 'Succeeded')
+
+    def _get_transcription(submission_id):
+        polled.set()
+        return get_transcription_fn(submission_id)
+
+    job_tracker = TranscriptionJobTracker(_get_transcription, min_poll_interval=60)
+    job_tracker.notify('a') # Before tracking starts, dropped
+
+    def notify_when_polled():
+        polled.wait(5)
+        job_tracker.notify('a')
+
+    notifier = threading.Thread(target=notify_when_polled)
+    notifier.start()
+    start_time = time.time()
+    final_responses = job_tracker.run(['a'])
+    notifier.join()
+
+    assert final_responses['a']['status'] == 'Succeeded'
+    assert time.time() - start_time < 5
+    assert job_tracker.notifications == 1
+    job_tracker.notify('a') # After the event loop has closed
+
+@pytest.fixture
+def webhook_receiver():
+    webhook_receiver = TranscriptionWebhookReceiver(host='127.0.0.1', port=0, secret='mock-secret').start()
+    completed = []
+    webhook_receiver.add_listener(completed.append)
+    webhook_receiver.completed = completed
+    yield webhook_receiver
+    webhook_receiver.stop()
+
+def post_event(webhook_receiver, event_kind, body, signature=None, path='/'):
+    headers = {'X-MicrosoftSpeechServices-Event': event_kind}
+    if signature is not None:
+        headers['X-MicrosoftSpeechServices-Signature'] = signature
+    return requests.post(f'http://127.0.0.1:{webhook_receiver.port}{path}', data=body, headers=headers, timeout=5)
+
+def sign(body, secret='mock-secret'):
+    return hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+def test_webhook_receiver_answers_challenge(webhook_receiver):
+    response = post_event(webhook_receiver, 'Challenge', b'', path='/?validationToken=token-123')
+
+    assert response.status_code == 200 and response.text == 'token-123'
+
+def test_webhook_receiver_calls_listeners_with_submission_id(webhook_receiver):
+    body = json.dumps({'self': 'https://eastus.api.cognitive.microsoft.com/speechtotext/transcriptions/job-1?api-version=2024-11-15'}).encode()
+
+    assert post_event(webhook_receiver, 'TranscriptionCompletion', body, sign(body)).status_code == 200
+    assert post_event(webhook_receiver, 'TranscriptionCreation', body, sign(body)).status_code == 200
+
+    # Listeners are called after the response is sent
+    deadline = time.time() + 5
+    while not webhook_receiver.completed and time.time() < deadline:
+        time.sleep(0.01)
+    assert webhook_receiver.completed == ['job-1']
+    assert webhook_receiver.events == 1
+
+def test_webhook_receiver_rejects_bad_signature_and_body(webhook_receiver):
+    body = json.dumps({'self': 'https://mock/transcriptions/job-1'}).encode()
+
+    assert post_event(webhook_receiver, 'TranscriptionCompletion', body, sign(body, 'other-secret')).status_code == 401
+    assert post_event(webhook_receiver, 'TranscriptionCompletion', body).status_code == 401
+    assert post_event(webhook_receiver, 'TranscriptionCompletion', b'{not json', sign(b'{not json')).status_code == 400
+    assert webhook_receiver.completed == []
@@ -0,0 +1,93 @@
+import base64
+import hashlib
+import os
+import urllib.parse
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from utils import SasProvider, estimate_sas_expiry_minutes, get_blob_service_client, get_sas_provider, upload_binary_data_to_azure_storage, \
+    upload_files_to_azure_storage
+
+@pytest.fixture
+def blob_storage(start_mock_services):
+    mock = start_mock_services({'blob': {'latency': 0}})
+    return mock, get_blob_service_client(os.environ['STORAGE_BLOB_SAS'])
+
+def upload(blob_service_client, binary_data, **upload_kwargs):
+    return upload_binary_data_to_azure_storage(blob_service_client, 'audio', 'uploads', 'x.bin', binary_data, **upload_kwargs)
+
+def test_upload_skips_unchanged_blob(blob_storage):
+    mock, blob_service_client = blob_storage
+
+    assert upload(blob_service_client, b'first') is True
+    assert upload(blob_service_client, b'first') is False
+    assert upload(blob_service_client, b'second') is True
+    assert upload(blob_service_client, b'second', skip_if_unchanged=False) is True
+    assert mock.blobs['/devstoreaccount1/audio/uploads/x.bin'][0] == b'second'
+
+def test_upload_stages_blocks_of_large_file(blob_storage, tmp_path):
+    mock, blob_service_client = blob_storage
+    data = os.urandom(10 * 1024)
+    (tmp_path / 'x.bin').write_bytes(data)
+
+    with open(tmp_path / 'x.bin', 'rb') as stream:
+        assert upload(blob_service_client, stream, block_size=4096, max_concurrency=2) is True
+    with open(tmp_path / 'x.bin', 'rb') as stream:
+        assert upload(blob_service_client, stream, block_size=4096, max_concurrency=2) is False
+
+    stored_data, stored_md5 = mock.blobs['/devstoreaccount1/audio/uploads/x.bin']
+    assert stored_data == data
+    assert stored_md5 == base64.b64encode(hashlib.md5(data).digest()).decode()
+
+def test_upload_files_returns_outcome_per_file(blob_storage, tmp_path):
+    mock, blob_service_client = blob_storage
+    for name in ('a.wav', 'b.wav'):
+        (tmp_path / name).write_bytes(name.encode() * 100)
+    uploads = [(str(tmp_path / name), 'uploads', name) for name in ('a.wav', 'b.wav', 'missing.wav')]
+
+    first_results = upload_files_to_azure_storage(blob_service_client, 'audio', uploads[:2])
+    results = upload_files_to_azure_storage(blob_service_client, 'audio', uploads)
+
+    assert first_results == [True, True]
+    assert results[:2] == [False, False]
+    assert isinstance(results[2], FileNotFoundError)
+
+STORAGE_KEY = base64.b64encode(b'mock-storage-account-key').decode()
+
+def sas_query(url):
+    return urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)
+
+def test_estimate_sas_expiry_minutes():
+    assert estimate_sas_expiry_minutes() == 60
+    assert estimate_sas_expiry_minutes(audio_duration_seconds=3 * 60 * 60, queued_jobs=4) == 240
+    assert estimate_sas_expiry_minutes(audio_duration_seconds=100 * 60 * 60, queued_jobs=100) == 24 * 60
+
+def test_sas_provider_signs_once_per_container_and_permission():
+    sas_provider = SasProvider('account', 'audio', storage_account_key=STORAGE_KEY)
+
+    blob_urls = [sas_provider.blob_url('uploads', f'file {_f}.wav', expiry_minutes=30) for _f in range(100)]
+    container_url = sas_provider.container_url()
+
+    assert sas_provider.tokens_signed == 2
+    assert blob_urls[1].startswith('https://account.blob.core.windows.net/audio/uploads/file%201.wav?')
+    assert sas_query(blob_urls[0]) == sas_query(blob_urls[99])
+    assert sas_query(blob_urls[0])['sp'] == ['r'] and sas_query(container_url)['sp'] == ['rl']
+    assert container_url.startswith('https://account.blob.core.windows.net/audio?')
+
+def test_sas_provider_signs_again_when_token_does_not_cover_expiry():
+    sas_provider = SasProvider('account', 'audio', storage_account_key=STORAGE_KEY, refresh_margin_minutes=10)
+
+    sas_provider.blob_url('uploads', 'a.wav', expiry_minutes=60)
+    sas_provider.blob_url('uploads', 'a.wav', expiry_minutes=65)
+    assert sas_provider.tokens_signed == 1
+    blob_url = sas_provider.blob_url('uploads', 'a.wav', expiry_minutes=120)
+    assert sas_provider.tokens_signed == 2
+
+    expiry_time = datetime.strptime(sas_query(blob_url)['se'][0], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+    assert abs(expiry_time - (datetime.now(timezone.utc) + timedelta(minutes=130))) < timedelta(minutes=1)
+
+def test_sas_provider_needs_key_or_client():
+    with pytest.raises(ValueError):
+        SasProvider('account', 'audio')
+    assert get_sas_provider('account', 'shared', storage_account_key=STORAGE_KEY) is get_sas_provider('account', 'shared')
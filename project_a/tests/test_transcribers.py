@@ -0,0 +1,136 @@
+import json
+
+import pytest
+
+import transcribers
+from transcribers import Transcriber, RoutingTranscriber, BackendStats, BACKEND_PROFILES, SPEECH_BACKEND_MODELS
+
+AUDIO_DURATIONS = {'short.mp3': 60, 'long.mp3': 4 * 60 * 60, 'long2.mp3': 2 * 60 * 60}
+
+class FakeTranscriber(Transcriber):
+    def __init__(self, backend, **options):
+        super().__init__()
+        self.backend = backend
+        self.options = options
+        self.file_paths = []
+
+    def transcribe_file(self, file_path, output_path, usage=None):
+        self.file_paths.append(file_path)
+        if file_path.startswith('bad'):
+            raise ValueError(f'cannot decode {file_path}')
+        if usage is not None:
+            usage['audio_seconds'] = 60
+        return [f'{output_path}/{self.backend}_{file_path}.txt']
+
+class FakeBatchTranscriber(FakeTranscriber):
+    """
+    Transcribes all files in one job of 900 seconds, reporting them as transcribe_files_with_speech_batch does.
+    """
+
+    def transcribe_files(self, file_paths, output_path, max_workers=4):
+        self.file_paths.extend(file_paths)
+        job_audio_seconds = sum(AUDIO_DURATIONS[file_path] for file_path in file_paths)
+        return [{'file_path': file_path, 'status': 'succeeded', 'outputs': [], 'error': None, 
+                 'seconds': round(900.0 * AUDIO_DURATIONS[file_path] / job_audio_seconds, 2), 
+                 'usage': {'submission_id': 'job-1', 'audio_seconds': AUDIO_DURATIONS[file_path], 'job_seconds': 900.0, 'job_audio_seconds': job_audio_seconds}}
+                for file_path in file_paths]
+
+def create_fake_transcriber(backend, **options):
+    return (FakeBatchTranscriber if backend in SPEECH_BACKEND_MODELS else FakeTranscriber)(backend, **options)
+
+def test_transcriber_needs_transcribe_file():
+    class IncompleteTranscriber(Transcriber):
+        pass
+
+    with pytest.raises(TypeError):
+        Transcriber()
+    with pytest.raises(TypeError):
+        IncompleteTranscriber()
+
+def test_transcriber_transcribes_files_and_records_outcomes(tmp_path):
+    transcriber = FakeTranscriber('whisper')
+
+    file_statuses = transcriber.transcribe_files(['a.mp3', 'bad.mp3', 'c.mp3'], str(tmp_path), max_workers=2)
+
+    assert [(file_status['file_path'], file_status['status']) for file_status in file_statuses] == \
+        [('a.mp3', 'succeeded'), ('bad.mp3', 'failed'), ('c.mp3', 'succeeded')]
+    assert file_statuses[0]['outputs'] == [f'{tmp_path}/whisper_a.mp3.txt']
+    assert file_statuses[0]['usage']['audio_seconds'] == 60
+    assert file_statuses[1]['error'] == 'cannot decode bad.mp3'
+    assert sorted(transcriber.file_paths) == ['a.mp3', 'bad.mp3', 'c.mp3']
+
+@pytest.fixture
+def make_router(tmp_path, monkeypatch):
+    monkeypatch.setattr(transcribers, 'get_audio_duration_seconds', lambda file_path: AUDIO_DURATIONS[file_path])
+
+    def _make_router(**options):
+        return RoutingTranscriber(cache_dir=str(tmp_path), transcriber_factory=create_fake_transcriber, **options)
+
+    return _make_router
+
+def test_router_sends_short_files_to_whisper_and_long_files_to_speech(make_router):
+    router = make_router()
+
+    assert router.choose_backend('short.mp3') == ('whisper', 60)
+    assert router.choose_backend('long.mp3')[0] in ('whisper_speech', 'base_speech')
+
+def test_router_skips_backends_missing_features_or_locale(make_router):
+    assert make_router(require_diarization=True).choose_backend('short.mp3')[0] in ('whisper_speech', 'base_speech')
+    assert make_router(require_word_timestamps=True, locale='fr-FR').choose_backend('short.mp3')[0] == 'whisper_speech'
+
+    with pytest.raises(ValueError):
+        make_router(backends=('base_speech',), locale='fr-FR').choose_backend('short.mp3')
+
+def test_router_applies_latency_sla_and_cost_budget(make_router):
+    # Without a price on latency the cheapest backend wins, unless its job queue would break the SLA
+    assert make_router(latency_cost_per_hour=0).choose_backend('short.mp3')[0] in ('whisper_speech', 'base_speech')
+    assert make_router(latency_cost_per_hour=0, latency_sla_seconds=60).choose_backend('short.mp3')[0] == 'whisper'
+    assert make_router(cost_budget_per_hour=0.2).choose_backend('short.mp3')[0] in ('whisper_speech', 'base_speech')
+
+def test_router_uses_measured_speed(make_router, tmp_path):
+    (tmp_path / 'backend_stats.json').write_text(json.dumps({'whisper': {'seconds_per_audio_second': 0.01, 'files': 1, 'audio_seconds': 60}}))
+    router = make_router()
+
+    latency_seconds, cost = router.estimate('whisper', 3600)
+
+    assert latency_seconds == pytest.approx(BACKEND_PROFILES['whisper']['overhead_seconds'] + 36)
+    assert cost == pytest.approx(BACKEND_PROFILES['whisper']['cost_per_hour'])
+
+def test_router_groups_files_by_backend(make_router, tmp_path):
+    router = make_router(locale='en-US')
+
+    file_statuses = router.transcribe_files(['long.mp3', 'short.mp3'], str(tmp_path))
+
+    assert [(file_status['file_path'], file_status['backend']) for file_status in file_statuses] == \
+        [('long.mp3', router.choose_backend('long.mp3')[0]), ('short.mp3', 'whisper')]
+    assert router.transcribers['whisper'].file_paths == ['short.mp3']
+    speech_transcriber = router.transcribers[file_statuses[0]['backend']]
+    assert speech_transcriber.options == {'cache_dir': str(tmp_path), 'locale': 'en-US'}
+    assert 'locale' not in router.transcribers['whisper'].options
+    assert router.routed_files == {speech_transcriber.backend: 1, 'whisper': 1}
+    # The speed measured on the Speech file is saved for the next run
+    assert json.loads((tmp_path / 'backend_stats.json').read_text())[speech_transcriber.backend]['files'] == 1
+
+def test_router_measures_speech_batch_per_job(make_router, tmp_path):
+    router = make_router(backends=('whisper_speech',))
+
+    file_statuses = router.transcribe_files(['long.mp3', 'long2.mp3'], str(tmp_path))
+
+    assert [file_status['seconds'] for file_status in file_statuses] == [600.0, 300.0]
+    # One observation of the whole job, not the job time once per file
+    backend_stats = router.backend_stats.stats['whisper_speech']
+    assert backend_stats['files'] == 2 and backend_stats['audio_seconds'] == 6 * 60 * 60
+    assert backend_stats['seconds_per_audio_second'] == pytest.approx((900 - BACKEND_PROFILES['whisper_speech']['overhead_seconds']) / (6 * 60 * 60))
+
+def test_backend_stats_ignores_cached_files(tmp_path):
+    backend_stats = BackendStats(str(tmp_path / 'stats' / 'backend_stats.json'), smoothing=0.5)
+
+    backend_stats.record('whisper', 600, 0.5) # Answered from the cache, faster than the backend's overhead
+    assert backend_stats.seconds_per_audio_second('whisper') == BACKEND_PROFILES['whisper']['seconds_per_audio_second']
+
+    backend_stats.record('whisper', 600, BACKEND_PROFILES['whisper']['overhead_seconds'] + 60)
+    backend_stats.record('whisper', 600, BACKEND_PROFILES['whisper']['overhead_seconds'] + 120)
+    assert backend_stats.seconds_per_audio_second('whisper') == pytest.approx(0.15)
+
+    backend_stats.save()
+    assert BackendStats(backend_stats.stats_file_path).stats == backend_stats.stats
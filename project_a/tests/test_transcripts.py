@@ -0,0 +1,65 @@
+import pytest
+
+from transcripts import transcript_from_verbose_json, transcript_from_speech_content, transcript_from_chunks, write_transcripts, \
+    read_transcripts, save_transcript, combine_transcripts
+
+def whisper_transcript():
+    result = {'text': 'Hello world. Bye.', 'language': 'english', 'duration': 4.0,
+              'segments': [{'start': 0.0, 'end': 2.0, 'text': ' Hello world.'}, {'start': 2.5, 'end': 4.0, 'text': ' Bye.'}],
+              'words': [{'start': 0.1, 'end': 0.6, 'word': 'Hello'}, {'start': 0.7, 'end': 1.9, 'word': 'world.'},
+                        {'start': 2.6, 'end': 3.0, 'word': 'Bye.'}]}
+    return transcript_from_verbose_json(result, 'a.wav', model='whisper-1')
+
+def speech_transcript():
+    transcription_content = {'text': 'Hi. Hello.', 'duration': 3.0,
+                             'phrases': [{'start': 1.0, 'end': 2.0, 'channel': 1, 'speaker': 2, 'confidence': 0.8, 'text': 'Hello.'},
+                                         {'start': 0.0, 'end': 0.5, 'channel': 0, 'speaker': 1, 'confidence': 0.9, 'text': 'Hi.'}],
+                             'words': [{'start': 1.0, 'end': 2.0, 'word': 'Hello.', 'confidence': 0.8, 'phrase': 0},
+                                       {'start': 0.0, 'end': 0.5, 'word': 'Hi.', 'confidence': 0.9, 'phrase': 1}]}
+    return transcript_from_speech_content(transcription_content, 'b.wav', 'base_speech', model='mock-model', locale='en-AU')
+
+def test_transcript_from_verbose_json_assigns_words_to_segments():
+    transcript = whisper_transcript()
+
+    assert [segment['text'] for segment in transcript['segments']] == ['Hello world.', 'Bye.']
+    assert [[word['word'] for word in segment['words']] for segment in transcript['segments']] == [['Hello', 'world.'], ['Bye.']]
+    assert transcript['segments'][0]['speaker'] is None
+
+def test_transcript_from_speech_content_orders_channels_by_time():
+    transcript = speech_transcript()
+
+    assert [(segment['id'], segment['text'], segment['speaker']) for segment in transcript['segments']] == [(0, 'Hi.', 1), (1, 'Hello.', 2)]
+    assert transcript['segments'][0]['words'] == [{'start': 0.0, 'end': 0.5, 'word': 'Hi.', 'confidence': 0.9}]
+    assert transcript['language'] == 'en-AU'
+
+def test_transcript_from_chunks_skips_empty_chunks():
+    transcript = transcript_from_chunks([(0.0, 10.0, ' One '), (10.0, 20.0, None), (20.0, 25.0, 'Three')], 'c.wav')
+
+    assert [(segment['start'], segment['text']) for segment in transcript['segments']] == [(0.0, 'One'), (20.0, 'Three')]
+    assert transcript['duration'] == 25.0 and transcript['text'] == 'One Three'
+
+@pytest.mark.parametrize('extension', ['jsonl', 'parquet'])
+def test_transcripts_round_trip(tmp_path, extension):
+    if extension == 'parquet':
+        pytest.importorskip('pyarrow')
+    transcripts = [whisper_transcript(), speech_transcript()]
+    file_path = str(tmp_path / f'transcripts.{extension}')
+
+    write_transcripts(transcripts, file_path)
+
+    assert read_transcripts(file_path) == [dict(transcript, text=' '.join(segment['text'] for segment in transcript['segments']))
+                                           for transcript in transcripts]
+
+def test_combine_transcripts_skips_other_outputs(tmp_path):
+    transcript_paths = [save_transcript(whisper_transcript(), str(tmp_path), 'whisper', 'a.wav'),
+                        save_transcript(speech_transcript(), str(tmp_path), 'base_speech', 'b.wav')]
+    (tmp_path / 'whisper_transcript_a.wav.txt').write_text('Hello world. Bye.')
+
+    assert combine_transcripts(transcript_paths + [str(tmp_path / 'whisper_transcript_a.wav.txt')], str(tmp_path / 'all.jsonl')) == 2
+    assert [transcript['source'] for transcript in read_transcripts(str(tmp_path / 'all.jsonl'))] == ['a.wav', 'b.wav']
+
+def test_unknown_transcript_format(tmp_path):
+    with pytest.raises(ValueError):
+        save_transcript(whisper_transcript(), str(tmp_path), 'whisper', 'a.wav', transcript_format='csv')
+    with pytest.raises(ValueError):
+        write_transcripts([whisper_transcript()], str(tmp_path / 'transcripts.csv'))
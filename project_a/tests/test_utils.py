@@ -0,0 +1,447 @@
+import base64
+import json
+import os
+import threading
+import time
+import wave
+from io import BytesIO
+
+import pytest
+from openai.types.audio import TranscriptionVerbose
+from openai.types.chat import ChatCompletion
+from pydub import AudioSegment
+from pydub.generators import Sine
+
+from utils import run_concurrently, split_audio_stream, find_silence_split_point, _read_wav_stream_header, TranscriptionCache, \
+    make_cache_key, is_completed_chunk_result, transcribe_file_with_4o_audio, stitch_transcription_parts, transcribe_file_with_whisper, \
+    _wav_header, export_chunk_to_base64, export_chunk_to_bytes, list_audio_files, transcribe_files_concurrently, transcribe_chunks_pipelined
+from scheduling import load_endpoint_pool
+
+FRAME_RATE = 16000
+
+def tone(duration_ms, volume_db=-6):
+    return Sine(440, sample_rate=FRAME_RATE).to_audio_segment(duration=duration_ms, volume=volume_db).set_channels(1)
+
+def silence(duration_ms):
+    return AudioSegment.silent(duration=duration_ms, frame_rate=FRAME_RATE)
+
+def write_wav(tmp_path, audio, name='audio.wav'):
+    file_path = str(tmp_path / name)
+    audio.export(file_path, format='wav')
+    return file_path
+
+# Concurrent runs
+def test_run_concurrently_keeps_item_order():
+    def transcribe_chunk(chunk_index, chunk):
+        time.sleep(0.01 * (5 - chunk_index)) # Later chunks finish first
+        return chunk.upper()
+
+    assert run_concurrently(['a', 'b', 'c', 'd', 'e'], transcribe_chunk, max_concurrency=3) == ['A', 'B', 'C', 'D', 'E']
+
+def test_run_concurrently_returns_exceptions_in_place():
+    def transcribe_chunk(chunk_index, chunk):
+        if chunk_index == 1:
+            raise ValueError('bad chunk')
+        return chunk
+
+    results = run_concurrently(['a', 'b', 'c'], transcribe_chunk)
+
+    assert results[0] == 'a' and results[2] == 'c'
+    assert isinstance(results[1], ValueError)
+
+def test_run_concurrently_bounds_items_in_flight():
+    lock = threading.Lock()
+    counts = {'taken': 0, 'completed': 0, 'in_flight': 0, 'max_in_flight': 0, 'max_held': 0}
+
+    def chunks():
+        for chunk_index in range(12):
+            with lock:
+                counts['taken'] += 1
+                counts['max_held'] = max(counts['max_held'], counts['taken'] - counts['completed'])
+            yield chunk_index
+
+    def transcribe_chunk(chunk_index, chunk):
+        with lock:
+            counts['in_flight'] += 1
+            counts['max_in_flight'] = max(counts['max_in_flight'], counts['in_flight'])
+        time.sleep(0.01)
+        with lock:
+            counts['in_flight'] -= 1
+            counts['completed'] += 1
+        return chunk
+
+    assert run_concurrently(chunks(), transcribe_chunk, max_concurrency=2) == list(range(12))
+    assert counts['max_in_flight'] == 2
+    # Chunks are taken lazily, the one waiting for a free slot aside
+    assert counts['max_held'] <= 3
+
+# Chunk pipeline
+def test_transcribe_chunks_pipelined_keeps_chunk_order():
+    written = {}
+
+    def send_chunk(chunk_index, chunk, payload):
+        time.sleep(0.01 * (5 - chunk_index)) # Later chunks finish first
+        return payload
+
+    results = transcribe_chunks_pipelined(['a', 'b', 'c', 'd', 'e'], str.upper, send_chunk, write_result_fn=written.__setitem__, max_concurrency=3)
+
+    assert results == ['A', 'B', 'C', 'D', 'E']
+    assert written == {0: 'A', 1: 'B', 2: 'C', 3: 'D', 4: 'E'}
+
+def test_transcribe_chunks_pipelined_skips_checkpointed_chunks():
+    exported, written = [], {}
+
+    def export_chunk(chunk):
+        exported.append(chunk)
+        return chunk.upper()
+
+    results = transcribe_chunks_pipelined(['a', 'b', 'c'], export_chunk, lambda chunk_index, chunk, payload: payload,
+                                          skip_chunk_fn=lambda chunk_index, chunk: 'saved b' if chunk == 'b' else None,
+                                          write_result_fn=written.__setitem__)
+
+    assert results == ['A', 'saved b', 'C']
+    assert sorted(exported) == ['a', 'c']
+    # Skipped chunks already have their result written
+    assert written == {0: 'A', 2: 'C'}
+
+def test_transcribe_chunks_pipelined_returns_exceptions_in_place():
+    def export_chunk(chunk):
+        if chunk == 'b':
+            raise ValueError('bad export')
+        return chunk
+
+    def send_chunk(chunk_index, chunk, payload):
+        if chunk == 'c':
+            raise ConnectionError('bad request')
+        return payload
+
+    results = transcribe_chunks_pipelined(['a', 'b', 'c', 'd'], export_chunk, send_chunk)
+
+    assert results[0] == 'a' and results[3] == 'd'
+    assert isinstance(results[1], ValueError) and isinstance(results[2], ConnectionError)
+
+def test_transcribe_chunks_pipelined_holds_back_decoding():
+    lock = threading.Lock()
+    counts = {'taken': 0, 'completed': 0, 'max_held': 0}
+
+    def chunks():
+        for chunk_index in range(20):
+            with lock:
+                counts['taken'] += 1
+                counts['max_held'] = max(counts['max_held'], counts['taken'] - counts['completed'])
+            yield chunk_index
+
+    def send_chunk(chunk_index, chunk, payload):
+        time.sleep(0.01)
+        with lock:
+            counts['completed'] += 1
+        return payload
+
+    assert transcribe_chunks_pipelined(chunks(), str, send_chunk, max_concurrency=1, max_queued_chunks=1) == [str(_c) for _c in range(20)]
+    # One chunk in each queue and in each stage, however slow the requests are
+    assert counts['max_held'] <= 6
+
+# Splitting
+def test_split_audio_stream_fixed_length_chunks(tmp_path):
+    file_path = write_wav(tmp_path, tone(5000))
+
+    chunks = list(split_audio_stream(file_path, chunk_length=2))
+
+    assert [offset_ms for offset_ms, _ in chunks] == [0, 2000, 4000]
+    assert [len(chunk) for _, chunk in chunks] == [2000, 2000, 1000]
+    assert all(chunk.frame_rate == FRAME_RATE and chunk.channels == 1 and chunk.sample_width == 2 for _, chunk in chunks)
+
+def test_split_audio_stream_stops_decoder_when_abandoned(tmp_path):
+    file_path = write_wav(tmp_path, tone(10000))
+    chunks = split_audio_stream(file_path, chunk_length=1)
+
+    assert next(chunks)[0] == 0
+    chunks.close() # Runs the finally block, which kills and reaps ffmpeg
+
+def test_split_audio_stream_reports_decode_errors(tmp_path):
+    file_path = tmp_path / 'broken.mp3'
+    file_path.write_bytes(b'not audio')
+
+    with pytest.raises(RuntimeError, match='ffmpeg failed'):
+        list(split_audio_stream(str(file_path)))
+
+def test_split_audio_stream_cuts_in_pauses(tmp_path):
+    audio = tone(1800) + silence(600) + tone(1800) + silence(600) + tone(1800)
+    file_path = write_wav(tmp_path, audio)
+
+    chunks = list(split_audio_stream(file_path, chunk_length=2, split_on_silence=True, search_window=1))
+
+    offsets = [offset_ms for offset_ms, _ in chunks]
+    assert len(chunks) == 3
+    assert 1800 <= offsets[1] <= 2400
+    assert 4200 <= offsets[2] <= 4800
+    # Chunks are contiguous and cover the whole file
+    assert [offset_ms + len(chunk) for offset_ms, chunk in chunks[:-1]] == offsets[1:]
+    assert offsets[-1] + len(chunks[-1][1]) == len(audio)
+
+def test_split_audio_stream_drops_silent_chunks(tmp_path):
+    file_path = write_wav(tmp_path, tone(2000) + silence(3000) + tone(2000))
+
+    chunks = list(split_audio_stream(file_path, chunk_length=2, split_on_silence=True, search_window=1))
+
+    assert len(chunks) == 2
+    assert chunks[0][0] == 0
+    assert chunks[1][0] >= 4000
+
+def test_split_audio_stream_keeps_short_tail_in_last_chunk(tmp_path):
+    file_path = write_wav(tmp_path, tone(2500))
+
+    chunks = list(split_audio_stream(file_path, chunk_length=2, split_on_silence=True, search_window=1))
+
+    assert [(offset_ms, len(chunk)) for offset_ms, chunk in chunks] == [(0, 2500)]
+
+def test_find_silence_split_point_prefers_pause():
+    segment = tone(1000) + silence(500) + tone(1000)
+
+    assert 1000 <= find_silence_split_point(segment, 0, 2500) <= 1500
+
+def test_find_silence_split_point_prefers_pause_nearest_the_middle():
+    segment = silence(400) + tone(1000) + silence(400) + tone(1000) + silence(400)
+
+    assert 1400 <= find_silence_split_point(segment, 0, 3200) <= 1800
+
+def test_find_silence_split_point_without_pause_cuts_at_quietest_point():
+    segment = tone(1000) + tone(500, volume_db=-30) + tone(1000)
+
+    assert 1000 <= find_silence_split_point(segment, 0, 2500) <= 1500
+
+def test_read_wav_stream_header_skips_other_chunks():
+    audio = tone(100)
+    wav_buffer = BytesIO()
+    audio.export(wav_buffer, format='wav')
+    wav_data = wav_buffer.getvalue()
+    list_chunk = b'LIST' + (3).to_bytes(4, 'little') + b'abc\x00' # Odd sized chunk with its pad byte
+    stream = BytesIO(wav_data[:36] + list_chunk + wav_data[36:])
+
+    assert _read_wav_stream_header(stream) == (1, FRAME_RATE, 2)
+    assert stream.read() == audio.raw_data
+
+def test_read_wav_stream_header_rejects_other_formats():
+    with pytest.raises(ValueError):
+        _read_wav_stream_header(BytesIO(b'ID3' + bytes(100)))
+
+# Transcription cache
+def test_make_cache_key_depends_on_every_key_part():
+    key = make_cache_key(audio_hash='abc', deployment='whisper', temperature=0)
+
+    assert key == make_cache_key(temperature=0, deployment='whisper', audio_hash='abc')
+    assert key != make_cache_key(audio_hash='abc', deployment='whisper', temperature=0.2)
+
+def test_transcription_cache_round_trip(tmp_path):
+    cache = TranscriptionCache(str(tmp_path))
+
+    assert cache.get('key') is None
+    cache.put('key', {'text': 'Hello'})
+
+    assert cache.get('key') == {'text': 'Hello'}
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+
+def test_transcription_cache_expires_old_entries(tmp_path):
+    cache = TranscriptionCache(str(tmp_path), max_age_days=1)
+    cache.put('key', {'text': 'Hello'})
+    entry_path = tmp_path / 'key.json'
+    two_days_ago = time.time() - 2 * 24 * 60 * 60
+    os.utime(entry_path, (two_days_ago, two_days_ago))
+
+    assert cache.get('key') is None
+    assert not entry_path.exists()
+    assert cache._size_bytes == 0
+
+def test_transcription_cache_ignores_corrupt_entries(tmp_path):
+    cache = TranscriptionCache(str(tmp_path))
+    (tmp_path / 'key.json').write_text('{"text": ')
+
+    assert cache.get('key') is None
+
+def test_transcription_cache_evicts_oldest_entries(tmp_path):
+    cache = TranscriptionCache(str(tmp_path), max_size_mb=2000 / (1024 * 1024))
+    value = {'text': 'x' * 200}
+    entry_size = len(json.dumps(value))
+    start_time = time.time() - 1000
+
+    for _e in range(20):
+        cache.put(f'key{_e}', value)
+        os.utime(tmp_path / f'key{_e}.json', (start_time + _e, start_time + _e)) # Distinct ages, oldest first
+
+    entry_names = sorted(os.listdir(tmp_path))
+    assert len(entry_names) * entry_size <= cache.max_size_bytes
+    assert 'key19.json' in entry_names and 'key0.json' not in entry_names
+    assert cache.get('key19') == value
+
+def test_transcription_cache_scans_only_when_over_limit(tmp_path, monkeypatch):
+    cache = TranscriptionCache(str(tmp_path), max_size_mb=1)
+    scans = []
+    evict = cache.evict
+    monkeypatch.setattr(cache, 'evict', lambda: scans.append(1) or evict())
+
+    for _e in range(50):
+        cache.put(f'key{_e}', {'text': 'x' * 100})
+
+    assert len(scans) == 1 # The first put counts the existing entries
+    assert cache._size_bytes == sum(entry.stat().st_size for entry in os.scandir(tmp_path))
+
+# Chunk checkpoints
+def make_chat_completion(finish_reason, content='Transcript.'):
+    return ChatCompletion.model_validate({'id': 'chatcmpl-test', 'object': 'chat.completion', 'created': 0, 'model': 'gpt-4o-audio-preview',
+                                          'choices': [{'index': 0, 'finish_reason': finish_reason, 'message': {'role': 'assistant', 'content': content}}]})
+
+def test_is_completed_chunk_result():
+    assert is_completed_chunk_result(make_chat_completion('stop'))
+    assert not is_completed_chunk_result(make_chat_completion('length'))
+    assert not is_completed_chunk_result(make_chat_completion('content_filter'))
+    assert not is_completed_chunk_result(RuntimeError('request failed'))
+
+def transcribe_with_4o_audio(file_path, output_path, chunk_checkpoint, usage):
+    endpoint_pool = load_endpoint_pool(None, model='gpt-4o-audio-preview', api_version='2025-01-01-preview')
+    endpoint_pool.endpoints[0].scheduler.max_retries = 0 # Leave the failed chunks to the rerun
+    endpoint_pool.cooldown_seconds = 0
+    # One request at a time, so the mock's random failures hit the same chunks on every run
+    return transcribe_file_with_4o_audio(endpoint_pool, file_path, output_path, 'System message.', 'Transcribe.', chunk_checkpoint=chunk_checkpoint, 
+                                         chunk_length=1, split_on_silence=False, max_concurrency=1, transcript_format=None, usage=usage)
+
+def test_4o_audio_rerun_only_sends_missing_chunks(tmp_path, start_mock_services):
+    mock = start_mock_services({'openai': {'latency': 0, 'failure_rate': 0.4, 'retry_after': 0}, 'seed': 3})
+    file_path = write_wav(tmp_path, tone(8000))
+    chunk_checkpoint = TranscriptionCache(str(tmp_path / 'checkpoints'))
+
+    first_usage = {}
+    output_file_path, = transcribe_with_4o_audio(file_path, str(tmp_path), chunk_checkpoint, first_usage)
+    failed_chunks = mock.stats()['openai chat']['failed']
+    assert 0 < failed_chunks < 8
+    assert len([name for name in os.listdir(tmp_path / 'checkpoints') if name.endswith('.json')]) == 8 - failed_chunks
+
+    mock.config['openai']['failure_rate'] = 0
+    second_usage = {}
+    transcribe_with_4o_audio(file_path, str(tmp_path), chunk_checkpoint, second_usage)
+
+    assert second_usage['requests'] == failed_chunks
+    assert second_usage['chunks'] == 8
+    with open(output_file_path) as file:
+        assert 'Skipped' not in file.read()
+
+# Stitching
+def make_transcription(text, duration, segments, words):
+    return TranscriptionVerbose.model_validate({
+        'text': text, 'duration': duration, 'language': 'english',
+        'segments': [{'id': _s, 'seek': 0, 'start': start, 'end': end, 'text': segment_text, 'tokens': [], 'temperature': 0.0,
+                      'avg_logprob': -0.2, 'compression_ratio': 1.2, 'no_speech_prob': 0.01}
+                     for _s, (start, end, segment_text) in enumerate(segments)],
+        'words': [{'word': word, 'start': start, 'end': end} for word, start, end in words]})
+
+def test_stitch_transcription_parts_shifts_timestamps():
+    first_part = make_transcription(' Hello there. ', 10.0, [(0.0, 4.0, ' Hello'), (4.0, 10.0, ' there.')], [('Hello', 0.5, 1.0), ('there', 4.5, 5.0)])
+    second_part = make_transcription('General Kenobi.', 8.0, [(1.0, 8.0, ' General Kenobi.')], [('General', 1.0, 1.5)])
+
+    stitched = stitch_transcription_parts([(0, first_part), (10000, second_part)])
+
+    assert stitched['text'] == 'Hello there. General Kenobi.'
+    assert stitched['duration'] == 18.0
+    assert stitched['language'] == 'english'
+    assert [segment['id'] for segment in stitched['segments']] == [0, 1, 2]
+    assert [(segment['start'], segment['end']) for segment in stitched['segments']] == [(0.0, 4.0), (4.0, 10.0), (11.0, 18.0)]
+    assert [(word['word'], word['start']) for word in stitched['words']] == [('Hello', 0.5), ('there', 4.5), ('General', 11.0)]
+
+def test_stitch_transcription_parts_skips_empty_text():
+    stitched = stitch_transcription_parts([(0, make_transcription('One.', 5.0, [], [])), (5000, make_transcription(' ', 5.0, [], []))])
+
+    assert stitched['text'] == 'One.'
+    assert stitched['segments'] == [] and stitched['words'] == []
+
+def test_whisper_splits_large_files_at_pauses(tmp_path, start_mock_services):
+    mock = start_mock_services({'openai': {'latency': 0}})
+    file_path = write_wav(tmp_path, tone(9000) + silence(1000) + tone(9000) + silence(1000) + tone(9000))
+    endpoint_pool = load_endpoint_pool(None, model='whisper', api_version='2024-10-21')
+
+    usage = {}
+    output_file_paths = transcribe_file_with_whisper(endpoint_pool, file_path, str(tmp_path), max_file_size_mb=0.1, part_length=10, 
+                                                     transcript_format=None, usage=usage)
+
+    assert usage['requests'] == 3 and mock.stats()['openai transcriptions']['requests'] == 3
+    with open(output_file_paths[1]) as file:
+        segments = json.load(file)
+    assert [segment['id'] for segment in segments] == list(range(len(segments)))
+    # Each part starts in a pause and its segments are shifted by the part offset
+    part_starts = [segment['start'] for segment in segments if segment['start'] in (0.0, 9.5, 19.5)]
+    assert part_starts == [0.0, 9.5, 19.5]
+    assert all(earlier['start'] <= later['start'] for earlier, later in zip(segments, segments[1:]))
+
+def test_whisper_sends_small_files_whole(tmp_path, start_mock_services):
+    mock = start_mock_services({'openai': {'latency': 0}})
+    file_path = write_wav(tmp_path, tone(3000))
+    endpoint_pool = load_endpoint_pool(None, model='whisper', api_version='2024-10-21')
+
+    usage = {}
+    transcribe_file_with_whisper(endpoint_pool, file_path, str(tmp_path), transcript_format=None, usage=usage)
+
+    assert usage['requests'] == 1 and usage['part_length'] is None
+    assert mock.stats()['openai transcriptions']['requests'] == 1
+
+# Chunk export
+def test_wav_header_matches_samples():
+    chunk = tone(1234)
+
+    with wave.open(BytesIO(_wav_header(chunk) + chunk.raw_data)) as wav_file:
+        assert wav_file.getnchannels() == chunk.channels
+        assert wav_file.getframerate() == chunk.frame_rate
+        assert wav_file.getsampwidth() == chunk.sample_width
+        assert wav_file.getnframes() == int(chunk.frame_count())
+
+def test_export_chunk_to_base64_wav_round_trip(tmp_path):
+    chunk = tone(1000).set_channels(2)
+    temp_file_path = str(tmp_path / 'chunk.wav')
+
+    chunk_data = base64.b64decode(export_chunk_to_base64(chunk, file_format='wav', temp_file_path=temp_file_path))
+
+    assert chunk_data == export_chunk_to_bytes(chunk, file_format='wav')
+    assert AudioSegment.from_wav(BytesIO(chunk_data)).raw_data == chunk.raw_data
+    with open(temp_file_path, 'rb') as file:
+        assert file.read() == chunk_data
+
+def test_export_chunk_to_base64_encodes_other_formats_once(tmp_path):
+    chunk = tone(1000)
+    temp_file_path = str(tmp_path / 'chunk.mp3')
+
+    chunk_data = base64.b64decode(export_chunk_to_base64(chunk, file_format='mp3', temp_file_path=temp_file_path))
+
+    with open(temp_file_path, 'rb') as file:
+        assert file.read() == chunk_data # The temporary file holds the bytes that were sent
+    assert chunk_data[:3] == b'ID3' or chunk_data[0] == 0xFF # ID3 tag or MP3 frame sync
+
+# Batch processing
+def test_list_audio_files_from_folder_and_glob(tmp_path):
+    for file_name in ('b.mp3', 'a.WAV', 'notes.txt'):
+        (tmp_path / file_name).write_bytes(b'')
+    (tmp_path / 'more').mkdir()
+    (tmp_path / 'more' / 'c.mp3').write_bytes(b'')
+
+    assert list_audio_files(str(tmp_path)) == [str(tmp_path / 'a.WAV'), str(tmp_path / 'b.mp3')]
+    assert list_audio_files(str(tmp_path / '**' / '*.mp3')) == [str(tmp_path / 'b.mp3'), str(tmp_path / 'more' / 'c.mp3')]
+
+def test_list_audio_files_from_manifests(tmp_path):
+    (tmp_path / 'manifest.csv').write_text('file_path,speaker\nb.mp3,1\nsub/a.mp3,2\n')
+    (tmp_path / 'manifest.jsonl').write_text('{"file_path": "b.mp3"}\n\n{"file_path": "sub/a.mp3"}\n')
+
+    expected_file_paths = [os.path.join(str(tmp_path), 'b.mp3'), os.path.join(str(tmp_path), 'sub/a.mp3')]
+    assert list_audio_files(str(tmp_path / 'manifest.csv')) == expected_file_paths
+    assert list_audio_files(str(tmp_path / 'manifest.jsonl')) == expected_file_paths
+
+def test_transcribe_files_concurrently_records_each_outcome():
+    def transcribe_file(file_path, usage):
+        usage['audio_seconds'] = 60
+        if file_path == 'bad.mp3':
+            raise RuntimeError('service unavailable')
+        return [f'{file_path}.txt']
+
+    file_statuses = transcribe_files_concurrently(['good.mp3', 'bad.mp3'], transcribe_file, max_workers=2)
+
+    assert [(file_status['file_path'], file_status['status'], file_status['outputs']) for file_status in file_statuses] == \
+        [('good.mp3', 'succeeded', ['good.mp3.txt']), ('bad.mp3', 'failed', [])]
+    assert file_statuses[1]['error'] == 'service unavailable'
+    assert all(file_status['usage'] == {'audio_seconds': 60} and file_status['seconds'] is not None for file_status in file_statuses)
+